@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+"""
+Benchmark of the image resolution of docker-clean-old over large generated image listings.
+
+Reports the duration, peak memory allocated and garbage collections triggered by the grouping of image rows into
+nested lists formerly employed, and by ``resolve_amount_remove`` with its compact records now employed.
+"""
+import argparse
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+import warnings
+
+CUR_DIR = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(CUR_DIR), "docker-tools"))
+
+with warnings.catch_warnings():
+    warnings.simplefilter("ignore", DeprecationWarning)  # distutils
+    import _docker_clean_old  # noqa: E402
+    from _docker_clean_old import (  # noqa: E402
+        STATUS_EXCLUDE,
+        STATUS_FORCED,
+        STATUS_INCLUDE,
+        STATUS_KEEP,
+        STATUS_REMOVE,
+        LatestVersion,
+        classify_image,
+        iter_image_rows,
+        resolve_amount_remove
+    )
+
+
+def generate_listing(count, seed=0):
+    """
+    Generates ``docker images`` rows for a registry mirror with many repositories and recurring version tags.
+    """
+    rng = random.Random(seed)
+    rows = []
+    repos = max(1, count // 50)
+    for _ in range(count):
+        img = "registry.example.com/team-{}/image-{}".format(rng.randrange(repos // 10 + 1), rng.randrange(repos))
+        tag = "{}.{}.{}".format(rng.randrange(5), rng.randrange(20), rng.randrange(10))
+        variant = rng.random()
+        if variant < 0.05:
+            tag = "latest"
+        elif variant < 0.10:
+            tag = "<none>"
+        elif variant < 0.25:
+            tag += "-dev"
+        rows.append("{} {}".format(img, tag))
+    return rows
+
+
+def reset_cache():
+    cache = getattr(getattr(_docker_clean_old, "LatestVersion"), "_cache", None)
+    if cache is not None:
+        cache.clear()
+
+
+def resolve_before(rows, keep_count):
+    """
+    Resolution of removed images with each row grouped as a ``[status, image, version, info]`` list.
+    """
+    images = {}
+    for img, tag, info in iter_image_rows(rows):
+        raw_img = img.rsplit("/", 1)[-1]
+        status, _ = classify_image(img, tag, raw_img, None, None)
+        if status == STATUS_EXCLUDE:
+            continue
+        images.setdefault(img, [])
+        images[img].append([status, img, LatestVersion.get(tag), info])
+    sorted_images = {}
+    for key in images:
+        sorted_images[key] = sorted(images[key], key=lambda x: x[2].sort_key)
+    remove_tags = set()
+    for img_key in sorted(sorted_images):
+        k = 0
+        for i, info in reversed(list(enumerate(sorted_images[img_key]))):
+            if info[0] in [STATUS_EXCLUDE, STATUS_INCLUDE, STATUS_FORCED]:
+                continue
+            sorted_images[img_key][i][0] = STATUS_KEEP if k < keep_count else STATUS_REMOVE
+            k = k + 1
+        for status, img, tag, info in sorted_images[img_key]:
+            if status in [STATUS_INCLUDE, STATUS_FORCED, STATUS_REMOVE]:
+                remove_tags.add("{}:{}".format(img, tag.vstring))
+    return remove_tags
+
+
+def resolve_after(rows, keep_count):
+    return resolve_amount_remove(rows, keep_count, [], [], "alpha", dry_run=False)
+
+
+def measure(resolve, rows, keep_count):
+    reset_cache()
+    gc.collect()
+    start = time.perf_counter()
+    result = resolve(rows, keep_count)
+    duration = time.perf_counter() - start
+
+    reset_cache()
+    gc.collect()
+    collections = sum(stat["collections"] for stat in gc.get_stats())
+    tracemalloc.start()
+    resolve(rows, keep_count)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    collections = sum(stat["collections"] for stat in gc.get_stats()) - collections
+    return result, duration, peak, collections
+
+
+def run(count, keep_count=3):
+    rows = generate_listing(count)
+    before = measure(resolve_before, rows, keep_count)
+    after = measure(resolve_after, rows, keep_count)
+    assert before[0] == after[0]
+    return before[1:], after[1:]
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("sizes", nargs="*", type=int, default=[10000, 100000, 300000],
+                    help="Amount of image rows to generate for each benchmark run.")
+    args = ap.parse_args()
+    print("{:>10} {:>10} {:>10} {:>12} {:>12} {:>9} {:>9}".format(
+        "rows", "time (s)", "time new", "peak (MiB)", "peak new", "gc runs", "gc new"))
+    for count in args.sizes:
+        (duration, peak, collections), (duration_new, peak_new, collections_new) = run(count)
+        print("{:>10} {:>10.3f} {:>10.3f} {:>12.1f} {:>12.1f} {:>9} {:>9}".format(
+            count, duration, duration_new, peak / 2 ** 20, peak_new / 2 ** 20, collections, collections_new))
+
+
+if __name__ == "__main__":
+    main()
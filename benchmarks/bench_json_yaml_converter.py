@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+"""
+Benchmark of the JSON<=>YAML converter over large generated JSON documents.
+
+Reports the duration of reading JSON and writing YAML with the pure-Python YAML loader/dumper formerly employed, and
+with the dedicated JSON parser and libyaml dumper now employed when available, along with the resulting speedups.
+With ``--large``, reports instead the peak memory allocated by the conversion of the whole document compared to the
+incremental conversion of its items.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import yaml
+
+CUR_DIR = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(CUR_DIR), "convert-tools"))
+
+from _json_yaml_converter import convert_large_json, read_content, write_content  # noqa: E402
+
+
+def generate_document(count, seed=0):
+    """
+    Generates a JSON export of ``count`` records with nested mappings and sequences.
+    """
+    rng = random.Random(seed)
+    return [
+        {
+            "id": i,
+            "name": "item-{}".format(rng.randrange(count)),
+            "enabled": rng.random() < 0.5,
+            "score": round(rng.random() * 100, 3),
+            "tags": ["tag-{}".format(rng.randrange(50)) for _ in range(rng.randrange(5))],
+            "metadata": {"owner": "team-{}".format(rng.randrange(20)), "version": "1.{}.0".format(rng.randrange(9))},
+        }
+        for i in range(count)
+    ]
+
+
+def measure(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def run(count, tmp_dir):
+    json_path = os.path.join(tmp_dir, "input-{}.json".format(count))
+    yaml_path = os.path.join(tmp_dir, "output-{}.yaml".format(count))
+    with open(json_path, "w") as json_file:
+        json.dump(generate_document(count), json_file)
+
+    def read_pure():
+        with open(json_path, encoding="utf-8") as json_file:
+            return yaml.safe_load(json_file)
+
+    def write_pure(data):
+        with open(yaml_path, "w") as yaml_file:
+            yaml.safe_dump(data, yaml_file)
+
+    read_before, data = measure(read_pure)
+    read_after, data_after = measure(read_content, json_path)
+    assert data == data_after
+    write_before, _ = measure(write_pure, data)
+    write_after, _ = measure(write_content, data, yaml_path)
+    return os.path.getsize(json_path), read_before, read_after, write_before, write_after
+
+
+def measure_peak(func, *args, **kwargs):
+    tracemalloc.start()
+    duration, _ = measure(func, *args, **kwargs)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return duration, peak
+
+
+def run_large(count, tmp_dir):
+    json_path = os.path.join(tmp_dir, "input-{}.json".format(count))
+    yaml_path = os.path.join(tmp_dir, "output-{}.yaml".format(count))
+    with open(json_path, "w") as json_file:
+        json.dump(generate_document(count), json_file)
+
+    def convert_whole():
+        write_content(read_content(json_path), yaml_path)
+
+    whole = measure_peak(convert_whole)
+    large = measure_peak(convert_large_json, json_path, yaml_path)
+    return os.path.getsize(json_path), whole, large
+
+
+def main_large(sizes):
+    print("{:>10} {:>10} {:>12} {:>14} {:>12} {:>14}".format(
+        "records", "size (MiB)", "whole (s)", "whole (MiB)", "large (s)", "large (MiB)"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for count in sizes:
+            size, whole, large = run_large(count, tmp_dir)
+            print("{:>10} {:>10.1f} {:>12.3f} {:>14.1f} {:>12.3f} {:>14.1f}".format(
+                count, size / 2 ** 20, whole[0], whole[1] / 2 ** 20, large[0], large[1] / 2 ** 20))
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("sizes", nargs="*", type=int, default=[1000, 10000, 50000],
+                    help="Amount of records to generate in the JSON document for each benchmark run.")
+    ap.add_argument("--large", action="store_true",
+                    help="Compare peak memory of whole document and incremental conversions instead.")
+    args = ap.parse_args()
+    if args.large:
+        main_large(args.sizes)
+        return
+    print("libyaml available: {}".format(yaml.__with_libyaml__))
+    print("{:>10} {:>10} {:>12} {:>12} {:>8} {:>13} {:>13} {:>8}".format(
+        "records", "size (MiB)", "read (s)", "read new (s)", "speedup", "write (s)", "write new (s)", "speedup"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for count in args.sizes:
+            size, read_before, read_after, write_before, write_after = run(count, tmp_dir)
+            print("{:>10} {:>10.1f} {:>12.3f} {:>12.3f} {:>7.1f}x {:>13.3f} {:>13.3f} {:>7.1f}x".format(
+                count, size / 2 ** 20, read_before, read_after, read_before / read_after,
+                write_before, write_after, write_before / write_after))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+"""
+Benchmark of the CWL Application Package merge into process deployment payloads of increasing sizes.
+
+Reports the duration of parsing YAML and JSON deployment payloads with the JSON attempt followed by the pure-Python
+YAML loader formerly employed, and with the format sniffing and libyaml loader now employed when available, as well
+as the duration of writing YAML payloads with the pure-Python and libyaml dumpers, along with the resulting speedups.
+"""
+from collections import OrderedDict
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import yaml
+
+CUR_DIR = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(os.path.dirname(CUR_DIR), "merge-tools"))
+
+from merge_cwl_app_deploy import NoAliasDumper, parse_document  # noqa: E402
+
+
+def generate_payload(count):
+    """
+    Generates a process deployment payload embedding an Application Package with ``count`` inputs.
+    """
+    inputs = {
+        "input_{}".format(i): {
+            "type": ["null", "string", {"type": "array", "items": "File"}],
+            "doc": "Description of input {} employed by the process.".format(i),
+            "inputBinding": {"prefix": "--input-{}".format(i), "position": i},
+        }
+        for i in range(count)
+    }
+    unit = {"cwlVersion": "v1.0", "class": "CommandLineTool", "baseCommand": "process", "inputs": inputs,
+            "outputs": {"output": {"type": "File", "outputBinding": {"glob": "*.nc"}}}}
+    return {"processDescription": {"process": {"id": "process", "title": "Generated process"}},
+            "immediateDeployment": True, "executionUnit": [{"unit": unit}]}
+
+
+def measure(func, *args, **kwargs):
+    start = time.perf_counter()
+    result = func(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def parse_before(path):
+    with open(path, 'r') as f:
+        try:
+            return json.load(f, object_pairs_hook=OrderedDict)
+        except json.decoder.JSONDecodeError:
+            f.seek(0)
+            return yaml.safe_load(f)
+
+
+def parse_after(path):
+    with open(path, 'r', encoding="utf-8") as f:
+        return parse_document(f.read())[0]
+
+
+def run(count, tmp_dir):
+    payload = generate_payload(count)
+    yaml_path = os.path.join(tmp_dir, "deploy-{}.yml".format(count))
+    json_path = os.path.join(tmp_dir, "deploy-{}.json".format(count))
+    with open(yaml_path, "w") as yaml_file:
+        yaml.safe_dump(payload, yaml_file)
+    with open(json_path, "w") as json_file:
+        json.dump(payload, json_file, indent=4)
+
+    results = [os.path.getsize(yaml_path)]
+    for path in (yaml_path, json_path):
+        before, data = measure(parse_before, path)
+        after, data_after = measure(parse_after, path)
+        assert data == data_after
+        results.extend([before, after])
+    results.append(measure(yaml.safe_dump, payload)[0])
+    results.append(measure(yaml.dump, payload, Dumper=NoAliasDumper, sort_keys=False)[0])
+    return results
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__)
+    ap.add_argument("sizes", nargs="*", type=int, default=[100, 1000, 10000],
+                    help="Amount of inputs of the Application Package in the payload for each benchmark run.")
+    args = ap.parse_args()
+    print("libyaml available: {}".format(yaml.__with_libyaml__))
+    print("{:>8} {:>10} {:>11} {:>11} {:>8} {:>11} {:>11} {:>8} {:>11} {:>11} {:>8}".format(
+        "inputs", "size (MiB)", "yaml (s)", "yaml new", "speedup", "json (s)", "json new", "speedup",
+        "dump (s)", "dump new", "speedup"))
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for count in args.sizes:
+            size, yaml_before, yaml_after, json_before, json_after, dump_before, dump_after = run(count, tmp_dir)
+            print("{:>8} {:>10.2f} {:>11.3f} {:>11.3f} {:>7.1f}x {:>11.3f} {:>11.3f} {:>7.1f}x "
+                  "{:>11.3f} {:>11.3f} {:>7.1f}x".format(
+                      count, size / 2 ** 20, yaml_before, yaml_after, yaml_before / yaml_after,
+                      json_before, json_after, json_before / json_after,
+                      dump_before, dump_after, dump_before / dump_after))
+
+
+if __name__ == "__main__":
+    main()
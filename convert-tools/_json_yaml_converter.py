@@ -1,19 +1,250 @@
 #!/user/bin/env python
 
 import argparse
+import codecs
+import contextlib
+import errno
+import glob
+import hashlib
+import io
 import json
+import mmap
 import os
+import re
+import signal
+import socket
+import socketserver
 import sys
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import yaml
 
+try:
+    # libyaml bindings are much faster, but not always available
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper, SafeLoader
+
 __version__ = "0.3.1"
 
+# location shared with the bash client of the wrapper scripts
+SERVER_SOCKET = os.getenv("JSON_YAML_CONVERTER_SOCKET") or os.path.join(
+    os.getenv("XDG_RUNTIME_DIR") or tempfile.gettempdir(), "json-yaml-converter-{}.sock".format(os.getuid())
+)
+
 
 def read_content(file_path, ignore_extension=False):
-    if not ignore_extension and os.path.splitext(file_path)[-1] not in [".json", ".yaml", ".yml"]:
+    ext = os.path.splitext(file_path)[-1]
+    if not ignore_extension and ext not in [".json", ".yaml", ".yml"]:
+        return False
+    with open(file_path, mode='r', encoding="utf-8") as f:
+        if ext == ".json" or (ext not in [".yaml", ".yml"] and sniff_json(f)):
+            try:
+                return json.load(f)
+            except ValueError:  # JSON-like YAML (e.g.: flow mapping)
+                f.seek(0)
+        return yaml.load(f, Loader=SafeLoader)    # can read both json/yaml
+
+
+def sniff_json(stream):
+    """
+    Checks if the first non-whitespace character of the stream indicates JSON contents, and rewinds it.
+    """
+    char = " "
+    while char and char.isspace():
+        char = stream.read(1)
+    stream.seek(0)
+    return char in ["{", "["]
+
+
+def read_documents(file_path, ignore_extension=False):
+    """
+    Generates the documents of a stream one at a time, such that memory is bounded by the largest single document.
+
+    Files with ``.jsonl`` or ``.ndjson`` extension are read as JSON Lines (one document per line). Others are read as
+    YAML document streams separated by ``---`` (which includes a single JSON document). When the extension is ignored,
+    JSON Lines are detected if the first line is a complete JSON document.
+    """
+    ext = os.path.splitext(file_path)[-1]
+    if not ignore_extension and ext not in [".json", ".jsonl", ".ndjson", ".yaml", ".yml"]:
         return False
+    return _iter_documents(file_path, ext)
+
+
+def _iter_documents(file_path, ext):
     with open(file_path, mode='r', encoding="utf-8") as f:
-        return yaml.safe_load(f)    # can read both json/yaml
+        json_lines = ext in [".jsonl", ".ndjson"]
+        if not json_lines and ext not in [".json", ".yaml", ".yml"] and sniff_json(f):
+            try:
+                json.loads(f.readline())
+                json_lines = True
+            except ValueError:
+                pass
+            f.seek(0)
+        if json_lines:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+        else:
+            yield from yaml.load_all(f, Loader=SafeLoader)
+
+
+def iter_json_items(file_path, chunk_size=2 ** 20):
+    """
+    Generates the items of a top-level JSON array, or the members of a top-level JSON object, as they are parsed.
+
+    The file is memory-mapped and decoded incrementally by chunks, such that memory usage is bounded by the largest
+    single item rather than the whole file.
+
+    :returns: generator of items (for an array) or key-value pairs (for an object), preceded by the container type
+        (``list`` or ``dict``) as first generated value.
+    :raises ValueError: if the top-level value is not an array or an object, or the contents are not valid JSON.
+    """
+    decoder = json.JSONDecoder()
+    with open(file_path, mode="rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            raise ValueError("empty JSON file: [{}]".format(file_path))
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            reader = _JSONChunkReader(data, chunk_size)
+            start = reader.next_char()
+            if start not in ["[", "{"]:
+                raise ValueError("top-level JSON value is not an array or an object: [{}]".format(file_path))
+            end = "]" if start == "[" else "}"
+            yield list if start == "[" else dict
+            reader.pos += 1
+            if reader.next_char() == end:
+                return
+            while True:
+                if start == "{":
+                    key = reader.decode(decoder)
+                    if reader.next_char() != ":":
+                        raise ValueError("expected ':' at position {} of [{}]".format(reader.offset, file_path))
+                    reader.pos += 1
+                    yield key, reader.decode(decoder)
+                else:
+                    yield reader.decode(decoder)
+                char = reader.next_char()
+                reader.pos += 1
+                if char == end:
+                    return
+                if char != ",":
+                    raise ValueError("expected ',' or '{}' at position {} of [{}]".format(
+                        end, reader.offset - 1, file_path))
+
+
+class _JSONChunkReader(object):
+    """
+    Text buffer over memory-mapped JSON contents, extended by decoding further chunks only when required.
+    """
+    # characters that can continue a number, which could therefore be truncated if only those remain in the buffer
+    number_tail = re.compile(r"[0-9.eE+-]*\Z")
+
+    def __init__(self, data, chunk_size):
+        self.data = data
+        self.chunk_size = chunk_size
+        self.read_pos = 0
+        self.decoder = codecs.getincrementaldecoder("utf-8")()
+        self.buffer = ""
+        self.pos = 0
+        self.consumed = 0
+
+    @property
+    def offset(self):
+        return self.consumed + self.pos
+
+    @property
+    def eof(self):
+        return self.read_pos >= len(self.data)
+
+    def extend(self, size=None):
+        size = size or self.chunk_size
+        chunk = self.data[self.read_pos:self.read_pos + size]
+        self.read_pos += len(chunk)
+        if self.pos > self.chunk_size:  # drop parsed contents
+            self.consumed += self.pos
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        self.buffer += self.decoder.decode(chunk, final=self.eof)
+
+    def next_char(self):
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos].isspace():
+                self.pos += 1
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos + 1]
+            self.extend()
+
+    def decode(self, decoder):
+        self.next_char()
+        size = self.chunk_size
+        while True:
+            try:
+                value, end = decoder.raw_decode(self.buffer, self.pos)
+                # a value ending with the buffer could be truncated (e.g.: number split over chunks), and so could a
+                # number followed only by characters that continue it (e.g.: '12.' of '12.5', or '1e' of '1e5')
+                truncated = end == len(self.buffer) or (
+                    isinstance(value, (int, float)) and not isinstance(value, bool)
+                    and self.number_tail.match(self.buffer, end)
+                )
+                if not truncated or self.eof:
+                    self.pos = end
+                    return value
+            except ValueError:
+                if self.eof:
+                    raise
+            self.extend(size)
+            size *= 2  # avoid parsing large items again for every chunk
+
+
+def convert_large_json(file_in, file_out, indent=None, sort=False, ensure_ascii=False, chunk_size=2 ** 20):
+    """
+    Converts a large JSON array or object to YAML, writing sequence items or mapping members as they are parsed.
+
+    Only the contents of each item or member are sorted with ``sort``, since the top-level object is never loaded.
+    """
+    items = iter_json_items(file_in, chunk_size=chunk_size)
+    container = next(items)
+    empty = True
+    with open(file_out, 'w') as f:
+        for item in items:
+            data = [item] if container is list else dict([item])
+            yaml.dump(data, f, Dumper=SafeDumper, indent=indent, sort_keys=sort, allow_unicode=not ensure_ascii)
+            empty = False
+        if empty:
+            f.write("[]\n" if container is list else "{}\n")
+    return True
+
+
+def write_documents(documents, file_path, file_format=None, indent=None, sort=False, ensure_ascii=False):
+    """
+    Writes documents one at a time as they are generated, either as JSON Lines or as a YAML document stream.
+
+    :returns: number of written documents, or ``False`` if the format is unknown.
+    """
+    if not file_format:
+        file_format = os.path.splitext(file_path)[-1]
+    file_format = file_format.replace(".", "", 1)
+    count = 0
+    if file_format in ["json", "jsonl", "ndjson"]:
+        with open(file_path, 'w') as f:
+            for data in documents:
+                # indentation is not applicable since each document must remain on a single line
+                f.write(json.dumps(data, sort_keys=sort, ensure_ascii=ensure_ascii) + "\n")
+                count += 1
+        return count
+    if file_format in ["yaml", "yml"]:
+        def counted():
+            nonlocal count
+            for data in documents:
+                count += 1
+                yield data
+
+        with open(file_path, 'w') as f:
+            yaml.dump_all(counted(), f, Dumper=SafeDumper, explicit_start=True,
+                          indent=indent, sort_keys=sort, allow_unicode=not ensure_ascii)
+        return count
+    return False
 
 
 def write_content(data, file_path, file_format=None, indent=None, sort=False, ensure_ascii=False):
@@ -26,20 +257,292 @@ def write_content(data, file_path, file_format=None, indent=None, sort=False, en
             return True
     if file_format in ["yaml", "yml"]:
         with open(file_path, 'w') as f:
-            yaml.safe_dump(data, f, indent=indent, sort_keys=sort, allow_unicode=not ensure_ascii)
+            yaml.dump(data, f, Dumper=SafeDumper, indent=indent, sort_keys=sort, allow_unicode=not ensure_ascii)
             return True
     return False
 
 
-def main():
-    args = sys.argv[1:]
+def _sniff_json_file(file_path):
+    # only a top-level array or object can be streamed, other contents are converted as a whole
+    with open(file_path, mode='r', encoding="utf-8") as f:
+        return sniff_json(f)
+
+
+def convert_file(file_in, file_out, ignore_extension=False, file_format="", indent=None, sort=False,
+                 ensure_ascii=False, stream=False, large=False):
+    if not file_in or not os.path.isfile(file_in):
+        raise IOError("failed reading: [{}]".format(file_in))
+    out_format = (file_format or os.path.splitext(file_out)[-1]).replace(".", "", 1)
+    if large and out_format in ["yaml", "yml"] and (os.path.splitext(file_in)[-1] == ".json" or ignore_extension) \
+            and _sniff_json_file(file_in):
+        success = convert_large_json(file_in, file_out, indent=indent, sort=sort, ensure_ascii=ensure_ascii)
+    elif stream:
+        documents = read_documents(file_in, ignore_extension=ignore_extension)
+        success = documents is not False and write_documents(
+            documents, file_out, file_format=file_format,
+            indent=indent, sort=sort, ensure_ascii=ensure_ascii
+        ) is not False
+    else:
+        data = read_content(file_in, ignore_extension=ignore_extension)
+        success = write_content(data, file_out, file_format=file_format,
+                                indent=indent, sort=sort, ensure_ascii=ensure_ascii)
+    if not success or not file_out or not os.path.isfile(file_out):
+        raise IOError("failed writing: [{}]".format(file_out))
+
+
+class ConversionCache(object):
+    """
+    Manifest of previous conversions, used to skip files that did not change since then.
+
+    Each output file is recorded with the hash of its input and output contents, and the conversion options. File
+    sizes and modification times are also recorded to avoid hashing files again when they were not modified.
+    Output files are referenced relative to the manifest location, such that it remains valid if moved with them.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.skipped = 0
+        if os.path.isfile(path):
+            with open(path, mode="r", encoding="utf-8") as f:
+                self.entries = json.load(f).get("files", {})
+
+    def key(self, file_out):
+        return os.path.relpath(os.path.abspath(file_out), os.path.dirname(os.path.abspath(self.path)))
+
+    def save(self):
+        tmp_path = "{}.{}.tmp".format(self.path, os.getpid())
+        with open(tmp_path, mode="w", encoding="utf-8") as f:
+            json.dump({"version": __version__, "files": self.entries}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def hash_file(file_path):
+    digest = hashlib.sha256()
+    with open(file_path, mode="rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def file_state(file_path):
+    stat = os.stat(file_path)
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def cached_hash(file_path, state, entry, prefix):
+    """
+    Obtains the hash of a file, reusing the recorded one if the file size and modification time did not change.
+    """
+    if entry and entry.get(prefix + "_state") == state:
+        return entry[prefix + "_hash"]
+    return hash_file(file_path)
+
+
+def convert_cached(file_in, file_out, entry=None, **options):
+    """
+    Converts a file unless its input, options and output are unchanged since the conversion recorded by the entry.
+
+    The output is written to a temporary file first, and only replaces the existing output (atomically) if their
+    contents differ, such that the output is never partially written and its modification time is left untouched.
+
+    :returns: tuple of updated cache entry and whether the conversion was skipped.
+    """
+    options_key = json.dumps(dict(options, version=__version__), sort_keys=True)
+    in_state = file_state(file_in)
+    in_hash = cached_hash(file_in, in_state, entry, "input")
+    if entry and entry["options"] == options_key and entry["input_hash"] == in_hash and os.path.isfile(file_out):
+        out_state = file_state(file_out)
+        if cached_hash(file_out, out_state, entry, "output") == entry["output_hash"]:
+            return dict(entry, input_state=in_state, output_state=out_state), True
+
+    file_format = options.get("file_format") or os.path.splitext(file_out)[-1]
+    tmp_out = "{}.{}.tmp".format(file_out, os.getpid())
+    try:
+        convert_file(file_in, tmp_out, **dict(options, file_format=file_format))
+        out_hash = hash_file(tmp_out)
+        if os.path.isfile(file_out) and hash_file(file_out) == out_hash:
+            os.remove(tmp_out)
+        else:
+            os.replace(tmp_out, file_out)
+    finally:
+        if os.path.isfile(tmp_out):
+            os.remove(tmp_out)
+    entry = {"input": os.path.abspath(file_in), "options": options_key, "input_hash": in_hash,
+             "input_state": in_state, "output_hash": out_hash, "output_state": file_state(file_out)}
+    return entry, False
+
+
+def find_files(file_in, file_out, file_format="", ignore_extension=False, stream=False):
+    """
+    Finds pairs of input and output files to convert from an input directory or glob pattern.
+
+    The output is a directory where the layout of input files is mirrored, relative to the input directory or to the
+    directory part of the glob pattern. The extension of output files is replaced according to the desired format, or
+    swapped between JSON and YAML if it is not specified.
+
+    :returns: list of input and output file paths.
+    """
+    if os.path.isdir(file_in):
+        base_dir = file_in
+        inputs = [
+            os.path.join(root, name)
+            for root, _, names in os.walk(file_in)
+            for name in names
+        ]
+    else:
+        base_dir = os.path.dirname(file_in.split("*")[0].split("?")[0].split("[")[0])
+        inputs = [path for path in glob.glob(file_in, recursive=True) if os.path.isfile(path)]
+    known = [".json", ".yaml", ".yml"] + ([".jsonl", ".ndjson"] if stream else [])
+    files = []
+    for path in sorted(inputs):
+        name, ext = os.path.splitext(os.path.relpath(path, base_dir))
+        if ext not in known and not ignore_extension:
+            continue
+        out_format = file_format or ("yaml" if ext in [".json", ".jsonl", ".ndjson"] else "json")
+        out_ext = ".jsonl" if out_format == "json" and stream else ".{}".format(out_format)
+        files.append((path, os.path.join(file_out, name + out_ext)))
+    return files
+
+
+def _convert_task(task):
+    file_in, file_out, options, use_cache, entry = task
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(file_out)), exist_ok=True)
+        if use_cache:
+            entry, skipped = convert_cached(file_in, file_out, entry, **options)
+            return None, entry, skipped
+        convert_file(file_in, file_out, **options)
+    except Exception as exc:  # report errors per file without interrupting others
+        return "{}: {}".format(type(exc).__name__, exc), None, False
+    return None, None, False
+
+
+def convert_files(files, jobs=1, cache=None, **options):
+    """
+    Converts many files within a single process, or distributed over a pool of processes.
+
+    :param files: list of input and output file paths.
+    :param jobs: number of processes converting files concurrently.
+    :param cache: :class:`ConversionCache` employed to skip unchanged files, updated with converted ones.
+    :param options: conversion options of :func:`convert_file`.
+    :returns: list of errors for each file, ``None`` when its conversion succeeded.
+    """
+    tasks = [
+        (file_in, file_out, options, cache is not None, cache.entries.get(cache.key(file_out)) if cache else None)
+        for file_in, file_out in files
+    ]
+    if jobs <= 1 or len(tasks) <= 1:
+        results = [_convert_task(task) for task in tasks]
+    else:
+        chunk_size = max(1, len(tasks) // (jobs * 4))
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            results = list(executor.map(_convert_task, tasks, chunksize=chunk_size))
+    if cache is not None:
+        for (_, file_out), (_, entry, skipped) in zip(files, results):
+            if entry:
+                cache.entries[cache.key(file_out)] = entry
+            cache.skipped += int(skipped)
+    return [error for error, _, _ in results]
+
+
+class ConverterRequestHandler(socketserver.StreamRequestHandler):
+    """
+    Runs a conversion requested by a client, within a process forked from the server.
+
+    The request is composed of the client working directory, the program name and the command arguments, each
+    terminated by a NUL character. The response is the command output (both standard output and error), followed by
+    a last line with its exit code.
+    """
+    def handle(self):
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        request = self.rfile.read().decode("utf-8")
+        if not request:
+            return  # connection only checking if the service is running
+        cwd, name, *args = request.split("\0")[:-1] if request.endswith("\0") else request.split("\0")
+        output = io.StringIO()
+        code = 0
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            try:
+                os.chdir(cwd)
+                main(["--name", name] + args)
+            except SystemExit as exc:  # argparse help, version or usage error
+                code = exc.code if isinstance(exc.code, int) else int(exc.code is not None)
+            except Exception as exc:
+                print("{}: {}".format(type(exc).__name__, exc), file=sys.stderr)
+                code = 1
+        self.wfile.write("{}\n{}".format(output.getvalue(), code).encode("utf-8"))
+
+
+class ConverterServer(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+    """
+    Converter service on a local unix socket, where each request is processed by a forked process.
+
+    Forked processes inherit the already started interpreter and imported modules, which avoids their cost on every
+    conversion, while each request can employ its own working directory and outputs independently of others.
+    """
+    def __init__(self, socket_path):
+        if os.path.lexists(socket_path):
+            stat = os.lstat(socket_path)
+            if stat.st_uid != os.getuid():
+                raise PermissionError(errno.EPERM, "socket location owned by another user", socket_path)
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                client.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)  # left over by a previous server that was not stopped cleanly
+            else:
+                raise OSError(errno.EADDRINUSE, "converter service already running", socket_path)
+            finally:
+                client.close()
+        umask = os.umask(0o077)  # only the current user can connect
+        try:
+            super(ConverterServer, self).__init__(socket_path, ConverterRequestHandler)
+        finally:
+            os.umask(umask)
+        self.socket_path = socket_path
+        self.socket_inode = os.lstat(socket_path).st_ino
+
+    def server_close(self):
+        super(ConverterServer, self).server_close()
+        # only remove the socket created by this server, not one replaced since then by someone else
+        try:
+            stat = os.lstat(self.socket_path)
+        except FileNotFoundError:
+            return
+        if stat.st_ino == self.socket_inode and stat.st_uid == os.getuid():
+            os.remove(self.socket_path)
+
+
+def _stop_server(*_):
+    raise KeyboardInterrupt
+
+
+def serve(socket_path=None):
+    socket_path = socket_path or SERVER_SOCKET
+    signal.signal(signal.SIGTERM, _stop_server)  # remove the socket when stopped
+    with ConverterServer(socket_path) as server:
+        print("Serving conversions on: [{}]".format(socket_path))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+def main(args=None):
+    args = sys.argv[1:] if args is None else args
     name = os.path.splitext(os.path.split(__file__)[-1])[0]
     if len(args) > 1 and args[0] == "--name":
         name = os.path.split(args[1])[-1]
         args = args[2:]
     ap = argparse.ArgumentParser(name, description="Tool that converts JSON<=>YAML", add_help=True)
-    ap.add_argument("file_in", type=str, help="Input file from where to read data to convert (JSON or YAML).")
-    ap.add_argument("file_out", type=str, help="Output file where to write converted data (JSON or YAML).")
+    ap.add_argument("file_in", type=str, nargs="?",
+                    help="Input file from where to read data to convert (JSON or YAML). "
+                         "Can also be a directory or a glob pattern (quoted, '**' for recursive matches) to convert "
+                         "many files at once.")
+    ap.add_argument("file_out", type=str, nargs="?",
+                    help="Output file where to write converted data (JSON or YAML). When the input is a directory or "
+                         "a glob pattern, this is the output directory where the layout of input files is mirrored, "
+                         "with extensions replaced according to the desired format (or swapped if not specified).")
     ap.add_argument("--version", "-v", action="version", version="%(prog)s {}".format(__version__))
     ap.add_argument("--ignore", "-i", action="store_true", dest="ignore_extension",
                     help="Ignore input file extension, try to parse as either JSON or YAML.")
@@ -47,19 +550,64 @@ def main():
                     help="Specify the indentation to apply to the output JSON or YAML.")
     ap.add_argument("--sort", action="store_true", help="Sort mapping keys for the converted file.")
     ap.add_argument("--ascii", action="store_true", help="Enforce ASCII characters instead of permitting unicode.")
+    ap.add_argument("--stream", "-s", action="store_true",
+                    help="Convert a stream of documents one at a time, between YAML documents separated by '---' "
+                         "and JSON Lines (one JSON document per line, with '.jsonl' or '.ndjson' extension, or any "
+                         "JSON output). Memory usage remains bounded by the largest single document.")
+    ap.add_argument("--large", "-l", action="store_true",
+                    help="Convert a large JSON array or object to YAML by parsing its memory-mapped contents "
+                         "incrementally and writing each item or member as soon as it is parsed, such that memory "
+                         "usage is bounded by the largest single item instead of the whole file. "
+                         "Only the contents of each item are sorted with '--sort'. Other inputs are converted "
+                         "as a whole.")
+    ap.add_argument("--serve", nargs="?", const=SERVER_SOCKET, metavar="SOCKET",
+                    help="Run a persistent converter service on a local unix socket (default: '%(const)s', or "
+                         "'JSON_YAML_CONVERTER_SOCKET' if defined), instead of converting files. While it runs, the "
+                         "wrapper scripts forward conversions to the service, which avoids the startup time of a new "
+                         "Python process for each of them. Requires 'socat' for the wrapper scripts to connect to it.")
+    ap.add_argument("--cache", "-c", metavar="MANIFEST",
+                    help="Manifest file where the hashes of input and output contents and the conversion options "
+                         "are recorded. Conversions of inputs that did not change since are skipped, and outputs "
+                         "are rewritten (atomically) only when their contents differ.")
+    ap.add_argument("--jobs", type=int, default=1,
+                    help="Number of processes converting files concurrently when the input is a directory or a glob "
+                         "pattern (default: %(default)s).")
     f_out = ap.add_mutually_exclusive_group()
     f_out.add_argument("--json", "-j", action="store_const", const="json", dest="file_format", default="",
                        help="Specify the desired output format as JSON. Useful when the desired extension is not JSON.")
     f_out.add_argument("--yaml", "-y", "--yml", action="store_const", const="yaml", dest="file_format", default="",
                        help="Specify the desired output format as YAML. Useful when the desired extension is not YAML.")
     args = ap.parse_args(args=args)
-    if not args.file_in or not os.path.isfile(args.file_in):
-        raise IOError("failed reading: [{}]".format(args.file_in))
-    data = read_content(args.file_in, ignore_extension=args.ignore_extension)
-    success = write_content(data, args.file_out, file_format=args.file_format,
-                            indent=args.indent, sort=args.sort, ensure_ascii=args.ascii)
-    if not success or not args.file_out or not os.path.isfile(args.file_out):
-        raise IOError("failed writing: [{}]".format(args.file_out))
+    if args.serve:
+        serve(args.serve)
+        return
+    if not args.file_in or not args.file_out:
+        ap.error("the following arguments are required: file_in, file_out")
+    options = dict(ignore_extension=args.ignore_extension, file_format=args.file_format, indent=args.indent,
+                   sort=args.sort, ensure_ascii=args.ascii, stream=args.stream, large=args.large)
+    cache = ConversionCache(args.cache) if args.cache else None
+    if os.path.isfile(args.file_in) or not (os.path.isdir(args.file_in) or glob.has_magic(args.file_in)):
+        if cache is None:
+            convert_file(args.file_in, args.file_out, **options)
+            return
+        files = [(args.file_in, args.file_out)]
+        error = convert_files(files, cache=cache, **options)[0]
+        cache.save()
+        if error:
+            raise IOError("failed converting: [{}] {}".format(args.file_in, error))
+        return
+    files = find_files(args.file_in, args.file_out, args.file_format, args.ignore_extension, args.stream)
+    errors = convert_files(files, jobs=args.jobs, cache=cache, **options)
+    if cache is not None:
+        cache.save()
+    for (file_in, _), error in zip(files, errors):
+        if error:
+            print("failed converting: [{}] {}".format(file_in, error), file=sys.stderr)
+    failed = len([error for error in errors if error])
+    print("Converted {}/{} files{}.".format(len(files) - failed, len(files),
+                                           " ({} unchanged)".format(cache.skipped) if cache is not None else ""))
+    if failed:
+        raise IOError("failed converting {} of {} files".format(failed, len(files)))
 
 
 if __name__ == "__main__":
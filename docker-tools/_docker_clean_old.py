@@ -3,15 +3,31 @@
 Removes older versions of corresponding docker images according to their repository tags.
 """
 
-__version__ = "0.1.0"
+__version__ = "0.2.0"
 
 import argparse
+import calendar
+import fnmatch
+import gzip
+import heapq
+import http.client
+import json
 import logging
 import os
+import queue
+import re
+import shlex
+import socket
 import subprocess
 import sys
+import threading
+import time
+from collections import deque, namedtuple
+from concurrent.futures import ThreadPoolExecutor
 from distutils.version import LooseVersion
 from functools import total_ordering
+from operator import attrgetter
+from urllib.parse import quote, urlencode
 
 LOGGER = logging.getLogger("docker-clean-old")
 LOGGER.addHandler(logging.StreamHandler(sys.stdout))
@@ -22,6 +38,275 @@ STATUS_EXCLUDE = "e"
 STATUS_INCLUDE = "i"
 STATUS_FORCED = "f"
 STATUS_KEEP = " "
+STATUS_EXPLICIT = frozenset([STATUS_EXCLUDE, STATUS_INCLUDE, STATUS_FORCED])
+STATUS_REMOVED = frozenset([STATUS_INCLUDE, STATUS_FORCED, STATUS_REMOVE])
+STATUS_NAMES = {
+    STATUS_REMOVE: "remove",
+    STATUS_EXCLUDE: "exclude",
+    STATUS_INCLUDE: "include",
+    STATUS_FORCED: "forced",
+    STATUS_KEEP: "keep",
+}
+
+REASON_INCLUDE = "matched include pattern"
+REASON_EXCLUDE = "matched exclude pattern"
+REASON_LATEST = "latest tag"
+REASON_DANGLING = "dangling image"
+REASON_KEEP_COUNT = "within latest kept images of group"
+REASON_OLDER = "older than latest kept images of group"
+REASON_KEEP_NEWER = "created within preserved age"
+REASON_SPACE_TARGET = "not required to reach space target"
+REASON_SPACE_REMOVE = "required to reach space target"
+
+DOCKER_SOCKET = "/var/run/docker.sock"
+# image reference within a 'docker rmi' output line, not preceded or followed by other reference characters
+REFERENCE_DELIMITED = r"(?<![\w.:/@-]){}(?![\w:/@-]|\.\w)"
+
+# structured image metadata, as returned by the Docker Engine API (one entry per image ID, possibly many tags)
+ImageInfo = namedtuple("ImageInfo", ["id", "repo_tags", "created", "size", "parent", "shared_size"], defaults=[0])
+
+# outcome of the removal of a single image reference (tag or ID), with the image IDs it effectively deleted
+RemoveResult = namedtuple("RemoveResult", ["tag", "success", "error", "deleted", "size", "skipped"], defaults=[False])
+
+# container that can employ an image, preventing its removal
+ContainerInfo = namedtuple("ContainerInfo", ["id", "image_id", "state"])
+
+
+class ImageRecord(object):
+    """
+    Compact representation of a single image tag row employed for grouping and resolution of removed images.
+
+    Repository, image and tag strings are interned to share them across the many rows referring to them.
+    """
+    __slots__ = ("status", "reason", "repo", "image", "tag", "key", "info")
+
+    def __init__(self, status, repo, image, tag, key, info=None, reason=None):
+        self.status = status
+        self.reason = reason
+        self.repo = sys.intern(repo) if repo else None
+        self.image = sys.intern(image)
+        self.tag = sys.intern(tag)
+        self.key = key    # sort key of the tag version
+        self.info = info  # image metadata if available
+
+    def __repr__(self):
+        return "{}({!r}, {!r})".format(type(self).__name__, self.status, self.name)
+
+    @property
+    def name(self):
+        return "{}:{}".format(self.image, self.tag)
+
+    def to_plan(self, group):
+        """
+        Representation of the record in a removal plan.
+        """
+        return {
+            "status": STATUS_NAMES.get(self.status, self.status),
+            "reason": self.reason,
+            "group": group,
+            "image": self.image,
+            "tag": self.tag,
+            "reference": self.reference,
+            "id": self.info.id if self.info else None,
+            "size": unique_size(self.info) if self.info else None,
+        }
+
+    @property
+    def reference(self):
+        """
+        Reference to employ for removing the image.
+
+        Dangling images cannot be referenced by name, so their ID is used when known.
+        """
+        if self.info and (self.tag == "<none>" or self.image == "<none>"):
+            return self.info.id
+        return self.name
+
+
+class DockerAPIError(IOError):
+    """
+    Error response returned by the Docker Engine API.
+    """
+    def __init__(self, status, message):
+        super(DockerAPIError, self).__init__("[{}] {}".format(status, message))
+        self.status = status
+        self.message = message
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """
+    HTTP connection that talks to a local unix socket instead of a TCP host.
+    """
+    def __init__(self, socket_path, timeout=60):
+        super(UnixHTTPConnection, self).__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(self.timeout)
+        sock.connect(self.socket_path)
+        self.sock = sock
+
+
+class DockerAPIClient(object):
+    """
+    Minimal Docker Engine API client over the daemon unix socket.
+
+    A single HTTP/1.1 connection is kept alive and reused for every request, which avoids both the ``docker`` CLI
+    startup and the text formatting/parsing of its outputs.
+    """
+    def __init__(self, socket_path=None, timeout=60):
+        self.socket_path = socket_path or get_docker_socket() or DOCKER_SOCKET
+        self.conn = UnixHTTPConnection(self.socket_path, timeout=timeout)
+
+    def close(self):
+        self.conn.close()
+
+    def request(self, method, path, params=None):
+        url = "{}?{}".format(path, urlencode(params)) if params else path
+        try:
+            self.conn.request(method, url)
+            resp = self.conn.getresponse()
+        except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+            # persistent connection closed by the daemon between requests, retry once with a new one
+            self.conn.close()
+            self.conn.request(method, url)
+            resp = self.conn.getresponse()
+        body = resp.read()
+        if body and resp.getheader("Content-Type", "").startswith("application/json"):
+            data = json.loads(body.decode("utf-8"))
+        else:
+            data = body.decode("utf-8", errors="replace") or None  # plain text responses (e.g.: ``/_ping``)
+        if resp.status >= 400:
+            message = data.get("message") if isinstance(data, dict) else body.decode("utf-8", errors="replace")
+            raise DockerAPIError(resp.status, message)
+        return data
+
+    def ping(self):
+        try:
+            self.request("GET", "/_ping")
+        except (OSError, http.client.HTTPException):
+            return False
+        return True
+
+    def remove_image(self, name):
+        """
+        Removes an image reference and returns the list of ``Untagged``/``Deleted`` items reported by the daemon.
+        """
+        return self.request("DELETE", "/images/{}".format(quote(name, safe="/:@")))
+
+    def remove_container(self, container_id):
+        """
+        Removes a container along with its anonymous volumes.
+        """
+        return self.request("DELETE", "/containers/{}".format(container_id), {"v": 1})
+
+    def inspect_image(self, name):
+        """
+        Obtains the metadata of an image by ID or reference, or ``None`` if it does not exist.
+        """
+        try:
+            image = self.request("GET", "/images/{}/json".format(quote(name, safe="/:@")))
+        except DockerAPIError as exc:
+            if exc.status == 404:
+                return None
+            raise
+        return make_image_info(image)
+
+    def events(self, filters=None, since=None):
+        """
+        Generates daemon events as they occur, until the stream is closed by the daemon.
+
+        A dedicated connection without timeout is employed, since the daemon only writes to it when events occur.
+
+        :param filters: event filters, such as ``{"type": ["image"]}``.
+        :param since: timestamp from which past events are also reported, to avoid missing any since a listing.
+        """
+        params = {}
+        if filters:
+            params["filters"] = json.dumps(filters)
+        if since is not None:
+            params["since"] = int(since)
+        conn = UnixHTTPConnection(self.socket_path, timeout=None)
+        try:
+            conn.request("GET", "/events?{}".format(urlencode(params)) if params else "/events")
+            resp = conn.getresponse()
+            if resp.status >= 400:
+                raise DockerAPIError(resp.status, resp.read().decode("utf-8", errors="replace"))
+            for line in resp:
+                if line.strip():
+                    yield json.loads(line.decode("utf-8"))
+        finally:
+            conn.close()
+
+    def containers(self):
+        """
+        Lists all containers, regardless of their state.
+        """
+        return [
+            ContainerInfo(id=container["Id"], image_id=container.get("ImageID"), state=container.get("State"))
+            for container in self.request("GET", "/containers/json", {"all": 1}) or []
+        ]
+
+    def images(self, all_images=False, dangling=False):
+        """
+        Lists images sorted by newest to oldest creation, similarly to ``docker images``.
+
+        :param all_images: include intermediate images, similarly to ``docker images --all``.
+        :param dangling: list only untagged images.
+        """
+        params = {"shared-size": 1}
+        if all_images:
+            params["all"] = 1
+        if dangling:
+            params["filters"] = json.dumps({"dangling": ["true"]})
+        images = [make_image_info(img) for img in self.request("GET", "/images/json", params) or []]
+        return sorted(images, key=lambda info: info.created, reverse=True)
+
+
+def make_image_info(image):
+    """
+    Converts an image definition in the Docker Engine API format to its :class:`ImageInfo` record.
+    """
+    created = image.get("Created", 0)
+    if isinstance(created, str):  # RFC 3339 date when inspected instead of listed
+        created = calendar.timegm(time.strptime(created[:19], "%Y-%m-%dT%H:%M:%S"))
+    return ImageInfo(id=image["Id"], repo_tags=image.get("RepoTags") or [], created=created,
+                     size=image.get("Size", 0), parent=image.get("ParentId") or image.get("Parent") or None,
+                     shared_size=max(image.get("SharedSize") or 0, 0))  # -1 when not computed
+
+
+def get_docker_socket():
+    """
+    Obtains the daemon unix socket path, or ``None`` if ``DOCKER_HOST`` points to a non-socket location.
+    """
+    docker_host = os.getenv("DOCKER_HOST")
+    if not docker_host:
+        return DOCKER_SOCKET
+    if docker_host.startswith("unix://"):
+        return docker_host[len("unix://"):]
+    return None
+
+
+def get_api_client(backend="auto", docker_socket=None):
+    """
+    Obtains the Docker Engine API client according to the requested backend.
+
+    Returns ``None`` when the CLI backend should be employed instead, either explicitly or as fallback when the daemon
+    socket is not reachable in ``auto`` mode.
+    """
+    if backend == "cli":
+        return None
+    socket_path = docker_socket or get_docker_socket()
+    if backend == "auto" and (not socket_path or not os.path.exists(socket_path)):
+        LOGGER.debug("Docker socket unavailable, using CLI backend.")
+        return None
+    client = DockerAPIClient(socket_path)
+    if backend == "auto" and not client.ping():
+        LOGGER.debug("Docker socket [%s] not responding, using CLI backend.", socket_path)
+        client.close()
+        return None
+    return client
 
 
 @total_ordering
@@ -65,6 +350,9 @@ class LatestVersion(LooseVersion):
     ver_var_post = None  # value of variant if present after 'x.y.z' (eg: 'x.y.z-dev')
     latest = None   # is literal 'latest' keyword
     version = None  # version elements split by '.', with isolated '-' and other variants (eg: [1, 2, 3, '-', 'dev'])
+    sort_key = None  # precomputed tuple that orders versions (see 'make_sort_key')
+
+    _cache = {}  # interned versions by tag string
 
     def parse(self, vstring):
         super(LatestVersion, self).parse(vstring)
@@ -83,22 +371,21 @@ class LatestVersion(LooseVersion):
                 at = mid_ver.index("-")
                 post_ver = mid_ver[at + 1:]
                 mid_ver = mid_ver[:at]
-            pre = LooseVersion(".".join(str(v) for v in pre_ver))
+            # components are already split, so there is no need to parse them again as separate versions
             # if prefix variant is actually the version itself,
             # convert back middle and post and combined post variant
-            if isinstance(pre.version[0], int):
-                self.ver_int = pre.version
+            if pre_ver and isinstance(pre_ver[0], int):
+                self.ver_int = pre_ver
                 # rebuild from original to avoid removed '.', '-' from parsing
                 # use version string + start of following variant to have more robust split
                 # since parsed version middle part could be repeated or very few characters
-                mid_loc = "{}-{}".format(pre, mid_ver[0])
+                mid_loc = "{}-{}".format(".".join(str(v) for v in pre_ver), mid_ver[0])
                 self.ver_var_post = str(mid_ver[0]) + str(vstring.split(mid_loc)[-1])
             # otherwise the prefix variant is actually a prefix
             # figure out if there is any version after it
             else:
-                ver = LooseVersion(".".join(str(v) for v in mid_ver))
-                if isinstance(ver.version[0], int):
-                    self.ver_int = ver.version
+                if mid_ver and isinstance(mid_ver[0], int):
+                    self.ver_int = mid_ver
                     self.ver_var_post = post_ver
                 self.ver_var_pre = pre_ver
 
@@ -106,82 +393,192 @@ class LatestVersion(LooseVersion):
         # undo int() conversion to compare with other words
         self.version = [str(v) for v in self.version]  # noqa
         self.latest = self.version[0] == "latest"
+        self.sort_key = self.make_sort_key()
+
+    @classmethod
+    def get(cls, vstring):
+        """
+        Obtains the interned version of the tag, which is parsed only the first time it is encountered.
+        """
+        version = cls._cache.get(vstring)
+        if version is None:
+            version = cls._cache[vstring] = cls(vstring)
+        return version
+
+    def make_sort_key(self):
+        """
+        Generates the tuple that sorts versions according to the ordering rules described above.
+
+        Keys are compared with native tuple comparisons, which avoids any Python-level call while sorting.
+        Words are placed first, followed by numbered versions and then 'latest' (but numbered versions with a 'latest'
+        prefix, such as 'latest-0.5', are ordered as any other prefixed version). Numbered versions are ordered by
+        their number, and then by variant category for identical numbers (prefix only, prefix and suffix, none,
+        suffix only), and finally alphabetically by prefix and suffix.
+        """
+        if not self.ver_num:
+            return (2, ) if self.latest else (0, tuple(self.version))
+        ver_pre = self.ver_var_pre
+        ver_post = self.ver_var_post
+        if ver_pre and not ver_post:
+            variant = (0, comparable(ver_pre), ())
+        elif ver_pre:
+            variant = (1, comparable(ver_pre), comparable(ver_post))
+        elif ver_post:
+            variant = (3, (), ver_post)  # suffix is the original string when there is no prefix
+        else:
+            variant = (2, (), ())
+        return (1, comparable(self.ver_int)) + variant
 
     def __lt__(self, other):
         if not isinstance(other, LatestVersion):
-            other = LatestVersion(other)
-        # compare two numbers normally
-        if self.ver_num and other.ver_num:
-            # same versions but different variants
-            if self.ver_int == other.ver_int:
-                # first handle cases where only one of them has a variant
-                if (self.ver_var_pre and not other.ver_var_pre) or (not self.ver_var_post and other.ver_var_post):
+            other = LatestVersion.get(other)
+        return self.sort_key < other.sort_key
+
+
+def comparable(components):
+    """
+    Converts version components to a tuple where numbers and words can be compared against each other.
+    """
+    return tuple((0, c) if isinstance(c, int) else (1, c) for c in components)
+
+
+def iter_image_rows(input_images):
+    """
+    Generates ``(image, tag, info)`` rows from either ``docker images`` text lines or :class:`ImageInfo` records.
+
+    Text lines do not provide any metadata, so ``info`` is ``None`` for them.
+    Records produce one row per repository tag, or a single ``<none>:<none>`` row when dangling.
+    """
+    for row in input_images:
+        if isinstance(row, ImageInfo):
+            for repo_tag in row.repo_tags or ["<none>:<none>"]:
+                img, tag = repo_tag.rsplit(":", 1)
+                yield img, tag, row
+        elif row:  # avoid parsing empty lines
+            img, tag = row.split(" ", 1)
+            yield img, tag, None
+
+
+class ImageMatcher(object):
+    """
+    Precompiled matcher of images against include/exclude patterns.
+
+    Patterns can be any of the following, where the tag is optional to match all tags of corresponding images:
+
+        my-repo/my-image            exact image name
+        my-repo/my-image:1.0        exact image name and tag
+        my-repo/*:*-dev             glob pattern ('*', '?' and '[...]' wildcards)
+        re:my-repo/.*:[0-9.]+-rc    regular expression matched against the complete 'image:tag'
+
+    Exact patterns are looked up in sets, while all glob and regex patterns are combined in a single compiled regex,
+    so that the cost of matching does not grow with the number of patterns.
+    When ``ignore_repo`` is enabled, patterns are also matched against the image name without its repository prefix.
+    """
+    def __init__(self, patterns=None, ignore_repo=False):
+        self.ignore_repo = ignore_repo
+        self.names = set()
+        self.name_tags = set()
+        regexes = []
+        for pattern in patterns or []:
+            has_tag = ":" in pattern.rsplit("/", 1)[-1]  # ignore registry port
+            if pattern.startswith("re:"):
+                regexes.append(pattern[3:])
+            elif any(char in pattern for char in "*?["):
+                regexes.append(fnmatch.translate(pattern if has_tag else pattern + ":*"))
+            elif has_tag:
+                self.name_tags.add(pattern)
+            else:
+                self.names.add(pattern)
+        self.regex = re.compile("|".join("(?:{})".format(regex) for regex in regexes)) if regexes else None
+
+    def __bool__(self):
+        return bool(self.names or self.name_tags or self.regex)
+
+    def match(self, img, tag, raw_img=None):
+        """
+        Verifies if the image matches any pattern.
+
+        :param img: image name, including its repository prefix if any.
+        :param tag: image tag.
+        :param raw_img: image name without its repository prefix, used only when ignoring repositories.
+        """
+        names = [img, raw_img] if self.ignore_repo and raw_img and raw_img != img else [img]
+        for name in names:
+            if name in self.names:
+                return True
+            if self.name_tags or self.regex:
+                name_tag = "{}:{}".format(name, tag)
+                if name_tag in self.name_tags:
                     return True
-                if (not self.ver_var_pre and other.ver_var_pre) or (self.ver_var_post and not other.ver_var_post):
-                    return False
-                # case when both have variants and same number, simply sort alphabetically
-                # if they have the same prefix variants, fallback to post one
-                if self.ver_var_pre and self.ver_var_pre != other.ver_var_pre:
-                    return self.ver_var_pre < other.ver_var_pre
-                elif self.ver_var_post:
-                    return self.ver_var_post < other.ver_var_post
-            # when no variants, only numbers
-            return self.ver_int < other.ver_int
-        # latest is always the newest
-        # other words are always oldest
-        if self.latest:
-            return False
-        if other.latest:
-            return True
-        # at least one is a word at this point (non-number)
-        if self.ver_num:
-            return False
-        if other.ver_num:
-            return True
-        # both words, simple compare
-        return super(LatestVersion, self).__lt__(other)
+                if self.regex and self.regex.fullmatch(name_tag):
+                    return True
+        return False
 
 
 def resolve_amount_remove(input_images, keep_count, include_images, exclude_images, sort_method,
-                          include_latest=False, ignore_repo=False,dry_run=True):
+                          include_latest=False, ignore_repo=False,dry_run=True,
+                          keep_newer=None, max_usage=None, free_target=None, remove_order="oldest", now=None,
+                          plan=None):
+    """
+    Resolves which images must be removed.
+
+    With ``dry_run``, the status of every image is logged, unless a ``plan`` writer is provided, in which case
+    they are written to it instead.
+
+    :returns: references of images to remove.
+    :raises ValueError: if policies that require image metadata are requested for a listing without any metadata.
+    """
+    if not isinstance(include_images, ImageMatcher):
+        include_images = ImageMatcher(include_images, ignore_repo=ignore_repo)
+    if not isinstance(exclude_images, ImageMatcher):
+        exclude_images = ImageMatcher(exclude_images, ignore_repo=ignore_repo)
     images = {}
     order_names = (sort_method == "alpha")
-    for row in input_images:
-        if not row:  # avoid parsing empty lines
-            continue
-        img, tag = row.split(" ", 1)
-        repo, raw_img = img.rsplit("/") if "/" in img else None, img
-        img_tag = "{}:{}".format(img, tag)
+    tag_counts = {} if max_usage is not None or free_target is not None else None
+    listed = {}  # every listed image, including excluded ones, for disk usage estimation
+    rows = missing = 0
+    for img, tag, info in iter_image_rows(input_images):
+        rows += 1
+        if not info:
+            missing += 1
+        if info and tag_counts is not None:
+            tag_counts[info.id] = tag_counts.get(info.id, 0) + 1
+            listed[info.id] = info
+        repo, raw_img = img.rsplit("/", 1) if "/" in img else (None, img)
         img_key = raw_img if ignore_repo else img
-        status = None
-        if img in exclude_images:
-            status = STATUS_EXCLUDE
-        if img_tag in exclude_images:
-            status = STATUS_EXCLUDE
-        if ignore_repo and raw_img in exclude_images:
-            status = STATUS_EXCLUDE
-        if img in include_images:
-            status = STATUS_INCLUDE
-        if img_tag in include_images:
-            status = STATUS_INCLUDE
-        if ignore_repo and raw_img in include_images:
-            status = STATUS_INCLUDE
-        if tag == "<none>" or img == "<none>":
-            status = STATUS_FORCED
-        if tag == "latest":
-            if not include_latest:
-                status = STATUS_EXCLUDE
+        status, reason = classify_image(img, tag, raw_img, include_images, exclude_images, include_latest)
         if status == STATUS_EXCLUDE and not dry_run:
             continue
-        images.setdefault(img_key, [])
-        images[img_key].append([status, img, LatestVersion(tag)])
-    if sort_method == "date":
-        sorted_images = images
+        version = LatestVersion.get(tag)
+        img_key = sys.intern(img_key)
+        group = images.get(img_key)
+        if group is None:
+            group = images[img_key] = []
+        group.append(ImageRecord(status, repo, img, version.vstring, version.sort_key, info, reason))
+    if sort_method != "date":
+        for group in images.values():
+            group.sort(key=attrgetter("key"))
     else:
-        sorted_images = {}
-        for key in images:
-            sorted_images[key] = list(sorted(images[key], key=lambda x: x[-1]))
-    if dry_run:
+        # creation dates are used when available, otherwise the listing order of 'docker images' (newest first)
+        for group in images.values():
+            if all(record.info for record in group):
+                group.sort(key=lambda record: record.info.created)
+            else:
+                group.reverse()
+    policies = [option for option, value in [("--keep-newer", keep_newer), ("--max-usage", max_usage),
+                                             ("--free", free_target)] if value is not None]
+    if policies and missing:
+        if missing == rows:
+            raise ValueError("Option {} requires image metadata (API backend or JSON listing), but none was listed."
+                             .format(", ".join("'{}'".format(option) for option in policies)))
+        LOGGER.warning("%s listed images without metadata are not protected by %s.", missing, ", ".join(policies))
+    for group in images.values():
+        mark_group(group, keep_count)
+    freed = apply_retention_policies(images.values(), keep_newer=keep_newer, max_usage=max_usage,
+                                     free_target=free_target, remove_order=remove_order,
+                                     tag_counts=tag_counts, listed=listed.values(), now=now)
+    log_images = dry_run and not plan and LOGGER.isEnabledFor(logging.INFO)
+    if log_images:
         LOGGER.info("Would apply following changes on images:")
         LOGGER.info(" %s: keep", STATUS_KEEP)
         LOGGER.info(" %s: remove (normal)", STATUS_REMOVE)
@@ -190,45 +587,1029 @@ def resolve_amount_remove(input_images, keep_count, include_images, exclude_imag
         LOGGER.info(" %s: exclude", STATUS_EXCLUDE)
         LOGGER.info("----------------------------------------")
     remove_tags = set()
-    for img_key in sorted(sorted_images) if order_names else sorted_images:
-        k = 0
-        for i, info in reversed(list(enumerate(sorted_images[img_key]))):
-            if info[0] in [STATUS_EXCLUDE, STATUS_INCLUDE, STATUS_FORCED]:
+    for img_key in sorted(images) if order_names else images:
+        for record in images[img_key]:
+            if plan:
+                plan.write(record.to_plan(img_key))
+            elif log_images:
+                LOGGER.info("%s %s", record.status, record.name)
+            if record.status in STATUS_REMOVED:
+                remove_tags.add(record.reference)
+    if dry_run and freed is not None:
+        LOGGER.info("Estimated space freed: %s", format_size(freed))
+    return remove_tags
+
+
+def classify_image(img, tag, raw_img, include_images, exclude_images, include_latest=False):
+    """
+    Obtains the explicit status of an image row and its reason, or ``None`` if it depends on its group.
+    """
+    status = reason = None
+    if include_images and include_images.match(img, tag, raw_img):
+        status, reason = STATUS_INCLUDE, REASON_INCLUDE
+    elif exclude_images and exclude_images.match(img, tag, raw_img):
+        status, reason = STATUS_EXCLUDE, REASON_EXCLUDE
+    if tag == "<none>" or img == "<none>":
+        status, reason = STATUS_FORCED, REASON_DANGLING
+    if tag == "latest":
+        if not include_latest:
+            status, reason = STATUS_EXCLUDE, REASON_LATEST
+    return status, reason
+
+
+def mark_group(group, keep_count):
+    """
+    Marks which records of a group sorted from oldest to newest are kept or removed according to the keep count.
+
+    Records with an explicit status (exclude, include, forced) are left untouched and do not count toward kept ones.
+    """
+    k = 0
+    for record in reversed(group):
+        if record.status in STATUS_EXPLICIT:
+            continue
+        if k < keep_count:
+            record.status, record.reason = STATUS_KEEP, REASON_KEEP_COUNT
+        else:
+            record.status, record.reason = STATUS_REMOVE, REASON_OLDER
+        k = k + 1
+
+
+def apply_retention_policies(groups, keep_newer=None, max_usage=None, free_target=None, remove_order="oldest",
+                             tag_counts=None, listed=None, now=None):
+    """
+    Applies retention policies based on image metadata over records already marked by their keep count.
+
+    Records that would be removed are kept instead if they were created within ``keep_newer`` seconds, or if they
+    are not required to reach the disk usage budget (``max_usage`` bytes) or the amount of bytes to free
+    (``free_target``). In the later cases, removal candidates are processed from the oldest or largest image first,
+    after accounting for explicitly removed images.
+
+    Space is freed only once all tags referring to an image are removed, and only its unique size (not shared with
+    other images) is accounted for, so that layers shared across images are never counted more than once.
+    Images without metadata cannot be accounted for, and are therefore never protected by those policies.
+
+    :param groups: groups of records with resolved status.
+    :param tag_counts: total amount of tags listed for each image ID, including excluded ones.
+    :param listed: metadata of all listed images, including excluded ones, to estimate the current disk usage.
+        Otherwise, only images of the grouped records are accounted for.
+    :returns: estimated amount of bytes freed if any disk usage policy was applied, or ``None`` otherwise.
+    """
+    candidates = []
+    removed = []
+    now = time.time() if now is None else now
+    for group in groups:
+        for record in group:
+            if record.status == STATUS_REMOVE:
+                if keep_newer is not None and record.info and record.info.created >= now - keep_newer:
+                    record.status, record.reason = STATUS_KEEP, REASON_KEEP_NEWER
+                    continue
+                candidates.append(record)
+            elif record.status in STATUS_REMOVED:
+                removed.append(record)
+    if max_usage is None and free_target is None:
+        return None
+
+    if listed is None:
+        images = {}
+        for group in groups:
+            for record in group:
+                if record.info:
+                    images[record.info.id] = record.info
+        listed = images.values()
+    target = free_target or 0
+    if max_usage is not None:
+        target = max(target, estimate_disk_usage(listed) - max_usage)
+    remaining = dict(tag_counts or {})
+    freed = 0
+
+    def remove(record):
+        info = record.info
+        if not info:
+            return 0
+        remaining[info.id] = remaining.get(info.id, 1) - 1
+        if remaining[info.id] > 0:
+            return 0  # image still referenced by other tags
+        return unique_size(info)
+
+    for record in removed:
+        freed += remove(record)
+    if remove_order == "largest":
+        candidates.sort(key=lambda rec: (-unique_size(rec.info), rec.info.created) if rec.info else (0, 0))
+    else:
+        candidates.sort(key=lambda rec: rec.info.created if rec.info else 0)
+    for record in candidates:
+        if not record.info:
+            continue  # cannot be accounted for, removed as by other rules
+        if freed >= target:
+            record.status, record.reason = STATUS_KEEP, REASON_SPACE_TARGET
+            continue
+        record.reason = REASON_SPACE_REMOVE
+        freed += remove(record)
+    return freed
+
+
+def unique_size(info):
+    """
+    Size of the image layers that are not shared with any other image.
+    """
+    return info.size - max(info.shared_size or 0, 0)
+
+
+def estimate_disk_usage(images):
+    """
+    Estimates the disk usage of images, counting unique layers of each image and shared layers only once.
+
+    Since shared layers can be shared by different sets of images, their total is approximated by the largest
+    shared size of any image.
+    """
+    images = list(images)
+    shared = max([max(info.shared_size or 0, 0) for info in images] or [0])
+    return sum(unique_size(info) for info in images) + shared
+
+
+def parse_size(size):
+    """
+    Parses a size with optional unit (e.g.: ``500MB``, ``20G``, ``1.5TiB``) into bytes.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(i?)b?\s*$", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size: [{}]".format(size))
+    number, unit, binary = match.groups()
+    base = 1024 if binary else 1000
+    return int(float(number) * base ** " kmgt".index(unit.lower() or " "))
+
+
+def parse_age(age):
+    """
+    Parses an age with optional unit (e.g.: ``3600``, ``90m``, ``12h``, ``7d``, ``2w``) into seconds.
+    """
+    units = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([smhdw]?)\s*$", str(age), re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid age: [{}]".format(age))
+    number, unit = match.groups()
+    return float(number) * units[unit.lower()]
+
+
+class ImageGraph(object):
+    """
+    Relationships between parent and child images, and images employed by containers.
+
+    The graph is built once from the complete image listing (including intermediate images) and the containers, and
+    is then employed to order removals such that none of them fails because of dependent child images or containers.
+    """
+    def __init__(self, images, containers=None):
+        self.parents = {}
+        self.children = {}
+        self.tags = {}
+        for info in images:
+            self.parents[info.id] = info.parent
+            self.tags[info.id] = {tag for tag in info.repo_tags if tag != "<none>:<none>"}
+            if info.parent:
+                self.children.setdefault(info.parent, []).append(info.id)
+        self.used = {}
+        for container in containers or []:
+            self.used.setdefault(container.image_id, container.id)
+
+    def find_deletable(self, candidates):
+        """
+        Finds which of the candidate image IDs can be deleted.
+
+        An image can be deleted only if it is not employed by any container, and all its children can be deleted too.
+        """
+        deletable = {}
+        for image_id in candidates:
+            stack = [(image_id, False)]
+            while stack:
+                node, expanded = stack.pop()
+                if node in deletable:
+                    continue
+                children = self.children.get(node, [])
+                if not expanded:
+                    stack.append((node, True))
+                    stack.extend((child, False) for child in children if child not in deletable)
+                    continue
+                deletable[node] = (
+                    node in candidates and node not in self.used and all(deletable.get(c) for c in children)
+                )
+        return {image_id for image_id, ok in deletable.items() if ok}
+
+    def order_removal(self, references):
+        """
+        Orders the removal of image references such that child images are always removed before their parents.
+
+        :param references: mapping of image references (tags or IDs) to their image ID (``None`` if unknown).
+        :returns: tuple of chains of references that must each be removed in order (independent of each other),
+            and mapping of skipped references to the reason why they cannot be removed.
+        """
+        skipped = {}
+        targets = {}
+        tag_refs = {}
+        for name, image_id in references.items():
+            if image_id and image_id in self.used:
+                skipped[name] = "image in use by container {}".format(self.used[image_id][:12])
+                continue
+            targets.setdefault(image_id, []).append(name)
+            if image_id and name != image_id:
+                tag_refs.setdefault(image_id, set()).add(name)
+        # images are deleted when referenced by ID or when all their tags are removed,
+        # but only tags can be removed from images that cannot be deleted (untagged only)
+        removed_ids = {
+            image_id for image_id, names in targets.items()
+            if image_id and (image_id in names or self.tags.get(image_id) and self.tags[image_id] <= tag_refs[image_id])
+        }
+        deletable = self.find_deletable(removed_ids)
+        for image_id in removed_ids - deletable:
+            if image_id in targets[image_id]:
+                targets[image_id].remove(image_id)
+                skipped[image_id] = "image has dependent child images"
+        chains = [[name] for name in sorted(targets.pop(None, []))]
+        located = {}
+
+        def locate(image_id):
+            # find the topmost removed ancestor (independent tree root) and depth of the image in the graph,
+            # walking through intermediate images that are not removed themselves
+            chain = []
+            node = image_id
+            while node and node not in located:
+                chain.append(node)
+                node = self.parents.get(node)
+            root, depth = located[node] if node else (None, -1)
+            for node in reversed(chain):
+                depth += 1
+                if root is None and node in targets:
+                    root = node
+                located[node] = (root, depth)
+            return located[image_id]
+
+        trees = {}
+        for image_id, names in targets.items():
+            root, depth = locate(image_id)
+            # IDs last to remove their tags first
+            trees.setdefault(root, []).extend((-depth, name == image_id, name) for name in names)
+        for root in sorted(trees):
+            chains.append([name for _, _, name in sorted(trees[root])])
+        return [chain for chain in chains if chain], skipped
+
+
+def make_batches(items, batch_size):
+    """
+    Splits items into consecutive batches of at most ``batch_size`` elements.
+    """
+    items = list(items)
+    batch_size = max(1, batch_size)
+    return [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+
+
+def find_reference(line, names):
+    """
+    Finds which of the image references is mentioned in a ``docker rmi`` output line.
+
+    References must be delimited in the line (e.g.: quoted, or following ``No such image:``), such that ``img:1`` is
+    not found in a line about ``img:10``, and the longest one is preferred when many are found. Image IDs can be
+    reported by the daemon in their short form, so they are also looked for using it.
+    """
+    found = None
+    for name in names:
+        candidates = [name, name[7:19]] if name.startswith("sha256:") else [name]
+        for candidate in candidates:
+            if re.search(REFERENCE_DELIMITED.format(re.escape(candidate)), line):
+                if found is None or len(name) > len(found):
+                    found = name
+                break
+    return found
+
+
+def remove_batch_cli(batch, sizes=None, image_ids=None, deleted_ids=None):
+    """
+    Removes a batch of image references with a single ``docker rmi`` call and reports the result of each of them.
+
+    References are removed in the provided order. Images that were already deleted by the removal of a previous
+    reference (``deleted_ids``), for example untagged parents pruned along with their child, are considered removed.
+    """
+    sizes = sizes or {}
+    image_ids = image_ids or {}
+    deleted_ids = set() if deleted_ids is None else deleted_ids
+    cmd_rmi = "docker rmi {}".format(" ".join(shlex.quote(name) for name in batch))
+    LOGGER.debug("Full remove command: [%s]", cmd_rmi)
+    proc = subprocess.Popen(cmd_rmi, shell=True, universal_newlines=True,
+                            stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    pending = set(batch)
+    deleted = {name: [] for name in batch}
+    removed = set()
+    errors = {}
+    current = None
+    for line in iter(proc.stdout.readline, ""):
+        line = line.strip()
+        if line.startswith("Untagged: "):
+            name = line.split(": ", 1)[-1]
+            if name in pending:
+                current = name  # following 'Deleted' lines are the layers freed by this tag
+                removed.add(name)
+        elif line.startswith("Deleted: "):
+            img_id = line.split(": ", 1)[-1]
+            if img_id in pending:
+                current = img_id
+                removed.add(img_id)
+            if current:
+                deleted[current].append(img_id)
+        elif line:
+            name = find_reference(line, batch)
+            if name:
+                errors[name] = line
+    return_code = proc.wait()
+    for img_ids in deleted.values():
+        deleted_ids.update(img_ids)
+    results = []
+    for name in batch:
+        success = name not in errors and (name in removed or return_code == 0)
+        if not success and image_ids.get(name) in deleted_ids:
+            success = True  # pruned along with a previous reference
+            errors.pop(name, None)
+        error = errors.get(name) if not success else None
+        if not success and not error:
+            error = "no output reported for this image (exit code: {})".format(return_code)
+        size = sum(sizes.get(img_id, 0) for img_id in deleted[name])
+        results.append(RemoveResult(name, success, error, deleted[name], size))
+    return results
+
+
+def remove_batch_api(batch, socket_path, sizes=None, image_ids=None, deleted_ids=None):
+    """
+    Removes a batch of image references with the Docker Engine API, reusing one connection for the whole batch.
+
+    References are removed in the provided order. Images that were already deleted by the removal of a previous
+    reference (``deleted_ids``), for example untagged parents pruned along with their child, are not requested again.
+    """
+    sizes = sizes or {}
+    image_ids = image_ids or {}
+    deleted_ids = set() if deleted_ids is None else deleted_ids
+    results = []
+    client = DockerAPIClient(socket_path)
+    try:
+        for name in batch:
+            if image_ids.get(name) in deleted_ids:
+                results.append(RemoveResult(name, True, None, [], 0))
                 continue
-            result = STATUS_KEEP if k < keep_count else STATUS_REMOVE
-            sorted_images[img_key][i][0] = result
-            k = k + 1
-        for status, img, tag in sorted_images[img_key]:
-            if dry_run:
-                LOGGER.info("%s %s:%s", status, img, tag.vstring)
-            if status in [STATUS_INCLUDE, STATUS_FORCED, STATUS_REMOVE]:
-                remove_tags.add("{}:{}".format(img, tag.vstring))
+            try:
+                items = client.remove_image(name) or []
+            except (OSError, http.client.HTTPException) as exc:
+                results.append(RemoveResult(name, False, str(exc), [], 0))
+                continue
+            deleted = [item["Deleted"] for item in items if "Deleted" in item]
+            deleted_ids.update(deleted)
+            size = sum(sizes.get(img_id, 0) for img_id in deleted)
+            results.append(RemoveResult(name, True, None, deleted, size))
+    finally:
+        client.close()
+    return results
+
+
+def make_tasks(chains, batch_size):
+    """
+    Packs chains of references that must be removed in order into tasks of consecutive batches.
+
+    Short chains are combined into a single batch, while chains longer than the batch size are split into multiple
+    batches of the same task, so that a single worker processes them sequentially.
+    """
+    tasks = []
+    current = []
+    batch_size = max(1, batch_size)
+    for chain in chains:
+        if len(chain) > batch_size:
+            tasks.append(make_batches(chain, batch_size))
+            continue
+        if len(current) + len(chain) > batch_size:
+            tasks.append([current])
+            current = []
+        current.extend(chain)
+    if current:
+        tasks.append([current])
+    return tasks
+
+
+def remove_images(remove_tags, client=None, jobs=1, batch_size=100, sizes=None, graph=None, image_ids=None):
+    """
+    Removes image references in bounded batches distributed over a pool of workers.
+
+    When the image graph is provided, references are ordered such that child images are removed before their parents,
+    and references of images still employed by containers are skipped. Independent image trees are then processed
+    concurrently, while images of the same tree are processed in order by a single worker.
+
+    :param remove_tags: image references (``image:tag`` or IDs) to remove.
+    :param client: API client to employ, or ``None`` to use the ``docker`` CLI.
+    :param jobs: number of batches processed concurrently.
+    :param batch_size: maximum number of references processed by a single batch (a single command for the CLI).
+    :param sizes: mapping of image IDs to their size, used to report the amount of freed bytes.
+    :param graph: :class:`ImageGraph` of relationships between images and containers, if available.
+    :param image_ids: mapping of references to corresponding image IDs, required to employ the graph.
+    :returns: list of :class:`RemoveResult`, one for each reference.
+    """
+    image_ids = image_ids or {}
+    skipped = {}
+    if graph:
+        chains, skipped = graph.order_removal({name: image_ids.get(name) for name in remove_tags})
+    else:
+        chains = [[name] for name in sorted(remove_tags)]
+    tasks = make_tasks(chains, batch_size)
+
+    def remove_task(task):
+        task_results = []
+        deleted_ids = set()
+        for batch in task:
+            if client:
+                task_results.extend(remove_batch_api(batch, client.socket_path, sizes, image_ids, deleted_ids))
+            else:
+                task_results.extend(remove_batch_cli(batch, sizes, image_ids, deleted_ids))
+        return task_results
+
+    results = [
+        RemoveResult(name, False, reason, [], 0, skipped=True) for name, reason in sorted(skipped.items())
+    ]
+    if jobs <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            results.extend(remove_task(task))
+        return results
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        for task_results in executor.map(remove_task, tasks):
+            results.extend(task_results)
+    return results
+
+
+def format_size(size):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if abs(size) < 1000:
+            return "{:.1f}{}".format(size, unit) if unit != "B" else "{}{}".format(size, unit)
+        size /= 1000.0
+    return "{:.1f}TB".format(size)
+
+
+def report_removed(results, kind="images"):
+    """
+    Logs the summary of removal results.
+    """
+    failed = [result for result in results if not result.success and not result.skipped]
+    skipped = [result for result in results if result.skipped]
+    freed = sum(result.size for result in results)
+    for result in results:
+        if result.success:
+            LOGGER.debug("Removed: [%s] (%s)", result.tag, format_size(result.size))
+    for result in skipped:
+        LOGGER.info("Skipped: [%s] %s", result.tag, result.error)
+    for result in failed:
+        LOGGER.warning("Failed: [%s] %s", result.tag, result.error)
+    LOGGER.info("Removed %s/%s %s (freed: %s, failed: %s, skipped: %s).",
+                len(results) - len(failed) - len(skipped), len(results), kind,
+                format_size(freed), len(failed), len(skipped))
+
+
+class ImageWatcher(object):
+    """
+    Maintains the resolved groups of images in memory and updates them incrementally from daemon events.
+
+    After a single initial listing, each image event only inspects the affected image, and sorts and marks again the
+    groups it belongs to. Images that end up in excess of the keep count are queued, and removed at a bounded rate.
+    """
+    def __init__(self, client, keep_count=1, include_images=None, exclude_images=None, sort_method="alpha",
+                 include_latest=False, ignore_repo=False, keep_newer=None, dry_run=False, rate=None):
+        """
+        :param client: API client employed to inspect and remove images.
+        :param rate: maximum amount of removals per second, unlimited if not provided.
+        """
+        self.client = client
+        self.keep_count = keep_count
+        self.include_images = ImageMatcher(include_images, ignore_repo=ignore_repo)
+        self.exclude_images = ImageMatcher(exclude_images, ignore_repo=ignore_repo)
+        self.include_latest = include_latest
+        self.ignore_repo = ignore_repo
+        self.keep_newer = keep_newer
+        self.dry_run = dry_run
+        self.interval = 1.0 / rate if rate else 0
+        self.sort_key = attrgetter("key") if sort_method != "date" else lambda record: record.info.created
+        self.groups = {}    # group name -> records sorted from oldest to newest
+        self.records = {}   # reference -> (group name, record)
+        self.image_refs = {}  # image ID -> references of its records
+        self.queue = deque()
+        self.queued = set()
+        self.expiries = []  # heap of (time, group name) when images protected by age become removable
+        self.expiring = set()
+        self.results = []
+
+    def load(self, images):
+        """
+        Resolves the initial listing of images, and queues the removal of the ones in excess.
+        """
+        groups = set()
+        for info in images:
+            groups.update(self.add(info))
+        self.update(groups)
+
+    def add(self, info):
+        """
+        Adds the records of all tags of an image to their groups.
+
+        :returns: names of modified groups.
+        """
+        groups = set()
+        moved = set()
+        for img, tag, _ in iter_image_rows([info]):
+            repo, raw_img = img.rsplit("/", 1) if "/" in img else (None, img)
+            status, reason = classify_image(img, tag, raw_img, self.include_images, self.exclude_images,
+                                            self.include_latest)
+            if status == STATUS_EXCLUDE and not self.dry_run:
+                continue
+            version = LatestVersion.get(tag)
+            img_key = sys.intern(raw_img if self.ignore_repo else img)
+            record = ImageRecord(status, repo, img, version.vstring, version.sort_key, info, reason)
+            previous = self.records.get(record.reference)
+            if previous and previous[1].info.id != info.id:
+                moved.add(previous[1].info.id)  # tag reassigned to this image, previous one lost it
+                groups.update(self.discard(previous[1].info.id))
+            group = self.groups.setdefault(img_key, [])
+            insert_sorted(group, record, self.sort_key)
+            self.records[record.reference] = (img_key, record)
+            self.image_refs.setdefault(info.id, []).append(record.reference)
+            groups.add(img_key)
+        for image_id in moved:
+            groups.update(self.refresh(image_id))
+        return groups
+
+    def discard(self, image_id):
+        """
+        Removes all records of an image from their groups.
+
+        :returns: names of modified groups.
+        """
+        groups = set()
+        for reference in self.image_refs.pop(image_id, []):
+            img_key, record = self.records.pop(reference)
+            group = self.groups[img_key]
+            group.remove(record)
+            if not group:
+                del self.groups[img_key]
+            groups.add(img_key)
+        return groups
+
+    def refresh(self, reference):
+        """
+        Replaces the records of an image by its current state reported by the daemon.
+
+        :returns: names of modified groups.
+        """
+        info = self.client.inspect_image(reference)
+        if info is None:
+            # image deleted, reference is its ID unless it was never known
+            image_id = reference if reference in self.image_refs else None
+            if image_id is None and reference in self.records:
+                image_id = self.records[reference][1].info.id
+            return self.discard(image_id) if image_id else set()
+        return self.discard(info.id) | self.add(info)
+
+    def update(self, groups):
+        """
+        Marks records of modified groups again, and queues the removal of the ones in excess.
+        """
+        now = time.time()
+        for img_key in groups:
+            group = self.groups.get(img_key)
+            if not group:
+                continue
+            mark_group(group, self.keep_count)
+            apply_retention_policies([group], keep_newer=self.keep_newer, now=now)
+            for record in group:
+                if record.reason == REASON_KEEP_NEWER:
+                    expiry = (record.info.created + self.keep_newer, img_key)
+                    if expiry not in self.expiring:
+                        self.expiring.add(expiry)
+                        heapq.heappush(self.expiries, expiry)
+                elif record.status in STATUS_REMOVED and record.reference not in self.queued:
+                    LOGGER.debug("Queued removal: [%s] (%s)", record.reference, record.reason)
+                    self.queue.append(record.reference)
+                    self.queued.add(record.reference)
+
+    def handle(self, event):
+        """
+        Updates the groups affected by a daemon event.
+        """
+        if event.get("Type", "image") != "image":
+            return
+        action = event.get("Action") or event.get("status")
+        reference = event.get("Actor", {}).get("ID") or event.get("id")
+        if action not in ["delete", "import", "load", "pull", "tag", "untag"] or not reference:
+            return
+        LOGGER.debug("Image event: %s [%s]", action, reference)
+        self.update(self.refresh(reference))
+
+    def expire(self):
+        """
+        Marks again groups with images that are not protected by their age anymore.
+        """
+        now = time.time()
+        groups = set()
+        while self.expiries and self.expiries[0][0] <= now:
+            expiry = heapq.heappop(self.expiries)
+            self.expiring.discard(expiry)
+            groups.add(expiry[1])
+        self.update(groups)
+
+    def remove_next(self):
+        """
+        Removes the next queued image that is still marked for removal.
+
+        :returns: removal result, or ``None`` if the image does not need to be removed anymore.
+        """
+        reference = self.queue.popleft()
+        _, record = self.records.get(reference, (None, None))
+        if self.dry_run:
+            # never queued again, since the image remains
+            if record is not None and record.status in STATUS_REMOVED:
+                LOGGER.info("Would remove image: [%s] (%s)", reference, record.reason)
+            return None
+        self.queued.discard(reference)
+        if record is None or record.status not in STATUS_REMOVED:
+            return None
+        info = record.info
+        result = remove_images([reference], self.client, sizes={info.id: unique_size(info)},
+                               image_ids={reference: info.id})[0]
+        if result.success:
+            LOGGER.info("Removed: [%s] (%s, freed: %s)", reference, record.reason, format_size(result.size))
+            # do not wait for the corresponding events to forget about the removed reference
+            self.update(self.refresh(info.id))
+        else:
+            LOGGER.warning("Failed: [%s] %s", reference, result.error)
+        self.results.append(result)
+        return result
+
+    def run(self, events):
+        """
+        Processes daemon events and queued removals until the events stream is closed and the queue is empty.
+
+        Events are read by a separate thread such that removals can be paced while waiting for them.
+
+        :param events: iterable of daemon events, such as :meth:`DockerAPIClient.events`.
+        :returns: list of :class:`RemoveResult` of processed removals.
+        """
+        pending = queue.Queue()
+
+        def read_events():
+            try:
+                for event in events:
+                    pending.put(event)
+            finally:
+                pending.put(None)
+
+        threading.Thread(target=read_events, daemon=True).start()
+        streaming = True
+        next_removal = 0
+        while streaming or self.queue:
+            now = time.monotonic()
+            if self.queue and now >= next_removal:
+                if self.remove_next():
+                    next_removal = now + self.interval
+                continue
+            timeouts = [next_removal - now] if self.queue else []
+            if self.expiries:
+                timeouts.append(self.expiries[0][0] - time.time())
+            timeout = max(min(timeouts), 0) if timeouts else None
+            try:
+                event = pending.get(timeout=timeout) if streaming else time.sleep(timeout or 0)
+            except queue.Empty:
+                event = None
+            else:
+                if event is None and streaming:
+                    streaming = False
+                    LOGGER.debug("Events stream closed.")
+                    continue
+            if event:
+                self.handle(event)
+            self.expire()
+        return self.results
+
+
+def insert_sorted(group, record, sort_key):
+    """
+    Inserts a record in a group sorted by key, after records with an equal key.
+    """
+    key = sort_key(record)
+    lo, hi = 0, len(group)
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if key < sort_key(group[mid]):
+            hi = mid
+        else:
+            lo = mid + 1
+    group.insert(lo, record)
+
+
+def iter_listing(stream):
+    """
+    Generates listing rows one at a time as they are read from a text stream.
+
+    Lines can either be ``docker images --format '{{.Repository}} {{.Tag}}'`` rows, or JSON objects
+    (JSON Lines) of images in the Docker Engine API format, such as exported registry catalogs.
+    """
+    for line in stream:
+        line = line.rstrip("\r\n")
+        if line.startswith("{"):
+            yield make_image_info(json.loads(line))
+        elif line:
+            yield line
+
+
+def iter_listing_file(input_source):
+    """
+    Generates listing rows from a saved listing file, or from standard input if ``-``.
+    """
+    if input_source == "-":
+        LOGGER.debug("Listing images from standard input.")
+        yield from iter_listing(sys.stdin)
+        return
+    LOGGER.debug("Listing images from file: [%s]", input_source)
+    if input_source.endswith(".gz"):
+        listing = gzip.open(input_source, mode="rt", encoding="utf-8")
+    else:
+        listing = open(input_source, mode="r", encoding="utf-8")
+    with listing:
+        yield from iter_listing(listing)
+
+
+def iter_listing_cli():
+    """
+    Generates listing rows from the ``docker`` CLI as they are written to its output pipe.
+    """
+    cmd_img = "docker images --format '{{.Repository}} {{.Tag}}'"   # already sorted by newest to oldest creation
+    LOGGER.debug("Full listing command: [%s]", cmd_img)
+    proc = subprocess.Popen(cmd_img, shell=True, universal_newlines=True, stdout=subprocess.PIPE)
+    try:
+        yield from iter_listing(proc.stdout)
+    finally:
+        proc.stdout.close()
+        proc.wait()
+
+
+def run_cli(cmd):
+    """
+    Runs a ``docker`` CLI command and returns its output lines.
+    """
+    LOGGER.debug("Full command: [%s]", cmd)
+    proc = subprocess.Popen(cmd, shell=True, universal_newlines=True, stdout=subprocess.PIPE)
+    output = proc.communicate()[0]
+    return [line.strip() for line in output.split("\n") if line.strip()]
+
+
+def inspect_cli(kind, ids, fmt, batch_size=100):
+    """
+    Inspects objects in batches with the ``docker`` CLI and returns the formatted output lines.
+    """
+    lines = []
+    for batch in make_batches(ids, batch_size):
+        lines.extend(run_cli("docker {} inspect --format {} {}".format(
+            kind, shlex.quote(fmt), " ".join(shlex.quote(obj_id) for obj_id in batch)
+        )))
+    return lines
+
+
+def load_graph_cli():
+    """
+    Lists all images (including intermediate ones) and containers using the ``docker`` CLI.
+    """
+    image_ids = list(dict.fromkeys(run_cli("docker images --all --quiet --no-trunc")))
+    images = []
+    for line in inspect_cli("image", image_ids, "{{.Id}} {{.Parent}} {{.Size}} {{join .RepoTags \",\"}}"):
+        img_id, parent, size, repo_tags = (line.split(" ", 3) + [""])[:4]
+        images.append(ImageInfo(id=img_id, repo_tags=[tag for tag in repo_tags.split(",") if tag],
+                                created=0, size=int(size or 0), parent=parent or None))
+    container_ids = run_cli("docker ps --all --quiet --no-trunc")
+    containers = []
+    for line in inspect_cli("container", container_ids, "{{.Id}} {{.Image}} {{.State.Status}}"):
+        container_id, image_id, state = line.split(" ", 2)
+        containers.append(ContainerInfo(id=container_id, image_id=image_id, state=state))
+    return images, containers
+
+
+def list_images(client=None, input_source=None):
+    """
+    Lists images from the input source if provided, using the API client if provided, or the ``docker`` CLI otherwise.
+
+    Rows are generated incrementally, except for the API listing that is returned as a whole by the daemon.
+    """
+    if input_source:
+        return iter_listing_file(input_source)
+    if client:
+        LOGGER.debug("Listing images from API socket: [%s]", client.socket_path)
+        return client.images()
+    return iter_listing_cli()
+
+
+class PlanWriter(object):
+    """
+    Writes the status of resolved images as a removal plan.
+
+    The plan is streamed as JSON Lines (one image per line) if the file has ``.jsonl`` extension or is ``-``
+    (standard output), or as a single JSON document with the list of images otherwise. In both cases, images are
+    written as they are resolved, without accumulating them in memory.
+    When no file is provided, the writer evaluates as ``False`` and nothing is written.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.lines = bool(path) and (path == "-" or path.endswith(".jsonl"))
+        self.file = None
+        self.count = 0
+        self.redirected = []
+
+    def __bool__(self):
+        return bool(self.path)
+
+    def __enter__(self):
+        if not self.path:
+            return self
+        LOGGER.debug("Writing removal plan: [%s]", self.path)
+        if self.path == "-":
+            # keep the plan parsable by moving log messages out of the way
+            for handler in LOGGER.handlers:
+                if isinstance(handler, logging.StreamHandler) and handler.stream is sys.stdout:
+                    self.redirected.append(handler)
+                    handler.setStream(sys.stderr)
+            self.file = sys.stdout
+        else:
+            self.file = open(self.path, mode="w", encoding="utf-8")
+        if not self.lines:
+            self.file.write('{{"version": {}, "images": [\n'.format(json.dumps(__version__)))
+        return self
+
+    def write(self, entry):
+        if self.lines:
+            self.file.write(json.dumps(entry) + "\n")
+        else:
+            self.file.write((",\n" if self.count else "") + json.dumps(entry))
+        self.count += 1
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        if not self.file:
+            return
+        if not self.lines:
+            self.file.write("\n]}\n")
+        if self.file is not sys.stdout:
+            self.file.close()
+        LOGGER.info("Removal plan written with %s images: [%s]", self.count, self.path)
+        for handler in self.redirected:
+            handler.setStream(sys.stdout)
+
+
+def iter_plan(plan_in):
+    """
+    Generates the image entries of a removal plan written by :class:`PlanWriter`.
+    """
+    if plan_in == "-":
+        yield from (json.loads(line) for line in sys.stdin if line.strip())
+        return
+    with open(plan_in, mode="r", encoding="utf-8") as plan_file:
+        if plan_in.endswith(".jsonl"):
+            yield from (json.loads(line) for line in plan_file if line.strip())
+        else:
+            yield from json.load(plan_file)["images"]
+
+
+def load_plan(plan_in, sizes, image_ids):
+    """
+    Loads references of images to remove from a removal plan, along with their size and ID if available.
+    """
+    LOGGER.debug("Loading removal plan: [%s]", plan_in)
+    removed = {STATUS_NAMES[status] for status in STATUS_REMOVED}
+    remove_tags = set()
+    for entry in iter_plan(plan_in):
+        if entry["status"] not in removed:
+            continue
+        remove_tags.add(entry["reference"])
+        if entry.get("id"):
+            image_ids[entry["reference"]] = entry["id"]
+            sizes[entry["id"]] = entry.get("size") or 0
     return remove_tags
 
 
+def verify_plan(remove_tags, image_ids, current):
+    """
+    Filters references of a removal plan that no longer refer to the image recorded when the plan was resolved.
+
+    References re-tagged onto another image since then (e.g.: re-pushed tags) or already removed are skipped, such that
+    only reviewed images get removed. References without a recorded image ID cannot be verified and are kept.
+
+    :param remove_tags: references to remove from the plan.
+    :param image_ids: image IDs recorded in the plan for each reference.
+    :param current: current image ID of each reference (``image:tag`` and IDs themselves).
+    :returns: tuple of references to remove and skipped results.
+    """
+    verified = set()
+    skipped = []
+    for name in sorted(remove_tags):
+        planned_id = image_ids.get(name)
+        current_id = current.get(name)
+        if planned_id and current_id != planned_id:
+            if current_id:
+                error = "now refers to image [{}] instead of planned [{}]".format(current_id, planned_id)
+            else:
+                error = "no longer exists"
+            skipped.append(RemoveResult(name, False, error, [], 0, True))
+        else:
+            verified.add(name)
+    return verified, skipped
+
+
+def collect_metadata(rows, sizes, image_ids):
+    """
+    Forwards listing rows while collecting the unique size and the references of images with available metadata.
+    """
+    for row in rows:
+        if isinstance(row, ImageInfo):
+            sizes[row.id] = unique_size(row)
+            image_ids[row.id] = row.id
+            for repo_tag in row.repo_tags:
+                image_ids[repo_tag] = row.id
+        yield row
+
+
 def docker_clean_old(keep_count=1, include_latest=True, sort_method="alpha", dry_run=False,
-                     exclude_images=None, include_images=None, ignore_repo=False):
+                     exclude_images=None, include_images=None, ignore_repo=False,
+                     backend="auto", docker_socket=None, jobs=1, batch_size=100, input_source=None,
+                     keep_newer=None, max_usage=None, free_target=None, remove_order="oldest",
+                     plan_out=None, plan_in=None, watch=False, rate=None):
     include_images = include_images or []
     exclude_images = exclude_images or []
-    cmd_img = "docker images --format '{{.Repository}} {{.Tag}}'"   # already sorted by newest to oldest creation
-    LOGGER.debug("Full listing command: [%s]".format(cmd_img))
-    proc = subprocess.Popen(cmd_img, shell=True, universal_newlines=True, stdout=subprocess.PIPE)
-    output = proc.communicate()[0]
-    output = output.split("\n")
-    remove_tags = resolve_amount_remove(output, keep_count, sort_method=sort_method, dry_run=dry_run,
-                                        include_images=include_images, exclude_images=exclude_images,
-                                        include_latest=include_latest, ignore_repo=ignore_repo)
+    if watch:
+        return watch_images(keep_count=keep_count, include_latest=include_latest, sort_method=sort_method,
+                            dry_run=dry_run, exclude_images=exclude_images, include_images=include_images,
+                            ignore_repo=ignore_repo, docker_socket=docker_socket, keep_newer=keep_newer, rate=rate)
+    dry_run = dry_run or bool(plan_out)
+    client = None if dry_run and input_source else get_api_client(backend, docker_socket)
+    sizes = {}
+    image_ids = {}
+    if plan_in:
+        remove_tags = load_plan(plan_in, sizes, image_ids)
+    else:
+        output = collect_metadata(list_images(client, input_source), sizes, image_ids)
+        with PlanWriter(plan_out) as plan:
+            remove_tags = resolve_amount_remove(output, keep_count, sort_method=sort_method, dry_run=dry_run,
+                                                include_images=include_images, exclude_images=exclude_images,
+                                                include_latest=include_latest, ignore_repo=ignore_repo,
+                                                keep_newer=keep_newer, max_usage=max_usage,
+                                                free_target=free_target, remove_order=remove_order, plan=plan)
     if dry_run:
+        if client:
+            client.close()
+        if plan_in:
+            LOGGER.info("Would remove following images from plan:\n%s", "\n".join(sorted(remove_tags)))
         LOGGER.debug("All done (dry-run).")
         return
-    images_to_rm = ["'{}'".format(img_tag) for img_tag in remove_tags]  # ensure separation with quotes
-    LOGGER.debug("List to remove:\n%s", "\n".join(images_to_rm))
-    cmd_rmi = "docker rmi {}".format(" ".join(images_to_rm))
-    LOGGER.debug("Full remove command: [%s]".format(cmd_rmi))
-    proc = subprocess.Popen(cmd_rmi, shell=True, universal_newlines=True, stdout=subprocess.PIPE)
-    for line in iter(proc.stdout.readline, ''):  # forward stdout if command to console
-        sys.stdout.write(line)  # noqa
+    # parents can be intermediate images, which are not part of the normal listing
+    if client:
+        all_images = client.images(all_images=True)
+        containers = client.containers()
+        client.close()
+    else:
+        all_images, containers = load_graph_cli()
+    graph = ImageGraph(all_images, containers)
+    current = {info.id: info.id for info in all_images}
+    current.update({repo_tag: info.id for info in all_images for repo_tag in info.repo_tags})
+    skipped = []
+    if plan_in:
+        remove_tags, skipped = verify_plan(remove_tags, image_ids, current)
+    for info in all_images:
+        sizes.setdefault(info.id, unique_size(info))
+    for reference, image_id in current.items():
+        image_ids.setdefault(reference, image_id)  # references of text listings have no metadata
+    LOGGER.debug("List to remove:\n%s", "\n".join(sorted(remove_tags)))
+    results = remove_images(remove_tags, client, jobs=jobs, batch_size=batch_size, sizes=sizes,
+                            graph=graph, image_ids=image_ids)
+    results.extend(skipped)
+    report_removed(results)
     LOGGER.debug("Done.")
+    return results
+
+
+def watch_images(keep_count=1, include_latest=True, sort_method="alpha", dry_run=False,
+                 exclude_images=None, include_images=None, ignore_repo=False, docker_socket=None,
+                 keep_newer=None, rate=None, events=None):
+    """
+    Removes older versions of images continuously as they are created, tagged or removed, until interrupted.
+
+    :param events: iterable of daemon events to process instead of the daemon events stream.
+    """
+    client = get_api_client("api", docker_socket)
+    watcher = ImageWatcher(client, keep_count=keep_count, include_images=include_images,
+                           exclude_images=exclude_images, sort_method=sort_method, include_latest=include_latest,
+                           ignore_repo=ignore_repo, keep_newer=keep_newer, dry_run=dry_run, rate=rate)
+    since = time.time()
+    watcher.load(client.images())
+    LOGGER.info("Watching %s image groups (%s images queued for removal).", len(watcher.groups), len(watcher.queue))
+    try:
+        watcher.run(client.events({"type": ["image"]}, since=since) if events is None else events)
+    except KeyboardInterrupt:
+        LOGGER.info("Watch interrupted.")
+    finally:
+        client.close()
+    if not dry_run:
+        report_removed(watcher.results)
+    return watcher.results
 
 
 def parse():
@@ -248,6 +1629,21 @@ def parse():
                          "Matching image groups by tag names depend on '--ignore-repo' option.")
     ap.add_argument("--keep", "-k", type=int, default=1, dest="keep_count",
                     help="Number of latest corresponding image tags to preserve.")
+    ap.add_argument("--keep-newer", "-n", type=parse_age, dest="keep_newer", metavar="AGE",
+                    help="Preserve images created more recently than the specified age, in addition to the ones "
+                         "preserved by '--keep'. Age can be provided in seconds or with a unit (e.g.: '12h', '7d', "
+                         "'2w'). Requires image metadata (API backend or JSON listing).")
+    ap.add_argument("--max-usage", type=parse_size, dest="max_usage", metavar="SIZE",
+                    help="Disk usage budget of images (e.g.: '50GB', '100GiB'). Images that would be removed by other "
+                         "rules are removed only until the estimated disk usage fits within this budget. "
+                         "Requires image metadata (API backend or JSON listing).")
+    ap.add_argument("--free", type=parse_size, dest="free_target", metavar="SIZE",
+                    help="Amount of space to free (e.g.: '10GB'). Images that would be removed by other rules are "
+                         "removed only until this amount is reached. Freed space is estimated from the size of images "
+                         "not shared with other ones. Requires image metadata (API backend or JSON listing).")
+    ap.add_argument("--remove-order", choices=["oldest", "largest"], default="oldest", dest="remove_order",
+                    help="Order in which images are selected for removal when using '--max-usage' or '--free' "
+                         "(default: %(default)s).")
     ap.add_argument("--latest", "-l", action="store_true", dest="include_latest",
                     help="Include 'latest' tag as one of the N images to preserve, otherwise ignore it completely. "
                          "Tag 'latest' is always placed as most recent if using semantic version string.")
@@ -264,11 +1660,48 @@ def parse():
     ap.add_argument("--exclude", "-e", type=str, nargs="*", dest="exclude_images",
                     help="Images to exclude from the operation, "
                          "either without tag to exclude all corresponding ones by repository, "
-                         "or with a tag to exclude only that specific one.")
+                         "or with a tag to exclude only that specific one. "
+                         "Glob patterns (e.g.: 'my-repo/*:*-dev') and regular expressions prefixed by 're:' "
+                         "matched against the complete 'image:tag' (e.g.: 're:my-repo/.*:[0-9.]+-rc') are supported.")
     ap.add_argument("--include", "-i", type=str, nargs="*", dest="include_images",
                     help="Images to include in remove operation regardless of previous rules, "
                          "either without tag to include all corresponding ones by repository, "
-                         "or with a tag to include only that specific one.")
+                         "or with a tag to include only that specific one. "
+                         "Glob and regular expression patterns are supported in the same manner as '--exclude'.")
+    ap.add_argument("--from", "-f", dest="input_source", metavar="LISTING",
+                    help="Read images from a saved listing file (or standard input with '-') instead of the Docker "
+                         "daemon. Each line must either be formatted as 'docker images --format \"{{.Repository}} "
+                         "{{.Tag}}\"' output, or be a JSON object of the image as returned by the Docker Engine API "
+                         "(JSON Lines). Rows are processed as they are read, allowing very large listings. "
+                         "Compressed listings are supported with '.gz' extension. "
+                         "Combined with '--dry', images can be resolved offline from snapshots of other hosts.")
+    ap.add_argument("--plan-out", "-p", dest="plan_out", metavar="PLAN",
+                    help="Write the resolved status, group and reason of every image to a removal plan file instead "
+                         "of removing them (implies '--dry'). The plan is streamed as JSON Lines if the file has "
+                         "'.jsonl' extension or is '-' (standard output), or as a JSON document otherwise.")
+    ap.add_argument("--apply", "-a", dest="plan_in", metavar="PLAN",
+                    help="Remove images according to a previously written removal plan file (or standard input with "
+                         "'-' as JSON Lines), without listing and resolving images again. "
+                         "Options that control the resolution of images are ignored.")
+    ap.add_argument("--watch", "-w", action="store_true",
+                    help="Keep running and remove older versions of images as they are pulled, tagged or removed, "
+                         "using Docker daemon events after a single initial listing (requires the API backend). "
+                         "Only options that control the resolution of each image group are applied.")
+    ap.add_argument("--rate", type=float,
+                    help="Maximum number of image removals per second in watch mode (default: unlimited).")
+    ap.add_argument("--jobs", "-j", type=int, default=1,
+                    help="Number of removal batches to process concurrently (default: %(default)s).")
+    ap.add_argument("--batch-size", type=int, default=100,
+                    help="Maximum number of images removed by a single batch, which corresponds to one 'docker rmi' "
+                         "command with the CLI backend, or one API connection (default: %(default)s).")
+    ap.add_argument("--backend", "-b", choices=["auto", "api", "cli"], default="auto",
+                    help="Method employed to retrieve images. "
+                         "With 'api', the Docker Engine API is queried directly over its unix socket. "
+                         "With 'cli', the 'docker' command outputs are parsed. "
+                         "With 'auto' (default), 'api' is used if the socket is reachable, and 'cli' otherwise.")
+    ap.add_argument("--socket", dest="docker_socket",
+                    help="Location of the Docker daemon unix socket to employ with the API backend "
+                         "(default: from 'DOCKER_HOST' if it is a 'unix://' location, or '{}').".format(DOCKER_SOCKET))
     return ap.parse_args(args=args)
 
 
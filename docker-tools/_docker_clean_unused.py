@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+"""
+Removes stopped containers and dangling images that are not employed by any other image or container.
+"""
+
+__version__ = "0.1.0"
+
+import argparse
+import http.client
+import os
+import shlex
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from _docker_clean_old import (
+    DOCKER_SOCKET,
+    LOGGER,
+    DockerAPIClient,
+    ImageGraph,
+    RemoveResult,
+    get_api_client,
+    load_graph_cli,
+    make_batches,
+    remove_images,
+    report_removed,
+    unique_size
+)
+
+CONTAINER_STOPPED_STATES = frozenset(["exited", "dead"])
+
+
+def remove_containers(containers, client=None, jobs=1, batch_size=100):
+    """
+    Removes containers along with their anonymous volumes, in batches distributed over a pool of workers.
+    """
+    def remove_batch(batch):
+        if client:
+            api_client = DockerAPIClient(client.socket_path)
+            results = []
+            try:
+                for container in batch:
+                    try:
+                        api_client.remove_container(container.id)
+                        results.append(RemoveResult(container.id, True, None, [], 0))
+                    except (OSError, http.client.HTTPException) as exc:
+                        results.append(RemoveResult(container.id, False, str(exc), [], 0))
+            finally:
+                api_client.close()
+            return results
+        cmd_rm = "docker rm -v {}".format(" ".join(shlex.quote(container.id) for container in batch))
+        LOGGER.debug("Full remove command: [%s]", cmd_rm)
+        proc = subprocess.Popen(cmd_rm, shell=True, universal_newlines=True,
+                                stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+        output = proc.communicate()[0]
+        lines = [line.strip() for line in output.split("\n") if line.strip()]
+        results = []
+        for container in batch:
+            if container.id in lines:  # removed container IDs are echoed back
+                results.append(RemoveResult(container.id, True, None, [], 0))
+            else:
+                errors = [line for line in lines if container.id[:12] in line]
+                results.append(RemoveResult(container.id, False, errors[0] if errors else output.strip(), [], 0))
+        return results
+
+    batches = make_batches(containers, batch_size)
+    results = []
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+        for batch_results in executor.map(remove_batch, batches):
+            results.extend(batch_results)
+    return results
+
+
+def docker_clean_unused(dry_run=False, backend="auto", docker_socket=None, jobs=1, batch_size=100):
+    client = get_api_client(backend, docker_socket)
+    if client:
+        images = client.images(all_images=True)
+        containers = client.containers()
+        client.close()
+    else:
+        images, containers = load_graph_cli()
+    stopped = [container for container in containers if container.state in CONTAINER_STOPPED_STATES]
+    if dry_run:
+        removed_containers = {container.id for container in stopped}
+        for container in stopped:
+            LOGGER.info("Would remove container: [%s]", container.id[:12])
+    else:
+        container_results = remove_containers(stopped, client, jobs=jobs, batch_size=batch_size)
+        report_removed(container_results, kind="containers")
+        removed_containers = {result.tag for result in container_results if result.success}
+    remaining = [container for container in containers if container.id not in removed_containers]
+    graph = ImageGraph(images, remaining)
+    dangling = {info.id: info.id for info in images if not graph.tags[info.id]}
+    chains, skipped = graph.order_removal(dangling)
+    # untagged parents of tagged images are normal intermediate images, not dangling ones
+    intermediate = {img_id for img_id in skipped if img_id in graph.children}
+    skipped = {img_id: reason for img_id, reason in skipped.items() if img_id not in intermediate}
+    if dry_run:
+        for chain in chains:
+            for img_id in chain:
+                LOGGER.info("Would remove image: [%s]", img_id)
+        for img_id, reason in sorted(skipped.items()):
+            LOGGER.info("Would skip image: [%s] %s", img_id, reason)
+        LOGGER.debug("All done (dry-run).")
+        return
+    removable = [img_id for img_id in dangling if img_id not in intermediate]
+    sizes = {info.id: unique_size(info) for info in images}
+    results = remove_images(removable, client, jobs=jobs, batch_size=batch_size, sizes=sizes,
+                            graph=graph, image_ids=dangling)
+    report_removed(results)
+    LOGGER.debug("Done.")
+    return container_results + results
+
+
+def parse():
+    args = sys.argv[1:]
+    name = os.path.splitext(os.path.split(__file__)[-1])[0]
+    if len(args) > 1 and args[0] == "--name":
+        name = os.path.split(args[1])[-1]
+        args = args[2:]
+    ap = argparse.ArgumentParser(name, description=__doc__, add_help=True)
+    ap.add_argument("--version", "-v", action="version", version="%(prog)s {}".format(__version__))
+    ap.add_argument("--dry", "--dry-run", action="store_true", dest="dry_run",
+                    help="Run in dry-run mode. Nothing actually gets removed, only listing what would be removed.")
+    ap.add_argument("--jobs", "-j", type=int, default=1,
+                    help="Number of removal batches to process concurrently (default: %(default)s). "
+                         "Images are removed from children to parents, such that only independent image trees are "
+                         "processed concurrently.")
+    ap.add_argument("--batch-size", type=int, default=100,
+                    help="Maximum number of images or containers removed by a single batch (default: %(default)s).")
+    ap.add_argument("--backend", "-b", choices=["auto", "api", "cli"], default="auto",
+                    help="Method employed to retrieve and remove images and containers. "
+                         "With 'api', the Docker Engine API is queried directly over its unix socket. "
+                         "With 'cli', the 'docker' commands are employed. "
+                         "With 'auto' (default), 'api' is used if the socket is reachable, and 'cli' otherwise.")
+    ap.add_argument("--socket", dest="docker_socket",
+                    help="Location of the Docker daemon unix socket to employ with the API backend "
+                         "(default: from 'DOCKER_HOST' if it is a 'unix://' location, or '{}').".format(DOCKER_SOCKET))
+    return ap.parse_args(args=args)
+
+
+if __name__ == "__main__":
+    cmd_args = parse()
+    docker_clean_unused(**vars(cmd_args))
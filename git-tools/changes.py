@@ -10,69 +10,251 @@ __version__ = "0.2.0"
 
 import argparse
 import copy
+import hashlib
 import json
 import requests
 import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from distutils.version import LooseVersion
+from requests.adapters import HTTPAdapter
 
+API_URL = "https://api.github.com"
 
-def generate_changes(repo, output, output_format, oauth_token=None, cache=True):
-    ext = ".{}".format(output_format)
-    if os.path.isdir(output) or not output.endswith(ext):
-        output = os.path.join(output, "CHANGES" + ext)
-    output = os.path.abspath(output)
-    out_dir = os.path.abspath(os.path.dirname(output))
-    os.makedirs(out_dir, exist_ok=True)
 
-    headers = {}
+class RateLimiter(object):
+    """
+    Adaptive backoff shared by concurrent requests according to rate-limit headers of responses.
+
+    When the API indicates that the rate-limit is exceeded (``Retry-After`` or no ``X-RateLimit-Remaining`` request),
+    all requests are suspended until the indicated time. When only a few requests remain, they are instead spread
+    over the time left until the rate-limit resets rather than exhausting it immediately.
+    """
+    def __init__(self, jobs=1, max_delay=60):
+        self.jobs = jobs
+        self.max_delay = max_delay
+        self.resume = 0
+        self.lock = threading.Lock()
+        self.slots = threading.BoundedSemaphore(max(jobs, 1))  # concurrent requests budget shared by all callers
+
+    def wait(self):
+        with self.lock:
+            delay = self.resume - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def update(self, response):
+        """
+        Updates the backoff according to the response headers.
+
+        :returns: whether the request was refused because of the rate-limit and must be repeated.
+        """
+        headers = response.headers
+        now = time.time()
+        delay = 0
+        remaining = headers.get("X-RateLimit-Remaining")
+        reset = headers.get("X-RateLimit-Reset")
+        retry_after = headers.get("Retry-After")
+        refused = response.status_code in [403, 429] and (retry_after is not None or remaining == "0")
+        if refused and retry_after is not None:
+            delay = float(retry_after)
+        elif remaining is not None and reset is not None:
+            remaining = int(remaining)
+            reset_delay = max(float(reset) - now, 0)
+            if remaining <= 0:
+                delay = reset_delay
+            elif remaining < self.jobs:
+                delay = reset_delay / remaining
+        delay = min(delay, self.max_delay)
+        if delay > 0:
+            with self.lock:
+                self.resume = max(self.resume, now + delay)
+        return refused
+
+
+def make_session(oauth_token=None, jobs=1):
+    """
+    Creates a session with a pool of persistent connections large enough for all concurrent requests.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(jobs, 1))
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
     if oauth_token:
-        headers["Authorization"] = "token {}".format(oauth_token)
+        session.headers["Authorization"] = "token {}".format(oauth_token)
+    return session
 
-    tags_url = "https://api.github.com/repos/{}/tags".format(repo)
-    cache_dir = "/tmp/{}".format(repo.replace("/", "_"))
-    tmp_tags = "{}/tags.json".format(cache_dir)
-    tmp_info = "{}/info.json".format(cache_dir)
-    if cache:
+
+class ResponseCache(object):
+    """
+    On-disk cache of JSON responses, with one entry per requested URL along with its ``ETag``.
+    """
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
         os.makedirs(cache_dir, exist_ok=True)
 
+    def path(self, url):
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode("utf-8")).hexdigest() + ".json")
+
+    def load(self, url):
+        path = self.path(url)
+        if not os.path.isfile(path):
+            return None
+        with open(path) as cache_file:
+            return json.load(cache_file)
+
+    def save(self, url, etag, data):
+        path = self.path(url)
+        tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+        with open(tmp_path, "w") as cache_file:
+            json.dump({"url": url, "etag": etag, "data": data}, cache_file)
+        os.replace(tmp_path, path)  # concurrent readers never see partial entries
+
+
+def request_json(session, url, limiter, headers=None, retries=5):
+    """
+    Requests an URL with the session, repeating it as long as it is refused by the rate-limit.
+    """
+    for _ in range(retries):
+        limiter.wait()
+        with limiter.slots:
+            resp = session.get(url, headers=headers)
+        if not limiter.update(resp):
+            break
+    return resp
+
+
+def fetch_json(session, url, limiter, cache=None, immutable=False):
+    """
+    Fetches the JSON response of an URL, using the cached response whenever possible.
+
+    Immutable responses (e.g.: commits referenced by SHA) are returned directly from the cache. Others are revalidated
+    with a conditional request using their ``ETag``, which the API answers without content if they did not change.
+
+    :returns: tuple of the response status code and JSON data.
+    """
+    entry = cache.load(url) if cache else None
+    if entry and immutable:
+        return 200, entry["data"]
+    headers = {"If-None-Match": entry["etag"]} if entry and entry.get("etag") else None
+    resp = request_json(session, url, limiter, headers)
+    if resp.status_code == 304 and entry:
+        return 200, entry["data"]
+    data = resp.json()
+    if cache and resp.status_code == 200:
+        cache.save(url, resp.headers.get("ETag"), data)
+    return resp.status_code, data
+
+
+def fetch_tags(session, tags_url, limiter, cache=None):
+    """
+    Fetches all pages of repository tags.
+    """
     tags = []
-    if cache and os.path.isfile(tmp_tags):
-        with open(tmp_tags) as tmp_file:
-            tags = json.load(tmp_file)
-    else:
-        page = 0
-        while True:
-            tags_resp = requests.get(tags_url + "?per_page=100&page={}".format(page), headers=headers)
-            tags_list = tags_resp.json()
-            if tags_resp.status_code != 200 or not tags_list:
-                break
-            tags.extend(tags_list)
-            page += 1
-        if tags:
-            with open(tmp_tags, "w") as tmp_file:
-                json.dump(tags, tmp_file)
-
-    print("Total tags:", len(tags))
-
-    tags = {t["name"]: t for t in tags}
-
-    tag_messages = []
-    if cache and os.path.isfile(tmp_info):
-        with open(tmp_info) as tmp_file:
-            tag_messages = json.load(tmp_file)
-    else:
-        for tag, info in reversed(sorted(tags.items(), key=lambda t: LooseVersion(t[0]))):
-            commit_url = info["commit"]["url"]
-            commit = requests.get(commit_url, headers=headers).json()
-            message = commit["commit"]["message"]
-            date = commit["commit"]["committer"]["date"].split("T")[0]
-            tag_messages.append({"tag": tag, "message": message, "date": date})
-        if tag_messages:
-            with open(tmp_info, "w") as tmp_file:
-                json.dump(tag_messages, tmp_file)
+    page = 1
+    while True:
+        status, tags_list = fetch_json(session, tags_url + "?per_page=100&page={}".format(page), limiter, cache)
+        if status != 200 or not tags_list:
+            break
+        tags.extend(tags_list)
+        page += 1
+    return tags
 
-    if not tag_messages:
-        raise ValueError("Missing tag information!")
+
+def fetch_tag_messages(session, tags, limiter, jobs=1, cache=None):
+    """
+    Fetches the commit message and date of every tag concurrently, ordered from the latest to the oldest version.
+
+    Commits are immutable, such that only the ones of tags that were never fetched before are requested.
+    """
+    def fetch_commit(tag_item):
+        tag, info = tag_item
+        _, commit = fetch_json(session, info["commit"]["url"], limiter, cache, immutable=True)
+        message = commit["commit"]["message"]
+        date = commit["commit"]["committer"]["date"].split("T")[0]
+        return {"tag": tag, "message": message, "date": date}
+
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return list(executor.map(fetch_commit, sort_tags(tags)))
+
+
+def sort_tags(tags):
+    """
+    Orders tag items from the latest to the oldest version.
+    """
+    return reversed(sorted(tags.items(), key=lambda t: LooseVersion(t[0])))
+
+
+def read_local_tags(git_dir):
+    """
+    Reads the commit message and date of every tag from a local clone, ordered from the latest to the oldest version.
+
+    All tags are read by a single ``git for-each-ref`` call, which resolves loose and packed references, and both
+    lightweight tags (referring to the commit itself) and annotated tags (dereferenced to their commit).
+    Dates are reported in UTC like the Github API.
+    """
+    fields = ["%(refname:short)", "%(objecttype)", "%(*objecttype)",
+              "%(contents)", "%(committerdate:unix)", "%(*contents)", "%(*committerdate:unix)"]
+    cmd = ["git", "--git-dir", git_dir, "for-each-ref", "refs/tags", "--format", "%00".join(fields) + "%01"]
+    output = subprocess.run(cmd, check=True, stdout=subprocess.PIPE).stdout.decode("utf-8", errors="replace")
+    tags = {}
+    for record in output.split("\x01"):
+        record = record.lstrip("\n")
+        if not record:
+            continue
+        tag, obj_type, deref_type, message, date, deref_message, deref_date = record.split("\x00")
+        if obj_type == "tag":
+            if deref_type != "commit":
+                continue  # tag of tree, blob or other tag
+            message, date = deref_message, deref_date
+        elif obj_type != "commit":
+            continue
+        date = time.strftime("%Y-%m-%d", time.gmtime(int(date)))
+        tags[tag] = {"tag": tag, "message": message.rstrip("\n"), "date": date}
+    return [info for _, info in sort_tags(tags)]
+
+
+def is_newer(tag, latest_tag=None):
+    """
+    Checks if the tag is a newer version than the latest one, or any version if there is no latest one.
+    """
+    return latest_tag is None or LooseVersion(tag) > LooseVersion(latest_tag)
+
+
+def find_documented_tags(lines, version_regex):
+    """
+    Finds the version sections of an existing CHANGES file, except the 'Unreleased' one.
+
+    :returns: list of line index and tag of every version section, in order of appearance.
+    """
+    version_regex = re.compile(version_regex)
+    documented = []
+    for index, line in enumerate(lines):
+        match = version_regex.match(line)
+        if match and match.group("tag") != "Unreleased":
+            documented.append((index, match.group("tag")))
+    return documented
+
+
+def generate_changes(repo, output, output_format, oauth_token=None, cache=True, jobs=8, api_url=API_URL,
+                     cache_dir=None, source="github", git_dir=None, update=False, session=None, limiter=None):
+    """
+    Generates the CHANGES file of a repository.
+
+    :param session: session to employ for requests, shared with other repositories in batch mode.
+    :param limiter: rate-limit of requests, shared with other repositories in batch mode.
+    :returns: location of the generated file.
+    """
+    ext = ".{}".format(output_format)
+    if os.path.isdir(output) or not output.endswith(ext):
+        output = os.path.join(output, "CHANGES" + ext)
+    output = os.path.abspath(output)
+    out_dir = os.path.abspath(os.path.dirname(output))
+    os.makedirs(out_dir, exist_ok=True)
 
     change_info = "**DEFINE LATEST CHANGES UNDER BELOW 'Unreleased' SECTION - THEY WILL BE INTEGRATED IN NEXT RELEASE**"
     change_list = "list changes here, using '-' for each new entry (remove this when items are added)"
@@ -84,6 +266,7 @@ def generate_changes(repo, output, output_format, oauth_token=None, cache=True):
             separator_line,
             "",
         ]
+        version_regex = r"^`(?P<tag>[^`<]+?) <https://github\.com/"
         comment_line = ".. {}"
         change_lines = [
             ".. :changelog:",
@@ -105,6 +288,7 @@ def generate_changes(repo, output, output_format, oauth_token=None, cache=True):
             version_line,
             "",
         ]
+        version_regex = r"^## \[(?P<tag>[^\]]+)\]\(https://github\.com/"
         comment_line = "[//]: # {}"
         change_lines = [
             "# Changes",
@@ -119,6 +303,43 @@ def generate_changes(repo, output, output_format, oauth_token=None, cache=True):
     else:
         raise NotImplementedError("Unknown format: [{}]".format(output_format))
 
+    existing_lines = None
+    latest_documented = None
+    insert_index = None
+    if update and os.path.isfile(output):
+        with open(output) as changes_file:
+            existing_lines = changes_file.read().splitlines()
+        documented = find_documented_tags(existing_lines, version_regex)
+        if documented:
+            insert_index = documented[0][0]
+            latest_documented = max((tag for _, tag in documented), key=LooseVersion)
+        print("Latest documented tag:", latest_documented)
+
+    if source == "local":
+        tag_messages = read_local_tags(git_dir or os.path.join(os.path.curdir, ".git"))
+        print("Total tags:", len(tag_messages))
+        tag_messages = [info for info in tag_messages if is_newer(info["tag"], latest_documented)]
+    else:
+        session = session or make_session(oauth_token, jobs)
+        limiter = limiter or RateLimiter(jobs)
+
+        tags_url = "{}/repos/{}/tags".format(api_url.rstrip("/"), repo)
+        cache_dir = cache_dir or "/tmp/{}".format(repo.replace("/", "_"))
+        response_cache = ResponseCache(cache_dir) if cache else None
+
+        tags = fetch_tags(session, tags_url, limiter, response_cache)
+        print("Total tags:", len(tags))
+
+        tags = {t["name"]: t for t in tags if is_newer(t["name"], latest_documented)}
+        tag_messages = fetch_tag_messages(session, tags, limiter, jobs, response_cache)
+
+    if existing_lines is not None and not tag_messages:
+        print("No tag newer than [{}], output already up to date: [{}]".format(latest_documented, output))
+        return output
+    if not tag_messages:
+        raise ValueError("Missing tag information!")
+
+    version_sections = []
     for tag_info in tag_messages:
         tag_info.setdefault("branch", tag_info["tag"])
         version_lines = copy.deepcopy(new_version_lines)
@@ -130,20 +351,96 @@ def generate_changes(repo, output, output_format, oauth_token=None, cache=True):
         if len(message_lines) > 1:
             message_lines[1:] = ["  " + m for m in message_lines[1:]]
         message_lines = [m.rstrip() for m in message_lines]
-        change_lines.extend(version_lines + message_lines + [""])
+        version_sections.extend(version_lines + message_lines + [""])
+
+    if existing_lines is not None:
+        # insert missing sections below the preserved 'Unreleased' section, before already documented ones
+        insert_index = len(existing_lines) if insert_index is None else insert_index
+        change_lines = existing_lines[:insert_index] + version_sections + existing_lines[insert_index:]
+    else:
+        change_lines.extend(version_sections)
 
     with open(output, "w") as changes_file:
         changes_file.writelines(line + "\n" for line in change_lines)
     print("Output generated: [{}]".format(output))
+    return output
+
+
+def read_manifest(manifest):
+    """
+    Reads the repositories to process in batch mode.
+
+    The manifest is either a JSON list of objects with ``repo`` and any other :func:`generate_changes` parameter
+    (e.g.: ``output``, ``output_format``, ``source``, ``git_dir``), or a text file with one ``repo [output]`` line per
+    repository, where empty lines and ``#`` comments are ignored.
+    """
+    with open(manifest) as manifest_file:
+        if manifest.endswith(".json"):
+            return json.load(manifest_file)
+        entries = []
+        for line in manifest_file:
+            items = line.split("#", 1)[0].split()
+            if items:
+                entries.append({"repo": items[0], "output": items[1]} if len(items) > 1 else {"repo": items[0]})
+        return entries
+
+
+def generate_batch(entries, oauth_token=None, jobs=8, output_dir=os.path.curdir, **options):
+    """
+    Generates the CHANGES files of many repositories concurrently.
+
+    All repositories share a single session and rate-limit, such that at most ``jobs`` requests are made at once
+    overall. Failures of a repository are reported without interrupting the others.
+
+    :param entries: repositories and their specific :func:`generate_changes` parameters, as from :func:`read_manifest`.
+    :param output_dir: base directory of repositories without a specific output, generated in a sub-directory each.
+    :param options: default :func:`generate_changes` parameters of all repositories.
+    :returns: list of repository, output (``None`` if it failed), duration and error for each entry, in order.
+    """
+    session = make_session(oauth_token, jobs)
+    limiter = RateLimiter(jobs)
+
+    def generate(entry):
+        params = dict(options, **entry)
+        params.setdefault("output", os.path.join(output_dir, params["repo"].replace("/", "_")))
+        start = time.perf_counter()
+        try:
+            output = generate_changes(jobs=jobs, session=session, limiter=limiter, **params)
+            error = None
+        except Exception as exc:  # report any failure without interrupting other repositories
+            output = None
+            error = "{}: {}".format(type(exc).__name__, exc)
+        return params["repo"], output, time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(generate, entries))
+    for repo, output, duration, error in results:
+        if error:
+            print("[{}] failed in {:.2f}s: {}".format(repo, duration, error))
+        else:
+            print("[{}] generated in {:.2f}s: [{}]".format(repo, duration, output))
+    failed = len([result for result in results if result[3]])
+    print("Batch completed in {:.2f}s ({} generated, {} failed).".format(
+        time.perf_counter() - start, len(results) - failed, failed))
+    return results
 
 
 def main():
     ap = argparse.ArgumentParser(prog="changes", description=__doc__, add_help=True)
-    ap.add_argument("repo", help="Repository [organization/repository] to employ for fetching tags.")
+    ap.add_argument("repo", nargs="?", help="Repository [organization/repository] to employ for fetching tags.")
+    ap.add_argument("--batch", "-b", metavar="MANIFEST",
+                    help="Generate CHANGES files of all repositories listed in a manifest instead of a single one. "
+                         "The manifest is either a text file with one 'organization/repository [output]' line per "
+                         "repository, or a JSON list of objects with 'repo' and any other option as 'output', "
+                         "'output_format', 'source' or 'git_dir'. Other options are applied to all repositories. "
+                         "Repositories are processed concurrently, sharing connections, cache and rate-limit.")
     ap.add_argument("--output", "-o", default=os.path.curdir,
                     help="Output location of CHANGES file (default: 'CHANGES.<format>'). "
                          "Extension is based on the selected format if output is a directory. "
-                         "Generates in the current directory by default.")
+                         "Generates in the current directory by default. "
+                         "In batch mode, this is the base directory where a sub-directory named after each "
+                         "repository is generated, unless the manifest provides its output.")
     ap.add_argument("--format", "-f", default="rst", choices=["rst", "md"],
                     help="Desired output format of the CHANGES file (rst: reStructuredText, md: Markdown).")
     ap.add_argument("--token", "-t",
@@ -152,10 +449,37 @@ def main():
                          "increase rate-limit range to avoid access problems when calling the script too often.")
     ap.add_argument("--no-cache", action="store_false", dest="cache",
                     help="Disable caching of intermediate request results between executions. "
-                         "Caching avoids quickly reaching request rate-limit that blocks access to metadata.")
+                         "Caching avoids quickly reaching request rate-limit that blocks access to metadata. "
+                         "Tag listings are revalidated on each execution, while commits are cached permanently.")
+    ap.add_argument("--cache-dir",
+                    help="Location of cached request results (default: '/tmp/<organization>_<repository>').")
+    ap.add_argument("--source", "-s", default="github", choices=["github", "local"],
+                    help="Source of tags and commits (github: Github API, local: local clone of the repository). "
+                         "The local source does not require any network access nor is subject to rate-limit.")
+    ap.add_argument("--git-dir", "-g",
+                    help="Location of the git directory of the local clone to employ with the local source "
+                         "(default: '.git' in the current directory).")
+    ap.add_argument("--update", "-u", action="store_true",
+                    help="Update an existing CHANGES file by inserting only the sections of tags newer than the latest "
+                         "one already documented, below the 'Unreleased' section. Existing content is preserved, and "
+                         "only commits of newer tags are fetched. Generates the complete file if it does not exist.")
+    ap.add_argument("--jobs", "-j", type=int, default=8,
+                    help="Maximum number of concurrent requests over pooled connections to fetch tag commits "
+                         "(default: %(default)s).")
+    ap.add_argument("--api-url", default=API_URL,
+                    help="Base URL of the Github API to employ (default: %(default)s).")
     ap.add_argument("--version", "-v", action="version", version="%(prog)s {}".format(__version__))
     args = ap.parse_args()
-    generate_changes(args.repo, args.output, args.format, args.token, args.cache)
+    if args.batch:
+        results = generate_batch(read_manifest(args.batch), args.token, jobs=args.jobs, output_dir=args.output,
+                                 output_format=args.format,
+                                 cache=args.cache, api_url=args.api_url, cache_dir=args.cache_dir,
+                                 source=args.source, git_dir=args.git_dir, update=args.update)
+        sys.exit(1 if any(result[3] for result in results) else 0)
+    if not args.repo:
+        ap.error("Either a repository or a batch manifest is required.")
+    generate_changes(args.repo, args.output, args.format, args.token, args.cache, jobs=args.jobs, api_url=args.api_url,
+                     cache_dir=args.cache_dir, source=args.source, git_dir=args.git_dir, update=args.update)
 
 
 if __name__ == "__main__":
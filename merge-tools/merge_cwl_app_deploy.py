@@ -4,33 +4,258 @@
 Application that will merge a CWL Application Package into the corresponding
 process deployment payload. Using this, you don't need to manage two files by hand.
 """
-from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from urllib.parse import urlparse
 import argparse
+import hashlib
 import os
+import shutil
 import sys
 import json
+import tempfile
+import threading
+import time
 import yaml
 
+try:
+    # libyaml bindings are much faster, but not always available
+    from yaml import CSafeDumper as SafeDumper, CSafeLoader as SafeLoader
+except ImportError:  # pragma: no cover
+    from yaml import SafeDumper, SafeLoader
+
+
+class NoAliasDumper(SafeDumper):
+    """
+    Dumper that writes documents shared between references in full at each location instead of YAML aliases.
+    """
+    def ignore_aliases(self, data):
+        return True
+
+
+class DocumentCache(object):
+    """
+    Parsed CWL documents shared between all merged application packages.
+
+    Each document is parsed and has its references resolved only once, even when it is requested concurrently.
+    Resolved documents are shared between all documents that refer to them, and must therefore not be modified.
+
+    Documents being loaded are recorded with the thread loading them, and the document each thread waits for, such
+    that waiting for a document whose loading itself waits on the current thread, as with cyclic references resolved
+    from different threads, raises an error instead of blocking all of them forever.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.documents = {}
+        self.loading = {}
+        self.waiting = {}
+        self.parsed = 0
+
+    def get(self, path, loader, kind="document"):
+        """
+        Obtains the document at the given location, calling ``loader(path)`` once to produce it when not yet cached.
+
+        :param kind: type of contents produced by the loader, to distinguish different uses of the same file.
+        :raises ValueError: if the document is being loaded by a thread waiting, directly or not, for the current one.
+        """
+        path = os.path.realpath(path)
+        key = (kind, path)
+        thread = threading.get_ident()
+        with self.lock:
+            future = self.documents.get(key)
+            owner = future is None
+            if owner:
+                future = self.documents[key] = Future()
+                self.loading[key] = thread
+            elif not future.done():
+                waited = key
+                while waited in self.loading:
+                    if self.loading[waited] == thread:
+                        raise ValueError("Cyclic reference to [{}].".format(path))
+                    waited = self.waiting.get(self.loading[waited])
+                self.waiting[thread] = key
+        if owner:
+            try:
+                future.set_result(loader(path))
+                with self.lock:
+                    self.parsed += 1
+            except Exception as exc:
+                future.set_exception(exc)
+            finally:
+                with self.lock:
+                    self.loading.pop(key, None)
+            return future.result()
+        try:
+            return future.result()
+        finally:
+            with self.lock:
+                self.waiting.pop(thread, None)
+
+
+def parse_document(body):
+    """
+    Parses JSON or YAML contents according to their first non-whitespace character, preserving the order of keys.
+
+    :returns: tuple of parsed document and whether it was JSON.
+    """
+    if body.lstrip()[:1] in ("{", "["):
+        try:
+            return json.loads(body), True
+        except ValueError:  # JSON-like YAML (e.g.: flow mapping)
+            pass
+    return yaml.load(body, Loader=SafeLoader), False
+
+
+def load_document(path):
+    with open(path, 'r', encoding="utf-8") as f:
+        return parse_document(f.read())[0]
+
+
+def load_text(path):
+    with open(path, 'r') as f:
+        return f.read()
+
+
+def canonical_hash(data):
+    """
+    Obtains a digest of the parsed document that does not depend on its format, key order nor indentation.
+    """
+    body = json.dumps(data, sort_keys=True, separators=(",", ":"), ensure_ascii=False, default=str)
+    return hashlib.sha256(body.encode("utf-8")).hexdigest()
+
+
+def write_atomic(path, body):
+    """
+    Writes the contents to a temporary file that then replaces the file at the given location, such that it is never
+    left partially written. Permissions of the replaced file are preserved, and symbolic links are written through.
+    """
+    path = os.path.realpath(path)
+    fd, tmp_path = tempfile.mkstemp(prefix=".{}.".format(os.path.basename(path)), suffix=".tmp",
+                                    dir=os.path.dirname(os.path.abspath(path)))
+    try:
+        with os.fdopen(fd, 'w', encoding="utf-8") as f:
+            f.write(body)
+        shutil.copymode(path, tmp_path)
+        os.replace(tmp_path, path)
+    finally:
+        if os.path.isfile(tmp_path):
+            os.remove(tmp_path)
+
+
+def reference_path(reference, base_dir):
+    """
+    Obtains the local file path and fragment of a CWL reference, or ``None`` if it is not a local file reference.
+    """
+    if not isinstance(reference, str) or reference.startswith("#"):
+        return None
+    url = urlparse(reference)
+    if url.scheme not in ("", "file"):
+        return None
+    path = url.path if url.scheme else reference.split("#", 1)[0]
+    return os.path.join(base_dir, path), url.fragment
+
+
+def select_fragment(document, fragment, reference):
+    if not fragment:
+        return document
+    graph = document.get("$graph", []) if isinstance(document, dict) else []
+    for item in graph:
+        if isinstance(item, dict) and item.get("id") in (fragment, "#" + fragment):
+            return item
+    raise ValueError("Reference [{}] not found in its document.".format(reference))
+
+
+def resolve_references(document, base_dir, cache, parents=()):
+    """
+    Replaces ``$import`` and ``$include`` directives and ``run`` references to local files by their contents.
+
+    Referenced documents are resolved relative to their own location, and are obtained from the cache such that those
+    common to many application packages are parsed only once. References to remote locations are left as is.
+
+    :param document: parsed CWL document or part of it, updated in place.
+    :param base_dir: directory of the file the document comes from, against which relative references are resolved.
+    :param cache: :class:`DocumentCache` shared between documents.
+    :param parents: referenced files being resolved, to detect cyclic references.
+    :returns: resolved document.
+    """
+    if isinstance(document, list):
+        for i, item in enumerate(document):
+            document[i] = resolve_references(item, base_dir, cache, parents)
+        return document
+    if not isinstance(document, dict):
+        return document
+    if len(document) == 1 and ("$import" in document or "$include" in document):
+        directive, reference = next(iter(document.items()))
+        location = reference_path(reference, base_dir)
+        if location is None:
+            return document
+        if directive == "$include":
+            return cache.get(location[0], load_text, kind="text")
+        return select_fragment(load_reference(location[0], cache, parents), location[1], reference)
+    for key, value in document.items():
+        location = reference_path(value, base_dir) if key == "run" else None
+        if location is not None:
+            document[key] = select_fragment(load_reference(location[0], cache, parents), location[1], value)
+        else:
+            document[key] = resolve_references(value, base_dir, cache, parents)
+    return document
+
+
+def load_reference(path, cache, parents=()):
+    """
+    Obtains the CWL document at the given location with all its references resolved.
+    """
+    path = os.path.realpath(path)
+    if path in parents:
+        raise ValueError("Cyclic reference to [{}].".format(path))
+
+    def loader(location):
+        document = load_document(location)
+        return resolve_references(document, os.path.dirname(location), cache, parents + (location, ))
+
+    return cache.get(path, loader)
+
 
 def make_parser():
     name = os.path.splitext(os.path.split(__file__)[-1])[0]
     ap = argparse.ArgumentParser(prog=name, description=__doc__, add_help=True)
-    ap.add_argument("app_package", help="Location of the CWL Application Package file.")
-    ap.add_argument("process_deploy", help="Location of the process deployment file.")
+    ap.add_argument("app_package", nargs="?", help="Location of the CWL Application Package file.")
+    ap.add_argument("process_deploy", nargs="?", help="Location of the process deployment file.")
+    ap.add_argument("--resolve", "-r", action="store_true",
+                    help="Replace '$import' and '$include' directives and 'run' references to local files of the "
+                         "Application Package by the referenced contents. Always applied in batch mode.")
+    ap.add_argument("--batch", "-b", metavar="MANIFEST",
+                    help="Merge many pairs of Application Package and process deployment files listed in a manifest "
+                         "instead of a single pair. The manifest is either a JSON list of objects with "
+                         "'app_package' and 'process_deploy' locations, or a text file with one "
+                         "'app_package process_deploy' line per pair. Relative locations are resolved against the "
+                         "manifest directory. Referenced documents are parsed only once for all pairs.")
+    ap.add_argument("--jobs", "-j", type=int, default=os.cpu_count() or 1,
+                    help="Amount of pairs merged concurrently in batch mode (default: %(default)s).")
     return ap
 
 
-def run(app_package, process_deploy):
-    with open(app_package, 'r') as f:
-        app = yaml.safe_load(f)
-    proc_json = True
-    with open(process_deploy, 'r') as f:
-        try:
-            proc = json.load(f, object_pairs_hook=OrderedDict)  # noqa
-        except json.decoder.JSONDecodeError:
-            proc_json = False
-            f.seek(0)
-            proc = yaml.safe_load(f)
+def run(app_package, process_deploy, resolve=False, cache=None):
+    """
+    Merges the CWL Application Package into the execution unit of the process deployment file.
+
+    :param app_package: location of the CWL Application Package file.
+    :param process_deploy: location of the process deployment file, updated in place.
+    :param resolve: replace references to other local CWL documents by their contents.
+    :param cache: :class:`DocumentCache` of referenced documents shared with other merges (implies ``resolve``).
+    :returns: whether the process deployment file was updated, or left untouched since it already embeds the same
+        Application Package.
+    """
+    if resolve or cache is not None:
+        app = load_reference(app_package, cache if cache is not None else DocumentCache())
+    else:
+        app = load_document(app_package)
+    with open(process_deploy, 'r', encoding="utf-8") as f:
+        proc, proc_json = parse_document(f.read())
+
+    units = proc.get("executionUnit")
+    if isinstance(units, list) and units and isinstance(units[0], dict) and "unit" in units[0]:
+        if canonical_hash(units[0]["unit"]) == canonical_hash(app):
+            return False
 
     proc.setdefault("executionUnit", [{}])
     if not isinstance(proc["executionUnit"], list):
@@ -40,20 +265,91 @@ def run(app_package, process_deploy):
     proc["executionUnit"][0].setdefault("unit", {})
     proc["executionUnit"][0]["unit"] = app
 
-    with open(process_deploy, 'w', encoding="utf-8") as f:
-        if proc_json:
-            body = json.dumps(proc, indent=4, ensure_ascii=False)
-            body = body.strip() + "\n"
-            f.write(body)
+    if proc_json:
+        body = json.dumps(proc, indent=4, ensure_ascii=False)
+        body = body.strip() + "\n"
+    else:
+        body = yaml.dump(proc, Dumper=NoAliasDumper, sort_keys=False)
+    write_atomic(process_deploy, body)
+    return True
+
+
+def read_manifest(manifest):
+    """
+    Reads the pairs of Application Package and process deployment files to merge in batch mode.
+
+    The manifest is either a JSON list of objects with ``app_package`` and ``process_deploy`` locations, or a text file
+    with one ``app_package process_deploy`` line per pair, where empty lines and ``#`` comments are ignored. Relative
+    locations are resolved against the manifest directory.
+    """
+    with open(manifest) as manifest_file:
+        if manifest.endswith(".json"):
+            entries = json.load(manifest_file)
+        else:
+            entries = []
+            for line in manifest_file:
+                items = line.split("#", 1)[0].split()
+                if not items:
+                    continue
+                if len(items) != 2:
+                    raise ValueError("Invalid manifest line: [{}]".format(line.strip()))
+                entries.append({"app_package": items[0], "process_deploy": items[1]})
+    base_dir = os.path.dirname(os.path.abspath(manifest))
+    return [{key: os.path.join(base_dir, entry[key]) for key in ("app_package", "process_deploy")}
+            for entry in entries]
+
+
+def run_batch(entries, jobs=1, cache=None):
+    """
+    Merges many pairs of Application Package and process deployment files concurrently.
+
+    References of all Application Packages are resolved through a single :class:`DocumentCache`, such that common tool
+    definitions are parsed only once. Failures of a pair are reported without interrupting the others.
+
+    :param entries: pairs of ``app_package`` and ``process_deploy`` locations, as from :func:`read_manifest`.
+    :param jobs: amount of pairs merged concurrently.
+    :param cache: cache of referenced documents to employ, or a new one.
+    :returns: list of process deployment file, whether it was updated, duration and error (``None`` if it succeeded)
+        for each entry, in order.
+    """
+    cache = cache if cache is not None else DocumentCache()
+
+    def merge(entry):
+        start = time.perf_counter()
+        try:
+            updated = run(entry["app_package"], entry["process_deploy"], cache=cache)
+            error = None
+        except Exception as exc:  # report any failure without interrupting other pairs
+            updated = False
+            error = "{}: {}".format(type(exc).__name__, exc)
+        return entry["process_deploy"], updated, time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        results = list(executor.map(merge, entries))
+    for process_deploy, updated, duration, error in results:
+        if error:
+            print("[{}] failed in {:.2f}s: {}".format(process_deploy, duration, error))
         else:
-            yaml.safe_dump(proc, f)
+            print("[{}] {} in {:.2f}s".format(process_deploy, "merged" if updated else "unchanged", duration))
+    failed = len([result for result in results if result[3]])
+    updated = len([result for result in results if result[1]])
+    print("Batch completed in {:.2f}s ({} merged, {} unchanged, {} failed, {} documents parsed).".format(
+        time.perf_counter() - start, updated, len(results) - updated - failed, failed, cache.parsed))
+    return results
 
 
 def main():
     ap = make_parser()
     args = ap.parse_args(args=None if sys.argv[1:] else ['--help'])
-    return run(**vars(args))
+    if args.batch:
+        results = run_batch(read_manifest(args.batch), jobs=args.jobs)
+        return 1 if any(result[3] for result in results) else 0
+    if not args.app_package or not args.process_deploy:
+        ap.error("Either an Application Package and process deployment file pair or a batch manifest is required.")
+    run(args.app_package, args.process_deploy, resolve=args.resolve)
+    return 0
 
 
 if __name__ == "__main__":
-    main()
+    sys.exit(main())
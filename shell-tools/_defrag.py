@@ -0,0 +1,321 @@
+#!/usr/bin/env python
+"""
+Fills the free space of filesystems with zeros and removes the written files afterwards, such that the unused blocks
+of virtual disks can be compacted.
+
+Zeros are written to files of bounded size in the selected directories, without polluting the page cache, at a
+limited rate, and only until a reserve of free space remains such that the disk never gets completely full.
+"""
+
+__version__ = "0.1.0"
+
+import argparse
+import errno
+import logging
+import mmap
+import os
+import re
+import signal
+import sys
+import time
+
+LOGGER = logging.getLogger("defrag")
+LOGGER.addHandler(logging.StreamHandler(sys.stdout))
+LOGGER.setLevel(logging.INFO)
+
+ALIGNMENT = 4096  # offsets and sizes of direct writes must be multiples of the logical block size
+ZERO_FILE_PREFIX = ".defrag-zero-"
+ZERO_FILE_PATTERN = re.compile(r"^{}(\d+)$".format(re.escape(ZERO_FILE_PREFIX)))
+PROGRESS_INTERVAL = 5
+
+
+def parse_size(size):
+    """
+    Parses a size with optional unit (e.g.: ``500MB``, ``20G``, ``1.5TiB``) into bytes.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([kmgt]?)(i?)b?\s*$", str(size), re.IGNORECASE)
+    if not match:
+        raise ValueError("Invalid size: [{}]".format(size))
+    number, unit, binary = match.groups()
+    base = 1024 if binary else 1000
+    return int(float(number) * base ** " kmgt".index(unit.lower() or " "))
+
+
+def parse_reserve(reserve):
+    """
+    Parses a reserve of free space either as a size (e.g.: ``2GiB``) or as a percentage of the filesystem (``5%``).
+
+    :returns: tuple of value and whether it is a percentage.
+    """
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*%\s*$", str(reserve))
+    if match:
+        return float(match.group(1)), True
+    return parse_size(reserve), False
+
+
+def format_size(size):
+    for unit in ["B", "KiB", "MiB", "GiB"]:
+        if abs(size) < 1024:
+            return "{:.1f}{}".format(size, unit)
+        size /= 1024
+    return "{:.1f}TiB".format(size)
+
+
+def free_space(path):
+    """
+    Obtains the available and total space in bytes of the filesystem where the path is located.
+    """
+    stat = os.statvfs(path)
+    return stat.f_bavail * stat.f_frsize, stat.f_blocks * stat.f_frsize
+
+
+def find_zero_files(directory):
+    """
+    Finds the zero files left in the directory by a previous execution, ordered by their index.
+    """
+    found = []
+    for name in os.listdir(directory):
+        match = ZERO_FILE_PATTERN.match(name)
+        if match:
+            found.append((int(match.group(1)), os.path.join(directory, name)))
+    return [path for _, path in sorted(found)]
+
+
+def remove_zero_files(directory):
+    for path in find_zero_files(directory):
+        os.remove(path)
+
+
+class Throttle(object):
+    """
+    Limits the amount of bytes written per second by sleeping between writes.
+    """
+    def __init__(self, rate=None):
+        self.rate = rate
+        self.start = time.monotonic()
+        self.amount = 0
+
+    def wait(self, amount):
+        self.amount += amount
+        if not self.rate:
+            return
+        delay = self.start + self.amount / self.rate - time.monotonic()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def open_zero_file(path, mode):
+    """
+    Opens a zero file for writing with the selected page cache mode.
+
+    With ``direct``, writes bypass the page cache using ``O_DIRECT``. With ``fadvise``, written pages are flushed and
+    dropped from the page cache with ``posix_fadvise(DONTNEED)`` after each block. With ``auto``, ``direct`` is used
+    when the filesystem supports it, and ``fadvise`` otherwise.
+
+    :returns: tuple of file descriptor and whether writes are direct.
+    """
+    flags = os.O_WRONLY | os.O_CREAT
+    if mode in ("auto", "direct") and hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(path, flags | os.O_DIRECT, 0o600), True
+        except OSError as exc:
+            if mode == "direct" or exc.errno != errno.EINVAL:
+                raise
+            LOGGER.debug("Direct writes not supported for [%s], using fadvise instead.", path)
+    elif mode == "direct":
+        raise OSError(errno.EINVAL, "Direct writes are not supported on this platform.")
+    return os.open(path, flags, 0o600), False
+
+
+def write_zeros(fd, offset, size, buffer, direct):
+    """
+    Writes zeros to the file at the given offset, preallocating the range first such that a full filesystem is detected
+    before any partial write.
+
+    :returns: amount of bytes written.
+    """
+    try:
+        os.posix_fallocate(fd, offset, size)
+    except OSError as exc:
+        if exc.errno not in (errno.EOPNOTSUPP, errno.EINVAL):
+            raise
+    written = 0
+    while written < size:
+        written += os.pwrite(fd, buffer[:size - written], offset + written)
+    if not direct:
+        os.fdatasync(fd)
+        os.posix_fadvise(fd, offset, size, os.POSIX_FADV_DONTNEED)
+    return written
+
+
+def zero_free_space(directory, block_size=4 * 2 ** 20, mode="auto", rate=None, reserve="2%",
+                    max_file_size=2 ** 30, limit=None, resume=False):
+    """
+    Fills the free space of the filesystem of the directory with zero files, and removes them once it is filled.
+
+    Zeros are written by blocks to successive files of at most ``max_file_size`` bytes each, until only the reserve of
+    free space remains, the filesystem is full, or the limit is reached.
+
+    :param directory: directory where zero files are written, which determines the filesystem to fill.
+    :param block_size: amount of bytes written at once, rounded up to a multiple of 4096 bytes.
+    :param mode: page cache mode (``auto``, ``direct`` or ``fadvise``), see :func:`open_zero_file`.
+    :param rate: maximum amount of bytes written per second, or unlimited if ``None``.
+    :param reserve: free space to preserve, as a size or a percentage of the filesystem (see :func:`parse_reserve`).
+    :param max_file_size: maximum size of each zero file.
+    :param limit: maximum amount of bytes of zero files, including resumed ones, or unlimited if ``None``.
+    :param resume: continue from zero files left by an interrupted execution, and leave written zero files in place
+        when interrupted for a later execution to resume from them. Otherwise, left zero files are removed beforehand
+        and after interruption.
+    :returns: amount of bytes of zero files written, including resumed ones.
+    """
+    block_size = -(-block_size // ALIGNMENT) * ALIGNMENT
+    max_file_size = max(max_file_size // ALIGNMENT * ALIGNMENT, block_size)
+    reserve_value, reserve_percent = parse_reserve(reserve)
+    _, total_space = free_space(directory)
+    reserve_size = int(total_space * reserve_value / 100) if reserve_percent else reserve_value
+
+    if not resume:
+        remove_zero_files(directory)
+    paths = find_zero_files(directory)
+    for path in paths[:-1]:
+        LOGGER.debug("Resuming after zero file [%s] of %s.", path, format_size(os.path.getsize(path)))
+    written = sum(os.path.getsize(path) for path in paths[:-1])
+    index = len(paths[:-1])
+    offset = os.path.getsize(paths[-1]) // ALIGNMENT * ALIGNMENT if paths else 0
+    written += offset
+
+    buffer = mmap.mmap(-1, block_size)  # anonymous mappings are zero-filled and page aligned, as direct writes require
+    zeros = memoryview(buffer)
+    throttle = Throttle(rate)
+    start = last_report = time.monotonic()
+    completed = False
+    LOGGER.info("Filling free space of [%s] with zeros (reserve: %s, limit: %s).", directory,
+                format_size(reserve_size), format_size(limit) if limit else "none")
+    try:
+        while not completed:
+            path = os.path.join(directory, "{}{}".format(ZERO_FILE_PREFIX, index))
+            fd, direct = open_zero_file(path, mode)
+            try:
+                os.ftruncate(fd, offset)  # drop any unaligned tail left by an interrupted write
+                while offset < max_file_size:
+                    available, _ = free_space(directory)
+                    size = min(block_size, max_file_size - offset, available - reserve_size)
+                    if limit is not None:
+                        size = min(size, limit - written)
+                    size = size // ALIGNMENT * ALIGNMENT
+                    if size <= 0:
+                        completed = True
+                        break
+                    try:
+                        size = write_zeros(fd, offset, size, zeros, direct)
+                    except OSError as exc:
+                        if exc.errno == errno.EINVAL and direct and mode == "auto":
+                            LOGGER.debug("Direct writes not supported for [%s], using fadvise instead.", path)
+                            os.close(fd)
+                            mode = "fadvise"
+                            fd, direct = open_zero_file(path, mode)
+                            continue
+                        if exc.errno != errno.ENOSPC:
+                            raise
+                        LOGGER.warning("Filesystem of [%s] is full before reaching the reserve.", directory)
+                        completed = True
+                        break
+                    offset += size
+                    written += size
+                    throttle.wait(size)
+                    now = time.monotonic()
+                    if now - last_report >= PROGRESS_INTERVAL:
+                        last_report = now
+                        LOGGER.info("Written %s (%s/s).", format_size(written),
+                                    format_size(throttle.amount / max(now - start, 1e-6)))
+            finally:
+                os.close(fd)
+            index += 1
+            offset = 0
+    except BaseException:
+        if resume:
+            LOGGER.warning("Interrupted after %s of zeros, left in place to resume.", format_size(written))
+        else:
+            remove_zero_files(directory)
+        raise
+    finally:
+        zeros.release()
+        buffer.close()
+    remove_zero_files(directory)
+    duration = time.monotonic() - start
+    LOGGER.info("Filled %s of free space of [%s] with zeros in %.2fs (%s/s).", format_size(written), directory,
+                duration, format_size(throttle.amount / max(duration, 1e-6)))
+    return written
+
+
+def defrag(paths, **options):
+    """
+    Fills the free space of the filesystems of all paths with zeros, processing each filesystem only once.
+
+    :param paths: directories where zero files are written, one per filesystem.
+    :param options: parameters of :func:`zero_free_space`.
+    :returns: amount of bytes of zero files written for each processed directory.
+    """
+    results = {}
+    devices = set()
+    for path in paths:
+        device = os.stat(path).st_dev
+        if device in devices:
+            LOGGER.info("Skipping [%s] located on an already processed filesystem.", path)
+            continue
+        devices.add(device)
+        results[path] = zero_free_space(path, **options)
+    return results
+
+
+def _interrupt(*_):
+    raise KeyboardInterrupt
+
+
+def parse():
+    args = sys.argv[1:]
+    name = os.path.splitext(os.path.split(__file__)[-1])[0]
+    if len(args) > 1 and args[0] == "--name":
+        name = os.path.split(args[1])[-1]
+        args = args[2:]
+    ap = argparse.ArgumentParser(name, description=__doc__, add_help=True)
+    ap.add_argument("--version", "-v", action="version", version="%(prog)s {}".format(__version__))
+    ap.add_argument("paths", nargs="*", default=["/"],
+                    help="Directories where zero files are written, one for each filesystem to fill "
+                         "(default: %(default)s).")
+    ap.add_argument("--block-size", "-b", type=parse_size, default="4MiB",
+                    help="Amount of bytes written at once, rounded up to a multiple of 4096 (default: %(default)s).")
+    ap.add_argument("--mode", "-m", choices=["auto", "direct", "fadvise"], default="auto",
+                    help="Method employed to avoid filling the page cache with written zeros. "
+                         "With 'direct', writes bypass the page cache using 'O_DIRECT'. "
+                         "With 'fadvise', written blocks are flushed and dropped from the page cache. "
+                         "With 'auto' (default), 'direct' is used if the filesystem supports it, and 'fadvise' "
+                         "otherwise.")
+    ap.add_argument("--rate", "-r", type=parse_size,
+                    help="Maximum amount of bytes written per second (e.g.: '100MiB'), unlimited by default.")
+    ap.add_argument("--reserve", default="2%",
+                    help="Free space to preserve on each filesystem as a size (e.g.: '2GiB') or a percentage of the "
+                         "filesystem (e.g.: '5%%') such that it never gets completely full (default: %(default)s).")
+    ap.add_argument("--max-file-size", "-s", type=parse_size, default="1GiB",
+                    help="Maximum size of each zero file. Free space is filled with as many files as needed "
+                         "(default: %(default)s).")
+    ap.add_argument("--limit", "-l", type=parse_size,
+                    help="Maximum amount of zeros written to each filesystem, unlimited by default.")
+    ap.add_argument("--resume", action="store_true",
+                    help="Continue from zero files left by an interrupted execution, and leave them in place when "
+                         "interrupted such that a later execution can resume from them. Otherwise, they are removed.")
+    ap.add_argument("--quiet", "-q", action="store_true", help="Do not report progress.")
+    return ap.parse_args(args=args)
+
+
+if __name__ == "__main__":
+    cmd_args = parse()
+    if cmd_args.quiet:
+        LOGGER.setLevel(logging.WARNING)
+    signal.signal(signal.SIGTERM, _interrupt)  # remove or keep zero files as for an interruption
+    try:
+        defrag(cmd_args.paths, block_size=cmd_args.block_size, mode=cmd_args.mode, rate=cmd_args.rate,
+               reserve=cmd_args.reserve, max_file_size=cmd_args.max_file_size, limit=cmd_args.limit,
+               resume=cmd_args.resume)
+    except KeyboardInterrupt:
+        sys.exit(130)
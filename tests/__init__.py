@@ -5,8 +5,12 @@ ROOT_DIR = os.path.realpath(os.path.join(CUR_DIR, ".."))
 
 CONVERT_TOOLS_DIR = os.path.join(ROOT_DIR, "convert-tools")
 DOCKER_TOOLS_DIR = os.path.join(ROOT_DIR, "docker-tools")
+GIT_TOOLS_DIR = os.path.join(ROOT_DIR, "git-tools")
 MERGE_TOOLS_DIR = os.path.join(ROOT_DIR, "merge-tools")
+SHELL_TOOLS_DIR = os.path.join(ROOT_DIR, "shell-tools")
 
 sys.path.insert(0, CONVERT_TOOLS_DIR)
 sys.path.insert(0, DOCKER_TOOLS_DIR)
+sys.path.insert(0, GIT_TOOLS_DIR)
 sys.path.insert(0, MERGE_TOOLS_DIR)
+sys.path.insert(0, SHELL_TOOLS_DIR)
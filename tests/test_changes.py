@@ -0,0 +1,266 @@
+import hashlib
+import http.server
+import json
+import os
+import subprocess
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import parse_qs, urlparse
+
+import mock
+
+from changes import RateLimiter, generate_batch, generate_changes, read_local_tags, read_manifest
+
+REPO = "org/repo"
+TAGS = ["0.1.0", "0.2.0", "0.10.0", "1.0.0", "1.0.1", "1.1.0", "2.0.0"]
+
+
+def make_commit(tag):
+    return {"commit": {"message": "Release {}\n\nDetails of {}.".format(tag, tag),
+                       "committer": {"date": "2021-01-{:02d}T10:00:00Z".format(len(tag))}}}
+
+
+class FakeGithubHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # allow keep-alive connections
+
+    def setup(self):
+        super(FakeGithubHandler, self).setup()
+        with self.server.lock:
+            self.server.connections += 1
+
+    def log_message(self, *_, **__):
+        pass
+
+    def send_json(self, data, status=200, headers=None):
+        body = json.dumps(data).encode("utf-8")
+        etag = '"{}"'.format(hashlib.md5(body).hexdigest())
+        if status == 200 and self.headers.get("If-None-Match") == etag:
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return
+        self.send_response(status)
+        self.send_header("ETag", etag)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header, value in (headers or {}).items():
+            self.send_header(header, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # noqa: N802
+        url = urlparse(self.path)
+        with self.server.lock:
+            self.server.requests.append(self.path)
+            refuse = self.server.refuse > 0
+            if refuse:
+                self.server.refuse -= 1
+        if refuse:
+            self.send_json({"message": "API rate limit exceeded"}, status=403,
+                           headers={"Retry-After": "0.2", "X-RateLimit-Remaining": "0"})
+            return
+        if url.path in ["/repos/{}/tags".format(repo) for repo in self.server.repos]:
+            page = int(parse_qs(url.query)["page"][0])
+            per_page = int(parse_qs(url.query)["per_page"][0])
+            items = [
+                {"name": tag, "commit": {"url": "http://localhost:{}/commits/{}".format(self.server.server_port, tag)}}
+                for tag in self.server.tags[(page - 1) * per_page:page * per_page]
+            ]
+            self.send_json(items)
+        elif url.path.startswith("/commits/"):
+            time.sleep(self.server.delay)
+            self.send_json(make_commit(url.path.split("/")[-1]))
+        else:
+            self.send_json({"message": "Not Found"}, status=404)
+
+
+@contextmanager
+def fake_github_api(delay=0.0, refuse=0):
+    """
+    Runs a local stand-in for the Github API that serves tags and commits of :data:`REPO`.
+    """
+    server = http.server.ThreadingHTTPServer(("localhost", 0), FakeGithubHandler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    server.requests = []
+    server.connections = 0
+    server.delay = delay
+    server.refuse = refuse
+    server.tags = list(TAGS)
+    server.repos = [REPO]
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, "http://localhost:{}".format(server.server_port)
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_generate_changes_concurrent(tmp_path):
+    with fake_github_api(delay=0.1) as (server, api_url):
+        start = time.monotonic()
+        generate_changes(REPO, str(tmp_path), "md", cache=False, jobs=len(TAGS), api_url=api_url)
+        elapsed = time.monotonic() - start
+    assert elapsed < 0.1 * len(TAGS), "expected commits to be fetched concurrently"
+    assert server.connections <= len(TAGS), "expected connections to be reused from the pool"
+    changes = (tmp_path / "CHANGES.md").read_text()
+    versions = [line.split("]")[0][4:] for line in changes.splitlines() if line.startswith("## [")]
+    assert versions == ["Unreleased", "2.0.0", "1.1.0", "1.0.1", "1.0.0", "0.10.0", "0.2.0", "0.1.0"]
+    assert "- Release 1.0.1" in changes
+
+
+def test_generate_changes_rate_limit_backoff(tmp_path):
+    with fake_github_api(refuse=2) as (server, api_url):
+        start = time.monotonic()
+        generate_changes(REPO, str(tmp_path), "rst", cache=False, jobs=2, api_url=api_url)
+        elapsed = time.monotonic() - start
+    assert elapsed >= 0.2, "expected requests to wait for the indicated delay"
+    assert len(server.requests) == 2 + 2 + len(TAGS), "expected refused requests to be repeated"
+    assert (tmp_path / "CHANGES.rst").read_text().count("Release ") == len(TAGS)
+
+
+def test_rate_limiter_spreads_remaining_requests():
+    limiter = RateLimiter(jobs=4)
+    response = mock.Mock(status_code=200, headers={"X-RateLimit-Remaining": "2",
+                                                   "X-RateLimit-Reset": str(time.time() + 10)})
+    assert not limiter.update(response)
+    assert 4 < limiter.resume - time.time() <= 5
+
+
+def test_generate_changes_cache_revalidation(tmp_path):
+    cache_dir = str(tmp_path / "cache")
+    with fake_github_api() as (server, api_url):
+        generate_changes(REPO, str(tmp_path), "md", jobs=2, api_url=api_url, cache_dir=cache_dir)
+        assert len(server.requests) == 2 + len(TAGS)
+
+        server.requests.clear()
+        generate_changes(REPO, str(tmp_path), "md", jobs=2, api_url=api_url, cache_dir=cache_dir)
+        assert len(server.requests) == 2, "expected only revalidation of tag listing pages"
+
+        server.requests.clear()
+        server.tags.append("2.1.0")
+        generate_changes(REPO, str(tmp_path), "md", jobs=2, api_url=api_url, cache_dir=cache_dir)
+        assert [path for path in server.requests if path.startswith("/commits/")] == ["/commits/2.1.0"]
+        assert len(server.requests) == 2 + 1
+    assert "## [2.1.0]" in (tmp_path / "CHANGES.md").read_text()
+
+
+def make_local_repo(path):
+    """
+    Creates a local repository with lightweight and annotated tags, some of which are packed.
+    """
+    env = dict(os.environ, GIT_AUTHOR_NAME="test", GIT_AUTHOR_EMAIL="test@example.com",
+               GIT_COMMITTER_NAME="test", GIT_COMMITTER_EMAIL="test@example.com")
+
+    def git(*args, **kwargs):
+        subprocess.run(["git", "-C", str(path)] + list(args), check=True, stdout=subprocess.DEVNULL,
+                       env=dict(env, **kwargs))
+
+    path.mkdir()
+    git("init", "-q")
+    for i, (tag, annotated) in enumerate([("0.1.0", False), ("0.2.0", True), ("0.10.0", False), ("1.0.0", True)]):
+        date = "2021-01-{:02d}T23:30:00-0200".format(i + 1)  # next day in UTC
+        git("commit", "-q", "--allow-empty", "-m", "Release {}\n\nDetails of {}.".format(tag, tag),
+            GIT_AUTHOR_DATE=date, GIT_COMMITTER_DATE=date)
+        if annotated:
+            git("tag", "-a", tag, "-m", "Tag message {}".format(tag))
+        else:
+            git("tag", tag)
+        if i == 1:
+            git("pack-refs", "--all")
+    return str(path / ".git")
+
+
+def test_read_local_tags(tmp_path):
+    git_dir = make_local_repo(tmp_path / "repo")
+    tag_messages = read_local_tags(git_dir)
+    assert tag_messages == [
+        {"tag": "1.0.0", "message": "Release 1.0.0\n\nDetails of 1.0.0.", "date": "2021-01-05"},
+        {"tag": "0.10.0", "message": "Release 0.10.0\n\nDetails of 0.10.0.", "date": "2021-01-04"},
+        {"tag": "0.2.0", "message": "Release 0.2.0\n\nDetails of 0.2.0.", "date": "2021-01-03"},
+        {"tag": "0.1.0", "message": "Release 0.1.0\n\nDetails of 0.1.0.", "date": "2021-01-02"},
+    ]
+
+    generate_changes(REPO, str(tmp_path), "rst", source="local", git_dir=git_dir)
+    changes = (tmp_path / "CHANGES.rst").read_text()
+    assert "`1.0.0 <https://github.com/org/repo/tree/1.0.0>`_ (2021-01-05)" in changes
+    assert "- Release 0.10.0" in changes
+
+
+def test_generate_changes_update(tmp_path):
+    with fake_github_api() as (server, api_url):
+        server.tags = TAGS[:-2]
+        generate_changes(REPO, str(tmp_path), "md", cache=False, api_url=api_url)
+        output = tmp_path / "CHANGES.md"
+        lines = output.read_text().splitlines()
+        unreleased = lines.index("## [Unreleased](https://github.com/org/repo/tree/master) (latest)")
+        lines.insert(unreleased + 2, "- Pending change that must be preserved.")
+        lines.append("Manual notes that must be preserved.")
+        output.write_text("\n".join(lines) + "\n")
+
+        server.requests.clear()
+        server.tags = list(TAGS)
+        generate_changes(REPO, str(tmp_path), "md", cache=False, api_url=api_url, update=True)
+        commits = sorted(path for path in server.requests if path.startswith("/commits/"))
+        assert commits == ["/commits/1.1.0", "/commits/2.0.0"], "expected only commits of newer tags to be fetched"
+        updated = output.read_text()
+        versions = [line.split("]")[0][4:] for line in updated.splitlines() if line.startswith("## [")]
+        assert versions == ["Unreleased", "2.0.0", "1.1.0", "1.0.1", "1.0.0", "0.10.0", "0.2.0", "0.1.0"]
+        assert updated.index("- Pending change") < updated.index("## [2.0.0]")
+        assert updated.endswith("Manual notes that must be preserved.\n")
+
+        server.requests.clear()
+        generate_changes(REPO, str(tmp_path), "md", cache=False, api_url=api_url, update=True)
+        assert not [path for path in server.requests if path.startswith("/commits/")]
+        assert output.read_text() == updated
+
+
+def test_generate_changes_update_local(tmp_path):
+    git_dir = make_local_repo(tmp_path / "repo")
+    output = tmp_path / "CHANGES.rst"
+    generate_changes(REPO, str(output), "rst", source="local", git_dir=git_dir)
+    full = output.read_text()
+    lines = full.splitlines()
+    start = lines.index("`1.0.0 <https://github.com/org/repo/tree/1.0.0>`_ (2021-01-05)")
+    end = lines.index("`0.10.0 <https://github.com/org/repo/tree/0.10.0>`_ (2021-01-04)")
+    output.write_text("\n".join(lines[:start] + lines[end:]) + "\n")
+    generate_changes(REPO, str(output), "rst", source="local", git_dir=git_dir, update=True)
+    assert output.read_text() == full
+
+
+def test_generate_batch(tmp_path, capsys):
+    manifest = tmp_path / "repos.txt"
+    manifest.write_text("\n".join([
+        "# repositories to process",
+        REPO,
+        "org/other {}  # specific output".format(tmp_path / "other" / "CHANGES.md"),
+        "",
+        "org/missing",
+    ]) + "\n")
+    entries = read_manifest(str(manifest))
+    assert [entry["repo"] for entry in entries] == [REPO, "org/other", "org/missing"]
+
+    with fake_github_api(delay=0.05) as (server, api_url):
+        server.repos = [REPO, "org/other"]
+        results = generate_batch(entries, jobs=4, output_dir=str(tmp_path), output_format="md", cache=False,
+                                 api_url=api_url)
+        assert server.connections <= 4, "expected connections to be shared by all repositories"
+    assert [(repo, bool(output), bool(error)) for repo, output, _, error in results] == [
+        (REPO, True, False), ("org/other", True, False), ("org/missing", False, True),
+    ]
+    assert (tmp_path / "org_repo" / "CHANGES.md").is_file()
+    assert (tmp_path / "other" / "CHANGES.md").is_file()
+    assert "Missing tag information" in results[2][3]
+    out = capsys.readouterr().out
+    assert "[org/other] generated in " in out
+    assert "(2 generated, 1 failed)" in out
+
+
+def test_read_manifest_json(tmp_path):
+    manifest = tmp_path / "repos.json"
+    manifest.write_text(json.dumps([{"repo": REPO, "output_format": "md", "source": "local", "git_dir": "repo/.git"}]))
+    assert read_manifest(str(manifest)) == [
+        {"repo": REPO, "output_format": "md", "source": "local", "git_dir": "repo/.git"}
+    ]
@@ -0,0 +1,144 @@
+import errno
+import os
+import time
+
+import mock
+import pytest
+
+import _defrag
+from _defrag import defrag, find_zero_files, parse_reserve, zero_free_space
+
+MiB = 2 ** 20
+
+
+def zero_files_sizes(directory):
+    return [os.path.getsize(path) for path in find_zero_files(directory)]
+
+
+def fake_free_space(directory, available, total):
+    """
+    Simulates a filesystem of the given total size with initially available space reduced by written zero files.
+    """
+    def free_space(_):
+        return available - sum(zero_files_sizes(directory)), total
+    return free_space
+
+
+def interrupt_after(count):
+    write_zeros = _defrag.write_zeros
+
+    def write(*args):
+        if write.calls == count:
+            raise KeyboardInterrupt
+        write.calls += 1
+        return write_zeros(*args)
+    write.calls = 0
+    return write
+
+
+def test_parse_reserve():
+    assert parse_reserve("5%") == (5.0, True)
+    assert parse_reserve("2.5 %") == (2.5, True)
+    assert parse_reserve("1GiB") == (2 ** 30, False)
+    with pytest.raises(ValueError):
+        parse_reserve("lots")
+
+
+@pytest.mark.parametrize("mode", ["auto", "fadvise"])
+def test_zero_free_space_limit(tmp_path, mode):
+    directory = str(tmp_path)
+    with mock.patch("_defrag.remove_zero_files"):
+        written = zero_free_space(directory, block_size=MiB, mode=mode, max_file_size=4 * MiB, limit=10 * MiB,
+                                  reserve="0")
+    assert written == 10 * MiB
+    assert zero_files_sizes(directory) == [4 * MiB, 4 * MiB, 2 * MiB]
+    for path in find_zero_files(directory):
+        with open(path, "rb") as f:
+            assert not f.read().strip(b"\0")
+
+    assert zero_free_space(directory, block_size=MiB, mode=mode, max_file_size=4 * MiB, limit=3 * MiB) == 3 * MiB
+    assert os.listdir(directory) == [], "zero files should be removed, including the ones of the previous run"
+
+
+def test_zero_free_space_page_cache_mode(tmp_path):
+    with mock.patch("_defrag.os.posix_fadvise") as fadvise:
+        zero_free_space(str(tmp_path), block_size=MiB, mode="fadvise", limit=3 * MiB)
+    assert [call[0][1:3] for call in fadvise.call_args_list] == [(0, MiB), (MiB, MiB), (2 * MiB, MiB)]
+    def open_direct(path, _):
+        return os.open(path, os.O_WRONLY | os.O_CREAT), True
+
+    with mock.patch("_defrag.open_zero_file", side_effect=open_direct):
+        with mock.patch("_defrag.os.posix_fadvise") as fadvise:
+            zero_free_space(str(tmp_path), block_size=MiB, mode="direct", limit=3 * MiB)
+    assert not fadvise.called, "direct writes should not need to drop the page cache"
+
+
+@pytest.mark.parametrize("reserve, expected", [("20%", 44 * MiB), ("50MiB", 14 * MiB), ("80%", 0)])
+def test_zero_free_space_reserve(tmp_path, reserve, expected):
+    directory = str(tmp_path)
+    free_space = fake_free_space(directory, available=64 * MiB, total=100 * MiB)
+    with mock.patch("_defrag.free_space", side_effect=free_space):
+        with mock.patch("_defrag.remove_zero_files"):
+            written = zero_free_space(directory, block_size=3 * MiB, max_file_size=16 * MiB, reserve=reserve)
+    assert written == expected
+    assert sum(zero_files_sizes(directory)) == expected
+
+
+def test_zero_free_space_full(tmp_path):
+    write_zeros = _defrag.write_zeros
+
+    def write(*args):
+        if write.calls == 3:
+            raise OSError(errno.ENOSPC, "No space left on device")
+        write.calls += 1
+        return write_zeros(*args)
+    write.calls = 0
+
+    with mock.patch("_defrag.write_zeros", side_effect=write):
+        written = zero_free_space(str(tmp_path), block_size=MiB, reserve="0")
+    assert written == 3 * MiB
+    assert os.listdir(str(tmp_path)) == []
+
+
+def test_zero_free_space_resume(tmp_path):
+    directory = str(tmp_path)
+    options = dict(block_size=MiB, max_file_size=2 * MiB, limit=7 * MiB)
+    with mock.patch("_defrag.write_zeros", side_effect=interrupt_after(3)):
+        with pytest.raises(KeyboardInterrupt):
+            zero_free_space(directory, resume=True, **options)
+    assert zero_files_sizes(directory) == [2 * MiB, MiB]
+
+    # unaligned tail of an interrupted write is dropped
+    with open(find_zero_files(directory)[-1], "ab") as f:
+        f.write(b"\0" * 100)
+    with mock.patch("_defrag.write_zeros", side_effect=interrupt_after(2)) as write:
+        with pytest.raises(KeyboardInterrupt):
+            zero_free_space(directory, resume=True, **options)
+    assert write.call_args_list[0][0][1] == MiB, "should resume writing at the end of the last zero file"
+    assert zero_files_sizes(directory) == [2 * MiB, 2 * MiB, MiB]
+
+    with mock.patch("_defrag.write_zeros", side_effect=_defrag.write_zeros) as write:
+        assert zero_free_space(directory, resume=True, **options) == 7 * MiB
+    assert write.call_count == 2
+    assert os.listdir(directory) == []
+
+
+def test_zero_free_space_interrupted(tmp_path):
+    with mock.patch("_defrag.write_zeros", side_effect=interrupt_after(3)):
+        with pytest.raises(KeyboardInterrupt):
+            zero_free_space(str(tmp_path), block_size=MiB, max_file_size=2 * MiB, limit=7 * MiB)
+    assert os.listdir(str(tmp_path)) == [], "zero files should be removed when not resumable"
+
+
+def test_zero_free_space_rate(tmp_path):
+    start = time.monotonic()
+    written = zero_free_space(str(tmp_path), block_size=MiB, rate=20 * MiB, limit=4 * MiB)
+    assert written == 4 * MiB
+    assert time.monotonic() - start >= 0.2
+
+
+def test_defrag_same_filesystem(tmp_path):
+    other = tmp_path / "other"
+    other.mkdir()
+    results = defrag([str(tmp_path), str(other)], block_size=MiB, limit=MiB)
+    assert results == {str(tmp_path): MiB}
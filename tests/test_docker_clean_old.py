@@ -1,5 +1,35 @@
-from _docker_clean_old import docker_clean_old
+import gzip
+import http.server
+import io
+import json
+import shlex
+import socketserver
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import unquote
+
 import mock
+import pytest
+
+from _docker_clean_old import (
+    __version__,
+    ContainerInfo,
+    DockerAPIClient,
+    ImageGraph,
+    ImageInfo,
+    ImageMatcher,
+    ImageWatcher,
+    LatestVersion,
+    docker_clean_old,
+    get_api_client,
+    make_image_info,
+    parse_age,
+    parse_size,
+    remove_images,
+    resolve_amount_remove,
+    watch_images
+)
 
 # uses a massive list of predefined combinations that represent possible image tags retrieved by docker
 # listed image are ordered from creation date (default), which could be pretty much anything
@@ -178,25 +208,216 @@ DEFAULT_CALL_REMOVES = [
 
 def mock_process(cmd, *_, **__):
     class MockProcess(object):
-        remove = []
-
-        @staticmethod
-        def communicate(*_, **__):
-            output = "\n".join("{} {}".format(*line.split(":")) for line in MOCK_DOCKER_LIST)
-            return output, 0
-        @property
-        def stdout(self):
-            self.remove = cmd.split("rmi")[-1].split(" ")
-
-            class StdOut(object):
-                @property
-                def readline(self):
-                    return lambda *_, **__: ""  # just skip iterate stdout
-            return StdOut()
+        returncode = 0
+
+        def __init__(self):
+            if cmd.startswith("docker rmi"):
+                output = "".join(mock_rmi_output(name) for name in shlex.split(cmd)[2:])
+            elif cmd.startswith("docker images --all"):
+                output = "\n".join(image["Id"] for image in mock_api_images())
+            elif cmd.startswith("docker image inspect"):
+                output = "\n".join("{} {} {} {}".format(image["Id"], image["ParentId"], image["Size"],
+                                                       ",".join(image["RepoTags"])) for image in mock_api_images())
+            elif cmd.startswith("docker ps"):
+                output = ""
+            else:
+                output = "\n".join("{} {}".format(*line.split(":")) for line in MOCK_DOCKER_LIST)
+            self.stdout = io.StringIO(output)
+
+        def communicate(self, *_, **__):
+            return self.stdout.read(), None
+
+        def wait(self, *_, **__):
+            return self.returncode
 
     return MockProcess()
 
 
+def mock_rmi_output(name):
+    """
+    Generates the ``docker rmi`` output of a single reference, where names containing ``error`` fail removal.
+    """
+    if "error" in name:
+        return "Error response from daemon: conflict: unable to remove repository reference \"{}\"\n".format(name)
+    if name.startswith("sha256:"):
+        return "Deleted: {}\n".format(name)
+    return "Untagged: {}\nDeleted: sha256:{}\n".format(name, name.replace(":", "-"))
+
+
+def mock_api_images():
+    """
+    Generates the Docker Engine API image listing equivalent to :data:`MOCK_DOCKER_LIST`.
+
+    Listing is returned in reverse order of creation to validate that the API backend sorts them back as the CLI would.
+    """
+    images = []
+    for i, img_tag in enumerate(MOCK_DOCKER_LIST):
+        repo_tags = [] if img_tag == "<none>:<none>" else [img_tag]
+        img_id = "sha256:{:064x}".format(i)
+        created = 2000000000 - i  # listing is ordered from newest to oldest
+        images.append({"Id": img_id, "RepoTags": repo_tags, "Created": created, "Size": 1000 + i, "ParentId": ""})
+    return list(reversed(images))
+
+
+class FakeDockerHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # allow keep-alive connections
+
+    def setup(self):
+        super(FakeDockerHandler, self).setup()
+        self.server.connections += 1
+
+    def address_string(self):
+        return "docker.sock"  # unix socket clients do not have an address
+
+    def log_message(self, *_, **__):
+        pass
+
+    def send_json(self, data, status=200):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_text(self, text, status=200):
+        body = text.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # noqa: N802
+        self.server.requests.append(("GET", self.path))
+        path, _, query = self.path.partition("?")
+        if path == "/_ping":
+            self.send_text("OK")  # the daemon answers pings in plain text
+        elif path == "/images/json":
+            images = self.server.images
+            if "all=1" not in query:  # intermediate images are not listed by default
+                images = [img for img in images if img["RepoTags"] or not self.children(img["Id"])]
+            self.send_json(images)
+        elif path == "/containers/json":
+            self.send_json(self.server.containers)
+        elif path == "/events":
+            self.send_events()
+        elif path.startswith("/images/") and path.endswith("/json"):
+            self.send_inspect(unquote(path[len("/images/"):-len("/json")]))
+        else:
+            self.send_json({"message": "page not found"}, status=404)
+
+    def send_events(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        for event in self.server.events:
+            chunk = (json.dumps(event) + "\n").encode("utf-8")
+            self.wfile.write("{:x}\r\n".format(len(chunk)).encode("utf-8") + chunk + b"\r\n")
+        self.wfile.write(b"0\r\n\r\n")
+        self.close_connection = True
+
+    def send_inspect(self, name):
+        images = [img for img in self.server.images if name == img["Id"] or name in img["RepoTags"]]
+        if not images:
+            self.send_json({"message": "No such image: {}".format(name)}, status=404)
+            return
+        image = dict(images[0])
+        image["Created"] = time.strftime("%Y-%m-%dT%H:%M:%S.123456789Z", time.gmtime(image["Created"]))
+        image["Parent"] = image.pop("ParentId")
+        self.send_json(image)
+
+    def children(self, image_id):
+        return [img for img in self.server.images if img["ParentId"] == image_id]
+
+    def do_DELETE(self):  # noqa: N802
+        self.server.requests.append(("DELETE", self.path))
+        path = unquote(self.path.split("?")[0])
+        if path.startswith("/containers/"):
+            container_id = path[len("/containers/"):]
+            self.server.containers = [ctr for ctr in self.server.containers if ctr["Id"] != container_id]
+            self.send_response(204)
+            self.end_headers()
+            return
+        name = path[len("/images/"):]
+        if "error" in name:
+            self.send_json({"message": "conflict: unable to remove repository reference"}, status=409)
+            return
+        images = [img for img in self.server.images if name == img["Id"] or name in img["RepoTags"]]
+        if not images:
+            self.send_json({"message": "No such image: {}".format(name)}, status=404)
+            return
+        image = images[0]
+        items = []
+        if name in image["RepoTags"]:
+            image["RepoTags"].remove(name)
+            items.append({"Untagged": name})
+            if image["RepoTags"] or self.children(image["Id"]):
+                self.send_json(items)
+                return
+        if self.children(image["Id"]):
+            self.send_json({"message": "conflict: image has dependent child images"}, status=409)
+            return
+        if any(ctr["ImageID"] == image["Id"] for ctr in self.server.containers):
+            self.send_json({"message": "conflict: image is being used by a container"}, status=409)
+            return
+        while image:  # delete image and prune its untagged parents without other children
+            self.server.images.remove(image)
+            self.server.deleted.append(image["Id"])
+            items.append({"Deleted": image["Id"]})
+            parents = [img for img in self.server.images if img["Id"] == image["ParentId"]]
+            image = parents[0] if parents and not parents[0]["RepoTags"] and not self.children(parents[0]["Id"]) \
+                else None
+        self.send_json(items)
+
+
+@contextmanager
+def fake_docker_socket(tmp_path, images=None, containers=None):
+    """
+    Runs a fake Docker daemon on a local unix socket that serves the provided images and containers.
+    """
+    socket_path = str(tmp_path / "docker.sock")
+    server = socketserver.ThreadingUnixStreamServer(socket_path, FakeDockerHandler)
+    server.daemon_threads = True
+    server.images = mock_api_images() if images is None else images
+    server.containers = containers or []
+    server.requests = []
+    server.deleted = []
+    server.events = []
+    server.connections = 0
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server, socket_path
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def make_image(img_id, repo_tags=None, parent=None, size=100):
+    return {"Id": img_id, "RepoTags": repo_tags or [], "Created": 0, "Size": size, "ParentId": parent or ""}
+
+
+def make_graph_images():
+    """
+    Generates images with parent relationships, where intermediate images are not tagged::
+
+        base:1 <- (mid) <- app:1, app:2
+                        <- (dangling) <- (dangling)
+        used:1 (employed by a container)
+    """
+    return [
+        make_image("sha256:base", ["base:1"]),
+        make_image("sha256:mid", parent="sha256:base"),
+        make_image("sha256:app1", ["app:1"], parent="sha256:mid"),
+        make_image("sha256:app2", ["app:2"], parent="sha256:mid"),
+        make_image("sha256:dangling1", parent="sha256:mid"),
+        make_image("sha256:dangling2", parent="sha256:dangling1"),
+        make_image("sha256:used", ["used:1"]),
+    ]
+
+
 def get_log_lines(captured_logs, strip_header=False):
     logs = [line.message for line in captured_logs.records]
     if strip_header:
@@ -208,16 +429,574 @@ def get_log_lines(captured_logs, strip_header=False):
 
 def test_docker_clean_old_basic():
     with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
-        docker_clean_old()
-        assert proc.call_count == 2, "expected 1 call to fetch images and another to remove selected ones"
-        assert proc.call_args_list[0].args[0].startswith("docker images")
-        assert proc.call_args_list[1].args[0].startswith("docker rmi")
+        docker_clean_old(backend="cli")
+        commands = [call.args[0] for call in proc.call_args_list]
+        assert len(commands) == 5, "expected calls to fetch images, their dependencies, and to remove selected ones"
+        assert commands[0].startswith("docker images --format")
+        assert commands[1].startswith("docker images --all")
+        assert commands[2].startswith("docker image inspect")
+        assert commands[3].startswith("docker ps")
+        assert commands[4].startswith("docker rmi")
 
 
 def test_docker_clean_old_dry_run(caplog):
     with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
-        docker_clean_old(dry_run=True)
+        docker_clean_old(dry_run=True, backend="cli")
         assert proc.call_count == 1, "expected 1 call to fetch images but remove images not called"
         assert proc.call_args_list[0].args[0].startswith("docker images")
     logs = get_log_lines(caplog, strip_header=True)
     assert logs == DEFAULT_CALL_REMOVES
+
+
+def test_docker_clean_old_api_backend_dry_run(tmp_path, caplog):
+    with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+        docker_clean_old(dry_run=True, backend="cli")
+    cli_logs = get_log_lines(caplog, strip_header=True)
+    caplog.clear()
+
+    with fake_docker_socket(tmp_path) as (server, socket_path):
+        with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+            docker_clean_old(dry_run=True, backend="api", docker_socket=socket_path)
+            assert proc.call_count == 0, "expected images to be listed from the API instead of the CLI"
+    api_logs = get_log_lines(caplog, strip_header=True)
+    assert api_logs == cli_logs
+    assert server.requests == [("GET", "/images/json?shared-size=1")]
+
+
+def test_docker_clean_old_api_backend_remove(tmp_path):
+    with fake_docker_socket(tmp_path) as (server, socket_path):
+        with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+            results = docker_clean_old(backend="auto", docker_socket=socket_path, jobs=4, batch_size=10)
+            assert proc.call_count == 0, "expected images to be listed and removed with the API"
+    removed = [path for method, path in server.requests if method == "DELETE"]
+    assert len(removed) == len(results)
+    assert all(result.success for result in results)
+    assert "/images/%3Cnone%3E:%3Cnone%3E" not in removed, "dangling images should be referenced by ID"
+    assert "/images/sha256:{:064x}".format(0) in removed
+    assert sum(result.size for result in results) == sum(
+        img["Size"] for img in mock_api_images()
+        if img["Id"] in {img_id for result in results for img_id in result.deleted}
+    )
+    assert server.connections == 1 + (len(results) + 9) // 10, "expected one connection for listing and each batch"
+
+
+def test_docker_clean_old_cli_batches():
+    with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+        results = docker_clean_old(backend="cli", jobs=3, batch_size=7)
+    cmd_rmi = [call.args[0] for call in proc.call_args_list if call.args[0].startswith("docker rmi")]
+    assert len(cmd_rmi) == (len(results) + 6) // 7
+    assert all(len(shlex.split(cmd)) - 2 <= 7 for cmd in cmd_rmi)
+    assert [result.tag for result in results] == [name for cmd in cmd_rmi for name in shlex.split(cmd)[2:]]
+    assert all(result.success for result in results)
+
+
+def test_remove_images_results(caplog):
+    tags = ["a:1", "b:error", "c:2", "sha256:{:064x}".format(1)]
+    sizes = {"sha256:a-1": 10, "sha256:c-2": 20, "sha256:{:064x}".format(1): 30}
+    with mock.patch("subprocess.Popen", side_effect=mock_process):
+        results = remove_images(tags, jobs=2, batch_size=2, sizes=sizes)
+    assert [(result.tag, result.success, result.size) for result in results] == [
+        ("a:1", True, 10),
+        ("b:error", False, 0),
+        ("c:2", True, 20),
+        ("sha256:{:064x}".format(1), True, 30),
+    ]
+    assert "conflict" in results[1].error
+
+
+def test_remove_batch_cli_similar_references():
+    from _docker_clean_old import find_reference, remove_batch_cli
+
+    output = "Untagged: img:1\nDeleted: sha256:img-1\nError response from daemon: No such image: img:10\n"
+    with mock.patch("subprocess.Popen") as proc:
+        proc.return_value.stdout = io.StringIO(output)
+        proc.return_value.wait.return_value = 1
+        results = remove_batch_cli(["img:1", "img:10"])
+    assert [(result.tag, result.success) for result in results] == [("img:1", True), ("img:10", False)]
+    assert "No such image" in results[1].error
+
+    names = ["img:1", "img:1.0", "sha256:{:064x}".format(1)]
+    assert find_reference('conflict: unable to remove repository reference "img:1.0" (must force)', names) == "img:1.0"
+    assert find_reference("Error: No such image: img:1.", names) == "img:1"
+    assert find_reference("unable to delete {} (must be forced)".format(names[2][7:19]), names) == names[2]
+    assert find_reference("Error: No such image: img:10", names) is None
+
+
+def test_docker_clean_old_auto_backend_fallback(tmp_path):
+    with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+        docker_clean_old(dry_run=True, backend="auto", docker_socket=str(tmp_path / "missing.sock"))
+        assert proc.call_count == 1
+        assert proc.call_args_list[0].args[0].startswith("docker images")
+
+
+def test_image_info_rows():
+    from _docker_clean_old import iter_image_rows
+
+    info = ImageInfo(id="sha256:abc", repo_tags=["registry:5000/repo/img:1.0", "img:latest"],
+                     created=1, size=10, parent=None)
+    dangling = ImageInfo(id="sha256:def", repo_tags=[], created=0, size=10, parent=None)
+    rows = list(iter_image_rows([info, "other 2.0", "", dangling]))
+    assert rows == [
+        ("registry:5000/repo/img", "1.0", info),
+        ("img", "latest", info),
+        ("other", "2.0", None),
+        ("<none>", "<none>", dangling),
+    ]
+
+
+def test_latest_version_sort_key():
+    # expected ordering from oldest to newest
+    expected = [
+        "other",
+        "random",
+        "unknown",
+        "v0.1",
+        "0.2",
+        "v0.3",
+        "pre-0.4",
+        "0.4",
+        "0.4-rc",
+        "v0.4.1",
+        "latest-0.5",
+        "0.5",
+        "post-0.6",
+        "pre-0.6",
+        "0.6",
+        "magpie-3.0.0",
+        "magpie-3.0.0-rc",
+        "3.7-alpine",
+        "3.7-slim",
+        "3.7-slim-buster",
+        "latest",
+    ]
+    versions = [LatestVersion.get(tag) for tag in reversed(expected)]
+    assert [v.vstring for v in sorted(versions, key=lambda v: v.sort_key)] == expected
+    assert [v.vstring for v in sorted(versions)] == expected, "comparison operators must match the sort keys"
+    assert LatestVersion("0.4") < "0.4-rc"
+    assert all(hash(v.sort_key) for v in versions)
+
+
+def test_latest_version_interned():
+    assert LatestVersion.get("1.2.3") is LatestVersion.get("1.2.3")
+    assert LatestVersion.get("latest") is LatestVersion.get("latest")
+    assert LatestVersion.get("1.2.3") is not LatestVersion("1.2.3")
+
+
+def test_resolve_ignore_repo():
+    rows = ["my-repo/my-image 1.0", "my-image 2.0", "other-repo/other 1.0"]
+    removed = resolve_amount_remove(rows, 1, [], [], "alpha", dry_run=False)
+    assert removed == set()
+    removed = resolve_amount_remove(rows, 1, [], [], "alpha", ignore_repo=True, dry_run=False)
+    assert removed == {"my-repo/my-image:1.0"}
+    removed = resolve_amount_remove(rows, 1, [], ["my-image"], "alpha", ignore_repo=True, dry_run=False)
+    assert removed == set()
+
+
+def test_docker_clean_old_from_listing(tmp_path, caplog):
+    with mock.patch("subprocess.Popen", side_effect=mock_process):
+        docker_clean_old(dry_run=True, backend="cli")
+    cli_logs = get_log_lines(caplog, strip_header=True)
+
+    listing_text = tmp_path / "listing.txt"
+    listing_text.write_text("\n".join("{} {}".format(*line.split(":")) for line in MOCK_DOCKER_LIST) + "\n")
+    listing_json = tmp_path / "listing.jsonl.gz"
+    with gzip.open(str(listing_json), mode="wt") as listing_file:
+        for image in sorted(mock_api_images(), key=lambda img: img["Created"], reverse=True):
+            listing_file.write(json.dumps(image) + "\n")
+
+    for listing in [listing_text, listing_json]:
+        caplog.clear()
+        with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+            docker_clean_old(dry_run=True, input_source=str(listing))
+            assert proc.call_count == 0, "expected no call to docker when listing is provided"
+        assert get_log_lines(caplog, strip_header=True) == cli_logs
+
+    caplog.clear()
+    with mock.patch("sys.stdin", io.StringIO(listing_text.read_text())):
+        docker_clean_old(dry_run=True, input_source="-")
+    assert get_log_lines(caplog, strip_header=True) == cli_logs
+
+
+def test_docker_clean_old_from_listing_streamed():
+    consumed = []
+
+    def listing():
+        for line in MOCK_DOCKER_LIST:
+            consumed.append(line)
+            yield "{} {}\n".format(*line.split(":"))
+
+    with mock.patch("sys.stdin", listing()):
+        with mock.patch("_docker_clean_old.resolve_amount_remove", return_value=set()) as resolve:
+            docker_clean_old(dry_run=True, input_source="-")
+        rows = resolve.call_args.args[0]
+        assert not consumed, "listing should not be read before resolution"
+        assert next(rows) == "<none> <none>"
+        assert len(consumed) == 1, "listing should be read one row at a time"
+
+
+def test_image_matcher():
+    matcher = ImageMatcher([
+        "devops",
+        "pavics/magpie:2.0.0",
+        "pavics/*:*-dev",
+        "nvidia/cuda",
+        "re:python:3\\.[0-9]+-slim.*",
+        "registry:5000/img",
+    ])
+    assert matcher.match("devops", "latest")
+    assert matcher.match("pavics/magpie", "2.0.0")
+    assert not matcher.match("pavics/magpie", "3.0.0")
+    assert matcher.match("pavics/twitcher", "magpie-3.3.0-dev")
+    assert not matcher.match("pavics/twitcher", "magpie-3.3.0-rc")
+    assert matcher.match("nvidia/cuda", "10.1")
+    assert matcher.match("python", "3.8-slim-buster")
+    assert not matcher.match("python", "3.7-alpine")
+    assert matcher.match("registry:5000/img", "1.0")
+    assert not matcher.match("registry", "5000")
+    assert not matcher.match("my-repo/devops", "1.0", "devops")
+    assert ImageMatcher(["devops"], ignore_repo=True).match("my-repo/devops", "1.0", "devops")
+    assert ImageMatcher(["devops:1.0"], ignore_repo=True).match("my-repo/devops", "1.0", "devops")
+    assert ImageMatcher(["*/devops"]).match("my-repo/devops", "1.0")
+    assert not ImageMatcher()
+
+
+def test_resolve_patterns():
+    rows = ["{} {}".format(*line.split(":")) for line in MOCK_DOCKER_LIST]
+    removed = resolve_amount_remove(rows, 1, [], ["pavics/*", "re:.*cuda.*"], "alpha", dry_run=False)
+    removed = {tag for tag in removed if not tag.endswith(":<none>")}  # dangling are forced regardless of excludes
+    assert not any(tag.startswith("pavics/") or "cuda" in tag for tag in removed)
+    assert "video-action-recognition:0.3.0" in removed
+    removed = resolve_amount_remove(rows, 1, ["pavics/*:*-dev"], ["pavics/*"], "alpha", dry_run=False)
+    assert {tag for tag in removed if tag.startswith("pavics/")} == {
+        "pavics/magpie:3.3.0-dev",
+        "pavics/twitcher:magpie-3.3.0-dev",
+        "pavics/magpie:<none>",
+        "pavics/twitcher:<none>",
+    }
+
+
+def make_policy_images():
+    day = 86400
+    return [
+        # same image with multiple tags, space is freed only once both are removed
+        ImageInfo("sha256:a", ["app:1.0", "app:1.0-final"], created=1 * day, size=500, parent=None, shared_size=100),
+        ImageInfo("sha256:b", ["app:2.0"], created=2 * day, size=300, parent=None, shared_size=100),
+        ImageInfo("sha256:c", ["app:3.0"], created=9 * day, size=900, parent=None, shared_size=100),
+        ImageInfo("sha256:d", ["app:4.0"], created=10 * day, size=200, parent=None, shared_size=100),
+        ImageInfo("sha256:e", ["<none>:<none>"], created=0, size=50, parent=None, shared_size=0),
+    ]
+
+
+def test_resolve_policy_keep_newer():
+    images = make_policy_images()
+    removed = resolve_amount_remove(images, 1, [], [], "alpha", dry_run=False,
+                                    keep_newer=parse_age("2d"), now=11 * 86400)
+    assert removed == {"app:1.0", "app:1.0-final", "app:2.0", "sha256:e"}
+
+
+def test_resolve_policy_free_target():
+    images = make_policy_images()
+    removed = resolve_amount_remove(images, 1, [], [], "alpha", dry_run=False, free_target=300)
+    # dangling (50) is forced, oldest image (400) needs both tags to be removed to free space
+    assert removed == {"app:1.0", "app:1.0-final", "sha256:e"}
+    removed = resolve_amount_remove(images, 1, [], [], "alpha", dry_run=False, free_target=500)
+    assert removed == {"app:1.0", "app:1.0-final", "app:2.0", "sha256:e"}
+    removed = resolve_amount_remove(images, 1, [], [], "alpha", dry_run=False, free_target=100,
+                                    remove_order="largest")
+    assert removed == {"app:3.0", "sha256:e"}
+
+
+def test_resolve_policy_max_usage(caplog):
+    images = make_policy_images()
+    # unique sizes: 400 + 200 + 800 + 100 + 50, with 100 shared counted once
+    removed = resolve_amount_remove(images, 1, [], [], "alpha", dry_run=False, max_usage=1650)
+    assert removed == {"sha256:e"}
+    removed = resolve_amount_remove(images, 1, [], [], "alpha", dry_run=False, max_usage=1200)
+    assert removed == {"app:1.0", "app:1.0-final", "sha256:e"}
+    removed = resolve_amount_remove(images, 0, [], ["app:4.0"], "alpha", dry_run=True, max_usage=0)
+    assert removed == {"app:1.0", "app:1.0-final", "app:2.0", "app:3.0", "sha256:e"}
+    assert get_log_lines(caplog)[-1] == "Estimated space freed: 1.4KB"
+
+
+def test_resolve_policy_max_usage_excluded_images():
+    gb = 10 ** 9
+    images = [ImageInfo("sha256:{}".format(i), ["app:{}".format(i)], created=i, size=10 * gb, parent=None)
+              for i in range(3)]
+    images.append(ImageInfo("sha256:3", ["app:latest"], created=3, size=10 * gb, parent=None))
+    dry = resolve_amount_remove(images, 0, [], [], "alpha", dry_run=True, max_usage=25 * gb)
+    real = resolve_amount_remove(images, 0, [], [], "alpha", dry_run=False, max_usage=25 * gb)
+    assert dry == real == {"app:0", "app:1"}, "excluded images must be accounted in the disk usage of both modes"
+
+
+def test_resolve_policy_without_metadata(caplog):
+    rows = ["img 1.0", "img 2.0", "img 3.0"]
+    for policy in [dict(max_usage=10), dict(free_target=10), dict(keep_newer=60)]:
+        with pytest.raises(ValueError, match="requires image metadata"):
+            resolve_amount_remove(rows, 1, [], [], "alpha", dry_run=False, **policy)
+
+    # images without metadata cannot be accounted for, and are removed as by other rules with either policy
+    images = make_policy_images() + ["other 1.0", "other 2.0"]
+    for policy in [dict(max_usage=10 ** 6), dict(free_target=0)]:
+        removed = resolve_amount_remove(images, 1, [], [], "alpha", dry_run=False, **policy)
+        assert removed == {"other:1.0", "sha256:e"}
+    assert "2 listed images without metadata are not protected by --free." in get_log_lines(caplog)
+
+
+def test_resolve_sort_date_listing_order():
+    # 'docker images' lists images from newest to oldest, as the creation dates of metadata indicate
+    rows = ["app c", "app b", "app a"]
+    infos = [ImageInfo("sha256:{}".format(tag), ["app:{}".format(tag)], created=created, size=1, parent=None)
+             for tag, created in [("c", 3), ("b", 2), ("a", 1)]]
+    removed_rows = resolve_amount_remove(rows, 1, [], [], "date", dry_run=False)
+    removed_infos = resolve_amount_remove(infos, 1, [], [], "date", dry_run=False)
+    assert removed_rows == removed_infos == {"app:a", "app:b"}
+
+
+def test_parse_policy_values():
+    assert parse_size("1024") == 1024
+    assert parse_size("1.5GB") == 1500000000
+    assert parse_size("2KiB") == 2048
+    assert parse_size("10m") == 10000000
+    assert parse_age("90") == 90
+    assert parse_age("12h") == 43200
+    assert parse_age("1w") == 604800
+
+
+def test_image_graph_order_removal():
+    images = [make_image_info(img) for img in make_graph_images()]
+    graph = ImageGraph(images, [ContainerInfo("abcdef0123456789", "sha256:used", "running")])
+    references = {
+        "base:1": "sha256:base",
+        "app:1": "sha256:app1",
+        "app:2": "sha256:app2",
+        "sha256:mid": "sha256:mid",
+        "sha256:dangling1": "sha256:dangling1",
+        "sha256:dangling2": "sha256:dangling2",
+        "used:1": "sha256:used",
+        "other:1": None,
+    }
+    chains, skipped = graph.order_removal(references)
+    assert skipped == {"used:1": "image in use by container abcdef012345"}
+    assert chains == [
+        ["other:1"],
+        ["sha256:dangling2", "app:1", "app:2", "sha256:dangling1", "sha256:mid", "base:1"],
+    ]
+
+    # intermediate image cannot be deleted if one of its children is kept
+    chains, skipped = graph.order_removal({"app:1": "sha256:app1", "sha256:mid": "sha256:mid"})
+    assert skipped == {"sha256:mid": "image has dependent child images"}
+    assert chains == [["app:1"]]
+
+    # independent trees can be removed concurrently
+    chains, _ = graph.order_removal({"sha256:dangling2": "sha256:dangling2", "app:1": "sha256:app1"})
+    assert sorted(chains) == [["app:1"], ["sha256:dangling2"]]
+
+
+def test_docker_clean_old_api_dependency_order(tmp_path, caplog):
+    images = make_graph_images()
+    images.append(make_image("sha256:base0", ["base:0"]))
+    containers = [{"Id": "abcdef0123456789", "ImageID": "sha256:used", "State": "exited"}]
+    with fake_docker_socket(tmp_path, images=images, containers=containers) as (server, socket_path):
+        results = docker_clean_old(keep_count=0, backend="api", docker_socket=socket_path, jobs=2, batch_size=2)
+    assert [result.tag for result in results if result.skipped] == ["used:1"]
+    assert all(result.success for result in results if not result.skipped)
+    assert "Failed" not in caplog.text
+    removed = [unquote(path)[len("/images/"):] for method, path in server.requests if method == "DELETE"]
+    assert sorted(removed) == ["app:1", "app:2", "base:0", "base:1", "sha256:dangling2"]
+    assert removed.index("app:1") < removed.index("base:1")
+    assert removed.index("app:2") < removed.index("base:1")
+    assert removed.index("sha256:dangling2") < removed.index("base:1")
+    assert sorted(server.deleted) == sorted(img["Id"] for img in make_graph_images() + [make_image("sha256:base0")]
+                                            if img["Id"] != "sha256:used")
+
+
+def test_docker_clean_old_cli_dependency_order():
+    images = make_graph_images() + [make_image("sha256:base0", ["base:0"])]
+    outputs = {
+        "docker images --format": "base 0\nbase 1\napp 2\napp 1\nused 1\n",
+        "docker images --all": "\n".join(img["Id"] for img in images),
+        "docker image inspect": "\n".join("{} {} {} {}".format(img["Id"], img["ParentId"], img["Size"],
+                                                              ",".join(img["RepoTags"])) for img in images),
+        "docker ps --all": "abcdef0123456789\n",
+        "docker container inspect": "abcdef0123456789 sha256:used exited\n",
+    }
+
+    def mock_cli(cmd, *_, **__):
+        if cmd.startswith("docker rmi"):
+            output = "".join("Untagged: {}\n".format(name) for name in shlex.split(cmd)[2:])
+        else:
+            output = [out for prefix, out in outputs.items() if cmd.startswith(prefix)][0]
+        proc = mock.MagicMock()
+        proc.stdout = io.StringIO(output)
+        proc.communicate.return_value = (output, None)
+        proc.wait.return_value = 0
+        return proc
+
+    with mock.patch("subprocess.Popen", side_effect=mock_cli) as proc:
+        results = docker_clean_old(keep_count=0, backend="cli", jobs=2, batch_size=2)
+    assert [result.tag for result in results if result.skipped] == ["used:1"]
+    assert all(result.success for result in results if not result.skipped)
+    cmd_rmi = [call.args[0] for call in proc.call_args_list if call.args[0].startswith("docker rmi")]
+    removed = [shlex.split(cmd)[2:] for cmd in cmd_rmi]
+    assert sorted(name for batch in removed for name in batch) == ["app:1", "app:2", "base:0", "base:1"]
+    assert removed.index(["app:1", "app:2"]) < removed.index(["base:1"]), "child images must be removed first"
+
+
+def test_docker_clean_old_plan_out_apply(tmp_path):
+    plan_json = tmp_path / "plan.json"
+    plan_lines = tmp_path / "plan.jsonl"
+    with fake_docker_socket(tmp_path) as (server, socket_path):
+        for plan_out in [plan_json, plan_lines]:
+            docker_clean_old(backend="api", docker_socket=socket_path, plan_out=str(plan_out))
+        assert not [path for method, path in server.requests if method == "DELETE"], "plan should not remove images"
+
+        plan = json.loads(plan_json.read_text())
+        assert plan["version"] == __version__
+        entries = [json.loads(line) for line in plan_lines.read_text().splitlines()]
+        assert plan["images"] == entries
+        assert len(entries) == len(mock_api_images())
+        by_name = {"{}:{}".format(entry["image"], entry["tag"]): entry for entry in entries}
+        assert by_name["<none>:<none>"]["status"] == "forced"
+        assert by_name["<none>:<none>"]["reason"] == "dangling image"
+        assert by_name["python:3.7-slim"]["reason"] in ["within latest kept images of group",
+                                                        "older than latest kept images of group"]
+        assert by_name["python:3.7-slim"]["group"] == "python"
+        assert all(entry["reason"] for entry in entries)
+        assert all(entry["id"] and entry["size"] is not None for entry in entries)
+        expected = {entry["reference"] for entry in entries if entry["status"] in ["remove", "forced", "include"]}
+
+        results = docker_clean_old(backend="api", docker_socket=socket_path, plan_in=str(plan_json))
+    listed = [path for method, path in server.requests if method == "GET" and path.startswith("/images/json")]
+    assert len(listed) == 2 + 1, "expected only the full listing for dependencies when applying the plan"
+    assert "all=1" in listed[-1]
+    assert {result.tag for result in results} == expected
+    assert all(result.success for result in results)
+
+
+def test_docker_clean_old_plan_apply_changed_images(tmp_path):
+    plan_path = tmp_path / "plan.jsonl"
+    images = [make_image("sha256:{:064x}".format(i), ["app:{}".format(i)]) for i in range(1, 5)]
+    with fake_docker_socket(tmp_path, images=images) as (server, socket_path):
+        docker_clean_old(backend="api", docker_socket=socket_path, plan_out=str(plan_path))
+        planned = {json.loads(line)["reference"] for line in plan_path.read_text().splitlines()
+                   if json.loads(line)["status"] == "remove"}
+        assert planned == {"app:1", "app:2", "app:3"}
+
+        # 'app:1' re-pushed onto another image, and 'app:2' removed after the plan was reviewed
+        server.images[0]["RepoTags"] = []
+        server.images.append(make_image("sha256:{:064x}".format(9), ["app:1"]))
+        server.images = [img for img in server.images if img["RepoTags"] != ["app:2"]]
+        results = docker_clean_old(backend="api", docker_socket=socket_path, plan_in=str(plan_path))
+    deleted = [unquote(path) for method, path in server.requests if method == "DELETE"]
+    assert deleted == ["/images/app:3"]
+    skipped = {result.tag: result.error for result in results if result.skipped}
+    assert sorted(skipped) == ["app:1", "app:2"]
+    assert "instead of planned" in skipped["app:1"]
+    assert skipped["app:2"] == "no longer exists"
+
+
+def test_docker_clean_old_plan_stdout(capsys):
+    with mock.patch("subprocess.Popen", side_effect=mock_process):
+        docker_clean_old(backend="cli", plan_out="-", include_latest=False)
+    entries = [json.loads(line) for line in capsys.readouterr().out.splitlines()]
+    assert len(entries) == len(MOCK_DOCKER_LIST)
+    assert {entry["reason"] for entry in entries if entry["tag"] == "latest"} == {"latest tag"}
+    with mock.patch("sys.stdin", io.StringIO("\n".join(json.dumps(entry) for entry in entries))):
+        with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+            results = docker_clean_old(backend="cli", plan_in="-")
+    assert all(not call.args[0].startswith("docker images --format") for call in proc.call_args_list)
+    assert {result.tag for result in results} == {
+        entry["reference"] for entry in entries if entry["status"] in ["remove", "forced", "include"]
+    }
+
+
+def make_image_event(action, reference, name=None):
+    return {"Type": "image", "Action": action, "Actor": {"ID": reference, "Attributes": {"name": name or reference}}}
+
+
+def test_get_api_client_auto(tmp_path):
+    with fake_docker_socket(tmp_path) as (server, socket_path):
+        client = get_api_client("auto", socket_path)
+        assert isinstance(client, DockerAPIClient)
+        assert client.ping()
+        client.close()
+    assert ("GET", "/_ping") in server.requests
+    assert get_api_client("auto", str(tmp_path / "missing.sock")) is None
+
+
+def test_image_watcher_load_matches_resolve(tmp_path):
+    with fake_docker_socket(tmp_path) as (_, socket_path):
+        client = get_api_client("api", socket_path)
+        images = client.images()
+        watcher = ImageWatcher(client, keep_count=2, include_latest=True)
+        watcher.load(images)
+        client.close()
+    expected = resolve_amount_remove(images, 2, [], [], "alpha", include_latest=True, dry_run=False)
+    assert set(watcher.queue) == expected
+    assert sorted(watcher.groups) == sorted({rec[0] for rec in watcher.records.values()})
+
+
+def test_image_watcher_events(tmp_path):
+    images = [
+        make_image("sha256:{:064x}".format(1), ["app:1.0"]),
+        make_image("sha256:{:064x}".format(2), ["app:1.1"]),
+        make_image("sha256:{:064x}".format(3), ["other:1.0"]),
+    ]
+    with fake_docker_socket(tmp_path, images=images) as (server, socket_path):
+        client = get_api_client("api", socket_path)
+        watcher = ImageWatcher(client, keep_count=2)
+        watcher.load(client.images())
+        assert not watcher.queue
+
+        # new version pulled in the group, oldest one in excess
+        server.images.append(make_image("sha256:{:064x}".format(4), ["app:1.2"]))
+        requests_before = len(server.requests)
+        watcher.handle(make_image_event("pull", "app:1.2"))
+        assert list(watcher.queue) == ["app:1.0"]
+        assert len(server.requests) - requests_before == 1, "expected only the affected image to be inspected"
+        assert [rec.tag for rec in watcher.groups["app"]] == ["1.0", "1.1", "1.2"]
+
+        # tag moved to another image, previous one becomes dangling and is queued as well
+        server.images[1]["RepoTags"] = []
+        server.images[2]["RepoTags"].append("app:1.1")
+        watcher.handle(make_image_event("tag", "sha256:{:064x}".format(3), "app:1.1"))
+        assert "sha256:{:064x}".format(2) in watcher.queue
+        assert [rec.tag for rec in watcher.groups["app"]] == ["1.0", "1.1", "1.2"]
+
+        # unrelated events are ignored, newest image removal keeps oldest one again
+        watcher.handle({"Type": "container", "Action": "start", "Actor": {"ID": "abc"}})
+        server.images[3]["RepoTags"] = []
+        watcher.handle(make_image_event("untag", "sha256:{:064x}".format(4)))
+        assert [rec.tag for rec in watcher.groups["app"]] == ["1.0", "1.1"]
+
+        results = watcher.run([])
+        client.close()
+    assert [result.tag for result in results] == ["sha256:{:064x}".format(2), "sha256:{:064x}".format(4)]
+    assert all(result.success for result in results)
+    assert "app:1.0" not in [path.split("/images/")[-1] for method, path in server.requests if method == "DELETE"]
+    assert not watcher.queue and "sha256:{:064x}".format(2) not in watcher.image_refs
+
+
+def test_image_watcher_rate_limit(tmp_path):
+    images = [make_image("sha256:{:064x}".format(i), ["app:1.{}".format(i)]) for i in range(4)]
+    with fake_docker_socket(tmp_path, images=images) as (_, socket_path):
+        client = get_api_client("api", socket_path)
+        watcher = ImageWatcher(client, keep_count=1, rate=20)
+        watcher.load(client.images())
+        start = time.monotonic()
+        results = watcher.run([])
+        elapsed = time.monotonic() - start
+        client.close()
+    assert len(results) == 3
+    assert elapsed >= 2 / 20.0, "expected removals to be paced by the rate"
+
+
+def test_watch_images_events_stream(tmp_path, caplog):
+    images = [make_image("sha256:{:064x}".format(1), ["app:1.0"])]
+    with fake_docker_socket(tmp_path, images=images) as (server, socket_path):
+        server.events = [make_image_event("pull", "app:1.1")]
+        server.images.append(make_image("sha256:{:064x}".format(2), ["app:1.1"]))
+        results = watch_images(keep_count=1, docker_socket=socket_path)
+    assert [result.tag for result in results] == ["app:1.0"]
+    events = [path for method, path in server.requests if path.startswith("/events")]
+    assert len(events) == 1 and "since=" in events[0] and "image" in unquote(events[0])
@@ -0,0 +1,80 @@
+from urllib.parse import unquote
+
+import mock
+
+from _docker_clean_unused import docker_clean_unused
+from tests.test_docker_clean_old import fake_docker_socket, get_log_lines, make_graph_images, make_image
+
+
+def make_unused_containers():
+    return [
+        {"Id": "running0123456789", "ImageID": "sha256:used", "State": "running"},
+        {"Id": "exited0123456789", "ImageID": "sha256:app1", "State": "exited"},
+        {"Id": "dead0123456789ab", "ImageID": "sha256:orphan", "State": "dead"},
+    ]
+
+
+def make_unused_images():
+    images = make_graph_images()
+    images.append(make_image("sha256:orphan"))  # dangling, but employed by a stopped container
+    images.append(make_image("sha256:busy", parent="sha256:used"))  # dangling, employed by running container
+    return images
+
+
+def test_docker_clean_unused_api(tmp_path, caplog):
+    containers = make_unused_containers()
+    containers[0]["ImageID"] = "sha256:busy"
+    with fake_docker_socket(tmp_path, images=make_unused_images(), containers=containers) as (server, socket_path):
+        with mock.patch("subprocess.Popen") as proc:
+            results = docker_clean_unused(backend="api", docker_socket=socket_path)
+            assert proc.call_count == 0
+    requests = [unquote(path) for method, path in server.requests if method == "DELETE"]
+    assert requests[:2] == ["/containers/exited0123456789?v=1", "/containers/dead0123456789ab?v=1"]
+    assert sorted(requests[2:]) == ["/images/sha256:dangling2", "/images/sha256:orphan"]
+    assert sorted(server.deleted) == ["sha256:dangling1", "sha256:dangling2", "sha256:orphan"]
+    assert [result.tag for result in results if result.skipped] == ["sha256:busy"]
+    assert not [result for result in results if not result.success and not result.skipped]
+    assert "Failed" not in caplog.text
+
+
+def test_docker_clean_unused_dry_run(tmp_path, caplog):
+    with fake_docker_socket(tmp_path, images=make_unused_images(), containers=make_unused_containers()) as server:
+        docker_clean_unused(dry_run=True, backend="api", docker_socket=server[1])
+        assert not [method for method, _ in server[0].requests if method == "DELETE"]
+    assert get_log_lines(caplog) == [
+        "Would remove container: [exited012345]",
+        "Would remove container: [dead01234567]",
+        "Would remove image: [sha256:busy]",
+        "Would remove image: [sha256:dangling2]",
+        "Would remove image: [sha256:dangling1]",
+        "Would remove image: [sha256:orphan]",
+    ]
+
+
+def test_docker_clean_unused_cli():
+    img_a, img_b, img_c = ("sha256:" + char * 64 for char in "abc")
+    outputs = {
+        "docker images --all --quiet --no-trunc": "\n".join([img_a, img_b, img_c, img_b]),
+        "docker image inspect": "{a}  10 app:1\n{b} {a} 20 \n{c} {b} 30 \n".format(a=img_a, b=img_b, c=img_c),
+        "docker ps --all --quiet --no-trunc": "c1\nc2\n",
+        "docker container inspect": "c1 {} running\nc2 {} exited\n".format(img_a, img_c),
+        "docker rm -v": "c2\n",
+        # untagged parent is pruned along with its child
+        "docker rmi": "Deleted: {c}\nDeleted: {b}\nError: No such image: {b}\n".format(b=img_b, c=img_c),
+    }
+
+    def mock_process(cmd, *_, **__):
+        output = [out for prefix, out in outputs.items() if cmd.startswith(prefix)][0]
+        proc = mock.MagicMock()
+        proc.communicate.return_value = (output, None)
+        proc.stdout.readline.side_effect = output.splitlines(True) + [""]
+        proc.wait.return_value = 1
+        return proc
+
+    with mock.patch("subprocess.Popen", side_effect=mock_process) as proc:
+        results = docker_clean_unused(backend="cli")
+    commands = [call.args[0] for call in proc.call_args_list]
+    assert commands[-2] == "docker rm -v c2"
+    assert commands[-1] == "docker rmi {} {}".format(img_c, img_b), "child image must be removed before its parent"
+    assert [(result.tag, result.success) for result in results] == [("c2", True), (img_c, True), (img_b, True)]
+    assert sum(result.size for result in results) == 50
@@ -0,0 +1,353 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import time
+from contextlib import contextmanager
+
+import mock
+import pytest
+import yaml
+
+import _json_yaml_converter
+from _json_yaml_converter import (
+    ConverterServer,
+    convert_large_json,
+    iter_json_items,
+    main,
+    read_content,
+    read_documents,
+    write_content
+)
+from tests import CONVERT_TOOLS_DIR
+
+DATA = {"name": "test", "items": [1, 2.5, "3", None, True], "nested": {"unicode": "é", "date-like": "2021-01-01"}}
+
+
+def run_main(*args):
+    with mock.patch("sys.argv", ["converter"] + [str(arg) for arg in args]):
+        main()
+
+
+@pytest.mark.parametrize("ext", [".json", ".yaml", ".yml"])
+def test_convert_round_trip(tmp_path, ext):
+    file_in = tmp_path / "input.json"
+    file_in.write_text(json.dumps(DATA))
+    file_out = tmp_path / ("output" + ext)
+    run_main(file_in, file_out)
+    assert read_content(str(file_out)) == DATA
+
+
+def test_read_content_json_parser(tmp_path):
+    file_in = tmp_path / "input.json"
+    file_in.write_text(json.dumps({"float": 1e3}))
+    with mock.patch.object(_json_yaml_converter.yaml, "load") as yaml_load:
+        assert read_content(str(file_in)) == {"float": 1000.0}
+        assert not yaml_load.called, "expected JSON input to be parsed without the YAML loader"
+
+
+def test_read_content_ignore_extension(tmp_path):
+    json_in = tmp_path / "input.txt"
+    json_in.write_text("\n  " + json.dumps(DATA))
+    flow_yaml_in = tmp_path / "flow.txt"
+    flow_yaml_in.write_text("{name: test, items: [1, 2]}\n")
+    yaml_in = tmp_path / "block.txt"
+    yaml_in.write_text(yaml.safe_dump(DATA))
+    assert read_content(str(json_in)) is False
+    assert read_content(str(json_in), ignore_extension=True) == DATA
+    assert read_content(str(flow_yaml_in), ignore_extension=True) == {"name": "test", "items": [1, 2]}
+    assert read_content(str(yaml_in), ignore_extension=True) == DATA
+
+
+def test_write_content_options(tmp_path):
+    yaml_out = tmp_path / "output.yml"
+    assert write_content({"b": "é", "a": 1}, str(yaml_out), sort=True, ensure_ascii=True)
+    assert yaml_out.read_text() == 'a: 1\nb: "\\xE9"\n'
+    json_out = tmp_path / "output.txt"
+    assert write_content({"b": "é", "a": 1}, str(json_out), file_format="json", indent=2)
+    assert json.loads(json_out.read_text()) == {"b": "é", "a": 1}
+
+
+def test_convert_stream_round_trip(tmp_path):
+    documents = [{"kind": "Pod", "metadata": {"name": "pod-{}".format(i)}} for i in range(3)] + [None, [1, 2]]
+    yaml_in = tmp_path / "manifests.yaml"
+    yaml_in.write_text(yaml.safe_dump_all(documents))
+    jsonl_out = tmp_path / "manifests.jsonl"
+    run_main("--stream", yaml_in, jsonl_out)
+    assert [json.loads(line) for line in jsonl_out.read_text().splitlines()] == documents
+
+    yaml_out = tmp_path / "converted.yml"
+    run_main("--stream", jsonl_out, yaml_out)
+    assert list(yaml.safe_load_all(yaml_out.read_text())) == documents
+    assert yaml_out.read_text().count("---") == len(documents)
+
+
+def test_read_documents_lazy(tmp_path):
+    file_in = tmp_path / "events.txt"
+    file_in.write_text("\n".join(json.dumps({"event": i}) for i in range(3)) + "\n{invalid\n")
+    assert read_documents(str(file_in)) is False
+    documents = read_documents(str(file_in), ignore_extension=True)
+    assert [next(documents) for _ in range(3)] == [{"event": 0}, {"event": 1}, {"event": 2}]
+    with pytest.raises(ValueError):
+        next(documents)  # invalid line only reached once previous documents were consumed
+
+
+def make_tree(root):
+    (root / "nested" / "deep").mkdir(parents=True)
+    (root / "a.json").write_text(json.dumps({"file": "a"}))
+    (root / "nested" / "b.yml").write_text("file: b\n")
+    (root / "nested" / "deep" / "c.json").write_text(json.dumps({"file": "c"}))
+    (root / "nested" / "invalid.json").write_text("{invalid: [")
+    (root / "nested" / "notes.txt").write_text("ignored")
+
+
+@pytest.mark.parametrize("jobs", [1, 2])
+def test_convert_directory(tmp_path, capsys, jobs):
+    make_tree(tmp_path / "in")
+    with pytest.raises(IOError, match="failed converting 1 of 4 files"):
+        run_main(tmp_path / "in", tmp_path / "out", "--jobs", jobs)
+    assert read_content(str(tmp_path / "out" / "a.yaml")) == {"file": "a"}
+    assert read_content(str(tmp_path / "out" / "nested" / "b.json")) == {"file": "b"}
+    assert read_content(str(tmp_path / "out" / "nested" / "deep" / "c.yaml")) == {"file": "c"}
+    assert not (tmp_path / "out" / "nested" / "notes.json").exists()
+    captured = capsys.readouterr()
+    assert "invalid.json" in captured.err
+    assert "Converted 3/4 files." in captured.out
+
+
+def test_convert_glob(tmp_path):
+    make_tree(tmp_path / "in")
+    run_main(str(tmp_path / "in" / "**" / "c.json"), tmp_path / "out", "--json", "--indent", 2)
+    assert json.loads((tmp_path / "out" / "nested" / "deep" / "c.json").read_text()) == {"file": "c"}
+    assert len(list((tmp_path / "out").rglob("*.*"))) == 1
+
+
+def test_convert_cache(tmp_path, capsys):
+    make_tree(tmp_path / "in")
+    (tmp_path / "in" / "nested" / "invalid.json").unlink()
+    manifest = tmp_path / "cache.json"
+    run_main(tmp_path / "in", tmp_path / "out", "--cache", manifest)
+    assert "Converted 3/3 files (0 unchanged)." in capsys.readouterr().out
+    entries = json.loads(manifest.read_text())["files"]
+    assert sorted(entries) == ["out/a.yaml", "out/nested/b.json", "out/nested/deep/c.yaml"]
+    output = tmp_path / "out" / "a.yaml"
+    mtime = output.stat().st_mtime_ns
+
+    with mock.patch("_json_yaml_converter.convert_file") as convert:
+        run_main(tmp_path / "in", tmp_path / "out", "--cache", manifest)
+        assert not convert.called, "expected unchanged inputs to be skipped entirely"
+    assert "Converted 3/3 files (3 unchanged)." in capsys.readouterr().out
+
+    # same contents rewritten in input, and equivalent options producing identical output
+    (tmp_path / "in" / "a.json").write_text(json.dumps({"file": "a"}))
+    run_main(tmp_path / "in", tmp_path / "out", "--cache", manifest, "--indent", 2)
+    assert "Converted 3/3 files (0 unchanged)." in capsys.readouterr().out
+    assert output.stat().st_mtime_ns == mtime, "expected identical output not to be rewritten"
+
+    (tmp_path / "in" / "a.json").write_text(json.dumps({"file": "changed"}))
+    run_main(tmp_path / "in", tmp_path / "out", "--cache", manifest, "--indent", 2)
+    assert "Converted 3/3 files (2 unchanged)." in capsys.readouterr().out
+    assert read_content(str(output)) == {"file": "changed"}
+    assert not list((tmp_path / "out").rglob("*.tmp"))
+
+    # output modified externally must be regenerated
+    output.write_text("modified: true\n")
+    run_main(tmp_path / "in" / "a.json", output, "--cache", manifest, "--indent", 2)
+    assert read_content(str(output)) == {"file": "changed"}
+
+
+@pytest.mark.parametrize("data", [
+    [
+        {"id": i, "value": 12345.678 * i, "text": "é€𝄞" * (i % 4), "nested": [True, None, {"k": "v"}]}
+        for i in range(50)
+    ],
+    {"key-{}".format(i): [i, -i * 1e10, "x" * i] for i in range(50)},
+    [],
+    {},
+    [1234567890123],
+])
+def test_convert_large_json(tmp_path, data):
+    file_in = tmp_path / "input.json"
+    file_in.write_text(json.dumps(data, indent=1, ensure_ascii=False), encoding="utf-8")
+    expected = tmp_path / "expected.yaml"
+    write_content(data, str(expected))
+    for chunk_size in [3, 7, 64, 2 ** 20]:
+        file_out = tmp_path / "output-{}.yaml".format(chunk_size)
+        convert_large_json(str(file_in), str(file_out), chunk_size=chunk_size)
+        assert yaml.safe_load(file_out.read_text(encoding="utf-8")) == data
+        assert file_out.read_text(encoding="utf-8") == expected.read_text(encoding="utf-8")
+    run_main(file_in, tmp_path / "output.yml", "--large")
+    assert read_content(str(tmp_path / "output.yml")) == data
+
+
+@pytest.mark.parametrize("name, contents, data", [
+    ("input.txt", "name: test\nitems: [1, 2]\n", {"name": "test", "items": [1, 2]}),
+    ("input.txt", "123\n", 123),
+    ("input.json", '"text"', "text"),
+])
+def test_convert_large_not_streamable(tmp_path, name, contents, data):
+    file_in = tmp_path / name
+    file_in.write_text(contents)
+    run_main(file_in, tmp_path / "output.yml", "--large", "-i")
+    assert read_content(str(tmp_path / "output.yml")) == data
+
+
+def test_iter_json_items_number_chunk_boundary(tmp_path):
+    file_in = tmp_path / "input.json"
+    numbers = [12.5, -0.25, 1e5, 2.5E-3, 1234567.125, -7e+10, 0, 100]
+    file_in.write_text(json.dumps(numbers))
+    for chunk_size in range(1, 16):
+        assert list(iter_json_items(str(file_in), chunk_size=chunk_size))[1:] == numbers
+    for prefix in range(8):
+        # chunk boundary right after the '.' or 'e' of numbers
+        contents = '["{}", 12.5, 1e5, {{"a": 3.75}}]'.format("a" * prefix)
+        file_in.write_text(contents)
+        assert list(iter_json_items(str(file_in), chunk_size=prefix + 7))[1:] == json.loads(contents)
+    contents = '["' + 'a' * (2 ** 20 - 8) + '", 12.5]'
+    file_in.write_text(contents)
+    assert list(iter_json_items(str(file_in)))[1:] == json.loads(contents)
+
+
+def test_iter_json_items_invalid(tmp_path):
+    file_in = tmp_path / "input.json"
+    for contents in ["", "123", "[1, 2", "[1 2]", '{"a" 1}']:
+        file_in.write_text(contents)
+        with pytest.raises(ValueError):
+            list(iter_json_items(str(file_in), chunk_size=2))
+
+
+@contextmanager
+def converter_server(socket_path):
+    proc = subprocess.Popen([sys.executable, os.path.join(CONVERT_TOOLS_DIR, "_json_yaml_converter.py"),
+                             "--serve", socket_path], stdout=subprocess.DEVNULL)
+    try:
+        for _ in range(100):
+            if os.path.exists(socket_path):
+                break
+            time.sleep(0.05)
+        yield proc
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def request_server(socket_path, cwd, *args):
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.connect(socket_path)
+    client.sendall("".join("{}\0".format(arg) for arg in [cwd, "yaml2json"] + list(args)).encode("utf-8"))
+    client.shutdown(socket.SHUT_WR)
+    response = b"".join(iter(lambda: client.recv(4096), b"")).decode("utf-8")
+    client.close()
+    output, _, code = response.rpartition("\n")
+    return output, int(code)
+
+
+def test_converter_server(tmp_path):
+    socket_path = str(tmp_path / "converter.sock")
+    (tmp_path / "input.yml").write_text("name: test\n")
+    with converter_server(socket_path):
+        output, code = request_server(socket_path, str(tmp_path), "input.yml", "output.json", "--indent", "2")
+        assert code == 0 and output == ""
+        assert json.loads((tmp_path / "output.json").read_text()) == {"name": "test"}
+
+        output, code = request_server(socket_path, str(tmp_path), "missing.yml", "output.json")
+        assert code == 1 and "failed reading: [missing.yml]" in output
+
+        output, code = request_server(socket_path, str(tmp_path), "--version")
+        assert code == 0 and output.startswith("yaml2json ")
+    assert not os.path.exists(socket_path), "expected socket to be removed when the server stops"
+
+
+def test_converter_server_foreign_socket(tmp_path):
+    socket_path = str(tmp_path / "converter.sock")
+    (tmp_path / "converter.sock").write_text("")
+    with mock.patch("_json_yaml_converter.os.getuid", return_value=os.getuid() + 1):
+        with pytest.raises(PermissionError):
+            ConverterServer(socket_path)
+    assert os.path.exists(socket_path), "expected location owned by another user to be left untouched"
+
+    os.remove(socket_path)
+    server = ConverterServer(socket_path)
+    os.remove(socket_path)
+    (tmp_path / "converter.sock").write_text("")  # replaced while the server was running
+    server.server_close()
+    assert os.path.exists(socket_path), "expected only the socket created by the server to be removed"
+
+
+def test_converter_server_already_running(tmp_path):
+    socket_path = str(tmp_path / "converter.sock")
+    (tmp_path / "input.yml").write_text("name: test\n")
+    with converter_server(socket_path):
+        with pytest.raises(OSError, match="already running"):
+            ConverterServer(socket_path)
+        output, code = request_server(socket_path, str(tmp_path), "input.yml", "output.json")
+        assert code == 0 and output == "", "running server should not be replaced"
+
+    stale = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    stale.bind(socket_path)
+    stale.close()
+    server = ConverterServer(socket_path)
+    server.server_close()
+    assert not os.path.exists(socket_path)
+
+
+def run_wrapper_fake_socat(tmp_path, socket_path, response, *args):
+    """
+    Runs the wrapper script with a fake ``socat`` command that returns the given server response.
+    """
+    (tmp_path / "bin").mkdir()
+    (tmp_path / "bin" / "response").write_text(response)
+    (tmp_path / "bin" / "socat").write_text("#!/bin/sh\ncat '{}'\n".format(tmp_path / "bin" / "response"))
+    os.chmod(str(tmp_path / "bin" / "socat"), 0o755)
+    env = dict(os.environ, JSON_YAML_CONVERTER_SOCKET=socket_path,
+               PATH="{}:{}".format(tmp_path / "bin", os.environ["PATH"]))
+    return subprocess.run([os.path.join(CONVERT_TOOLS_DIR, "json2yaml")] + list(args), cwd=str(tmp_path), env=env,
+                          stdout=subprocess.PIPE, check=True, universal_newlines=True)
+
+
+def test_wrapper_forwarded_output(tmp_path):
+    socket_path = str(tmp_path / "converter.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    try:
+        result = run_wrapper_fake_socat(tmp_path, socket_path, "json2yaml 1.0\n\n0", "--version")
+    finally:
+        listener.close()
+    assert result.stdout == "json2yaml 1.0\n", "output should be forwarded as is"
+
+
+@pytest.mark.skipif(os.getuid() != 0, reason="changing the owner of the socket requires root")
+def test_wrapper_ignores_foreign_socket(tmp_path):
+    socket_path = str(tmp_path / "converter.sock")
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    os.chown(socket_path, 65534, 65534)
+    (tmp_path / "input.json").write_text(json.dumps({"name": "test"}))
+    try:
+        # server response would pretend a successful conversion
+        run_wrapper_fake_socat(tmp_path, socket_path, "\n0", "input.json", "output.yaml")
+    finally:
+        listener.close()
+    assert read_content(str(tmp_path / "output.yaml")) == {"name": "test"}
+
+
+def test_wrapper_fallback_without_server(tmp_path):
+    (tmp_path / "input.json").write_text(json.dumps({"name": "test"}))
+    env = dict(os.environ, JSON_YAML_CONVERTER_SOCKET=str(tmp_path / "missing.sock"))
+    subprocess.run([os.path.join(CONVERT_TOOLS_DIR, "json2yaml"), "input.json", "output.yaml"],
+                   cwd=str(tmp_path), env=env, check=True)
+    assert read_content(str(tmp_path / "output.yaml")) == {"name": "test"}
+
+
+@pytest.mark.skipif(not shutil.which("socat"), reason="socat is required by the wrapper to connect to the server")
+def test_wrapper_forwards_to_server(tmp_path):
+    socket_path = str(tmp_path / "converter.sock")
+    (tmp_path / "input.json").write_text(json.dumps({"name": "test"}))
+    env = dict(os.environ, JSON_YAML_CONVERTER_SOCKET=socket_path)
+    with converter_server(socket_path):
+        result = subprocess.run([os.path.join(CONVERT_TOOLS_DIR, "json2yaml"), "input.json", "output.yaml"],
+                                cwd=str(tmp_path), env=env)
+    assert result.returncode == 0
+    assert read_content(str(tmp_path / "output.yaml")) == {"name": "test"}
@@ -0,0 +1,229 @@
+import json
+import os
+import threading
+
+import mock
+import pytest
+import yaml
+
+from merge_cwl_app_deploy import DocumentCache, load_document, read_manifest, run, run_batch
+
+TOOL = {"cwlVersion": "v1.0", "class": "CommandLineTool", "baseCommand": "echo", "inputs": {}, "outputs": {}}
+
+
+def write_yaml(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        yaml.safe_dump(data, f)
+
+
+def make_workflow(tool_ref):
+    return {
+        "cwlVersion": "v1.0",
+        "class": "Workflow",
+        "inputs": {},
+        "outputs": {},
+        "requirements": [{"$import": "../common/requirements.yml"}],
+        "steps": {"echo": {"run": tool_ref, "in": {}, "out": []}},
+        "doc": {"$include": "../common/doc.txt"},
+    }
+
+
+@pytest.fixture
+def catalog(tmpdir):
+    root = str(tmpdir)
+    write_yaml(os.path.join(root, "common", "echo.cwl"), TOOL)
+    write_yaml(os.path.join(root, "common", "requirements.yml"), {"class": "InlineJavascriptRequirement"})
+    with open(os.path.join(root, "common", "doc.txt"), "w") as f:
+        f.write("Shared documentation.\n")
+    entries = []
+    for i in range(6):
+        app = os.path.join(root, "process{}".format(i), "package.cwl")
+        deploy = os.path.join(root, "process{}".format(i), "deploy.{}".format("json" if i % 2 else "yml"))
+        write_yaml(app, make_workflow("../common/echo.cwl"))
+        if i % 2:
+            with open(deploy, "w") as f:
+                json.dump({"processDescription": {"id": "process{}".format(i)}}, f)
+        else:
+            write_yaml(deploy, {"processDescription": {"id": "process{}".format(i)}})
+        entries.append({"app_package": app, "process_deploy": deploy})
+    return root, entries
+
+
+def load_unit(path):
+    with open(path) as f:
+        return yaml.safe_load(f)["executionUnit"][0]["unit"]
+
+
+def test_run_without_resolve(catalog):
+    _, entries = catalog
+    run(**entries[0])
+    unit = load_unit(entries[0]["process_deploy"])
+    assert unit["steps"]["echo"]["run"] == "../common/echo.cwl"
+    assert unit["requirements"] == [{"$import": "../common/requirements.yml"}]
+
+
+def test_run_resolve_references(catalog):
+    _, entries = catalog
+    run(resolve=True, **entries[0])
+    unit = load_unit(entries[0]["process_deploy"])
+    assert unit["steps"]["echo"]["run"] == TOOL
+    assert unit["requirements"] == [{"class": "InlineJavascriptRequirement"}]
+    assert unit["doc"] == "Shared documentation.\n"
+
+
+def test_run_resolve_remote_and_fragment(tmpdir):
+    app = os.path.join(str(tmpdir), "package.cwl")
+    deploy = os.path.join(str(tmpdir), "deploy.json")
+    graph = {"cwlVersion": "v1.0", "$graph": [dict(TOOL, id="#first"), dict(TOOL, id="second", baseCommand="ls")]}
+    write_yaml(os.path.join(str(tmpdir), "tools.cwl"), graph)
+    workflow = make_workflow("https://example.com/tool.cwl")
+    workflow.pop("requirements")
+    workflow.pop("doc")
+    workflow["steps"]["other"] = {"run": "tools.cwl#second", "in": {}, "out": []}
+    workflow["steps"]["local"] = {"run": "#main", "in": {}, "out": []}
+    write_yaml(app, workflow)
+    with open(deploy, "w") as f:
+        json.dump({}, f)
+    run(app, deploy, resolve=True)
+    unit = load_unit(deploy)
+    assert unit["steps"]["echo"]["run"] == "https://example.com/tool.cwl"
+    assert unit["steps"]["other"]["run"]["baseCommand"] == "ls"
+    assert unit["steps"]["local"]["run"] == "#main"
+
+
+def test_run_resolve_cyclic_reference(tmpdir):
+    first = os.path.join(str(tmpdir), "first.cwl")
+    second = os.path.join(str(tmpdir), "second.cwl")
+    deploy = os.path.join(str(tmpdir), "deploy.json")
+    write_yaml(first, {"class": "Workflow", "steps": {"loop": {"run": "second.cwl"}}})
+    write_yaml(second, {"class": "Workflow", "steps": {"loop": {"run": "first.cwl"}}})
+    with open(deploy, "w") as f:
+        json.dump({}, f)
+    with pytest.raises(ValueError, match="Cyclic reference"):
+        run(first, deploy, resolve=True)
+
+
+def test_run_batch_cyclic_reference(tmpdir):
+    entries = []
+    for name, other in [("first", "second"), ("second", "first")]:
+        app = os.path.join(str(tmpdir), "{}.cwl".format(name))
+        write_yaml(app, {"class": "Workflow", "steps": {"loop": {"run": "{}.cwl".format(other)}}})
+        entries.append({"app_package": app, "process_deploy": os.path.join(str(tmpdir), "{}.json".format(name))})
+        with open(entries[-1]["process_deploy"], "w") as f:
+            json.dump({}, f)
+    barrier = threading.Barrier(2, timeout=5)
+
+    def load_both(path):
+        document = load_document(path)
+        barrier.wait()  # each package is being loaded by its own thread when resolving the reference to the other
+        return document
+
+    results = []
+    with mock.patch("merge_cwl_app_deploy.load_document", side_effect=load_both):
+        batch = threading.Thread(target=lambda: results.extend(run_batch(entries, jobs=2)), daemon=True)
+        batch.start()
+        batch.join(timeout=10)
+    assert not batch.is_alive(), "cyclic references resolved from different threads should not block forever"
+    assert all("Cyclic reference" in result[3] for result in results) and len(results) == 2
+
+
+def test_run_batch_shared_cache(catalog):
+    root, entries = catalog
+    entries.append({"app_package": os.path.join(root, "missing.cwl"),
+                    "process_deploy": os.path.join(root, "missing.json")})
+    cache = DocumentCache()
+    with mock.patch("merge_cwl_app_deploy.load_document", side_effect=load_document) as loader:
+        results = run_batch(entries, jobs=4, cache=cache)
+    assert [result[0] for result in results] == [entry["process_deploy"] for entry in entries]
+    assert all(result[1] and result[3] is None for result in results[:-1])
+    assert "FileNotFoundError" in results[-1][3]
+    # each application package once, and common tool and requirement only once for all of them
+    assert loader.call_count == 6 + 2 + 1  # including the failed attempt of the missing package
+    for entry in entries[:-1]:
+        unit = load_unit(entry["process_deploy"])
+        assert unit["steps"]["echo"]["run"] == TOOL
+        assert unit["doc"] == "Shared documentation.\n"
+    with open(entries[0]["process_deploy"]) as f:
+        assert "&id" not in f.read(), "shared documents should not be written as YAML aliases"
+
+    results = run_batch(entries[:-1], jobs=4)
+    assert [result[1] for result in results] == [False] * 6
+
+
+def test_run_skip_unchanged(catalog):
+    _, entries = catalog
+    deploy = entries[1]["process_deploy"]
+    os.chmod(deploy, 0o640)
+    assert run(**entries[1])
+    assert os.stat(deploy).st_mode & 0o777 == 0o640
+    mtime = os.stat(deploy).st_mtime_ns
+    assert not run(**entries[1])
+    assert os.stat(deploy).st_mtime_ns == mtime
+
+    # same unit in another key order and format is still unchanged, but a modified one is updated
+    with open(entries[1]["app_package"]) as f:
+        app = yaml.safe_load(f)
+    with open(entries[1]["app_package"], "w") as f:
+        json.dump(dict(reversed(list(app.items()))), f)
+    assert not run(**entries[1])
+    app["baseCommand"] = "ls"
+    with open(entries[1]["app_package"], "w") as f:
+        json.dump(app, f)
+    assert run(**entries[1])
+    assert load_unit(deploy)["baseCommand"] == "ls"
+    assert sorted(os.listdir(os.path.dirname(deploy))) == ["deploy.json", "package.cwl"]
+
+
+def test_run_interrupted_write(catalog):
+    _, entries = catalog
+    deploy = entries[0]["process_deploy"]
+    with open(deploy) as f:
+        original = f.read()
+    with mock.patch("merge_cwl_app_deploy.os.replace", side_effect=OSError("interrupted")):
+        with pytest.raises(OSError):
+            run(**entries[0])
+    with open(deploy) as f:
+        assert f.read() == original
+    assert sorted(os.listdir(os.path.dirname(deploy))) == ["deploy.yml", "package.cwl"]
+
+
+def test_run_symlinked_deploy(catalog):
+    _, entries = catalog
+    deploy = entries[1]["process_deploy"]
+    real = os.path.join(os.path.dirname(deploy), "real.json")
+    os.rename(deploy, real)
+    os.symlink("real.json", deploy)
+    assert run(**entries[1])
+    assert os.readlink(deploy) == "real.json"
+    assert load_unit(real)["steps"]["echo"]["run"] == "../common/echo.cwl"
+
+
+def test_read_manifest(tmpdir):
+    text = os.path.join(str(tmpdir), "manifest.txt")
+    with open(text, "w") as f:
+        f.write("# catalog\napp1/package.cwl app1/deploy.json\n\n/abs/package.cwl /abs/deploy.yml  # absolute\n")
+    assert read_manifest(text) == [
+        {"app_package": os.path.join(str(tmpdir), "app1/package.cwl"),
+         "process_deploy": os.path.join(str(tmpdir), "app1/deploy.json")},
+        {"app_package": "/abs/package.cwl", "process_deploy": "/abs/deploy.yml"},
+    ]
+    manifest = os.path.join(str(tmpdir), "manifest.json")
+    with open(manifest, "w") as f:
+        json.dump([{"app_package": "package.cwl", "process_deploy": "deploy.json"}], f)
+    assert read_manifest(manifest) == [{"app_package": os.path.join(str(tmpdir), "package.cwl"),
+                                        "process_deploy": os.path.join(str(tmpdir), "deploy.json")}]
+
+
+def test_run_yaml_key_order(tmpdir):
+    app = os.path.join(str(tmpdir), "package.cwl")
+    deploy = os.path.join(str(tmpdir), "deploy.yml")
+    with open(app, "w") as f:
+        f.write("cwlVersion: v1.0\nclass: CommandLineTool\nbaseCommand: echo\ninputs: {}\noutputs: {}\n")
+    with open(deploy, "w") as f:
+        f.write("  \n{processDescription: {id: test}, immediateDeployment: true}\n")  # JSON-like YAML flow mapping
+    assert run(app, deploy)
+    with open(deploy) as f:
+        body = f.read()
+    assert list(yaml.safe_load(body)) == ["processDescription", "immediateDeployment", "executionUnit"]
+    assert body.index("cwlVersion") < body.index("class") < body.index("baseCommand") < body.index("inputs")